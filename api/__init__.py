@@ -1,6 +1,8 @@
-from flask import Blueprint
+from flask import Blueprint, make_response
 from flask_restx import Api
 
+from serializer import dumps
+
 api_bp = Blueprint('api_bp', __name__, url_prefix='/api/v1')
 authorizations = {
     'Bearer Auth': {
@@ -17,5 +19,13 @@ api = Api(api_bp, version='1.0',
             authorizations=authorizations,
             security='Bearer Auth')
 
+# Serialize responses with the app's JSON encoder (orjson when installed)
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    response = make_response(dumps(data) + b'\n', code)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers.extend(headers or {})
+    return response
+
 # Import the routes to register the endpoints
 from . import routes
\ No newline at end of file
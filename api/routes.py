@@ -1,9 +1,14 @@
+import base64
+import json
 import sqlite3
-from flask_restx import Resource, fields
-from flask import current_app, jsonify, request
-from flask_jwt_extended import create_access_token, jwt_required
+import time
+from urllib.parse import urlencode
+from uuid import UUID
+from flask_restx import Resource, fields, inputs, marshal, reqparse
+from flask import current_app, request
+from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
 from . import api, api_bp
-from models import Db
+from transactions import apply_bulk_transactions, apply_transaction
 # from app import db
 
 # Define a namespace
@@ -32,6 +37,7 @@ class NullableInteger(fields.Integer):
 
 # Define API model for Encounter
 encounter_model = encounters_ns.model('Encounter', {
+    'uuid': fields.String(readonly=True, description='Encounter UUID'),
     'aid_station': fields.String(required=True, description='Aid Station Name'),
     'bib': fields.String(description='Bib Number'),
     'first_name': fields.String(description='First Name'),
@@ -60,7 +66,8 @@ encounter_model = encounters_ns.model('Encounter', {
     'hospital': fields.String(description='Hospital'),
     'notes': fields.String(description='Notes'),
     'delete_flag': fields.Boolean(description='Delete Flag'),
-    'delete_reason': fields.String(description='Delete Reason')
+    'delete_reason': fields.String(description='Delete Reason'),
+    'updated_at': fields.String(readonly=True, description='Time of the last change')
 })
 
 # Define API model for Person
@@ -78,18 +85,102 @@ person_model = persons_ns.model('Person', {
 # *====================================================================*
 #         INITIALIZE DB & DB access
 # *====================================================================*
-db = Db()
+# The app's Db, registered as app.extensions['db'], so the API shares its
+# connection pool, pool settings and async mode
+def app_db():
+    return current_app.extensions['db']
 
-def initialize_db():
-    db.add_db(current_app.config.get('DATABASE_PATH'))
 
-
-# Connect to database
+# Lease a pooled database connection
 def get_db():
-    initialize_db()
-    conn = db.db_connect()
-    conn.row_factory = sqlite3.Row
-    return conn
+    return app_db().connection()
+
+# Run a query returning sqlite3.Row rows without changing the pooled
+# connection's row factory
+def fetch_rows(conn, query, values=()):
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    return cursor.execute(query, values).fetchall()
+
+# *====================================================================*
+#         PAGINATION
+# *====================================================================*
+# List endpoints return one page of rows in rowid order.  When there are
+# more, the X-Next-Cursor header holds an opaque cursor for the next page
+# (also given as a Link rel="next" header); pass it back as ?cursor=.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def page_parser():
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type=inputs.int_range(1, MAX_PAGE_SIZE), default=DEFAULT_PAGE_SIZE, location='args',
+                        help=f'Rows per page, at most {MAX_PAGE_SIZE}')
+    parser.add_argument('cursor', type=str, location='args', help='Cursor from X-Next-Cursor of the previous page')
+    parser.add_argument('fields', type=str, location='args', help='Comma separated fields to return')
+    parser.add_argument('bib', type=str, location='args', help='Only rows for this bib number')
+    return parser
+
+encounter_parser = page_parser()
+encounter_parser.add_argument('aid_station', type=str, location='args', help='Only encounters at this aid station')
+encounter_parser.add_argument('updated_since', type=str, location='args',
+                              help="Only encounters changed after this time ('YYYY-MM-DD HH:MM:SS')")
+encounter_parser.add_argument('active_only', type=inputs.boolean, default=False, location='args',
+                              help='Only encounters not yet discharged')
+
+person_parser = page_parser()
+
+
+def encode_cursor(rowid):
+    return base64.urlsafe_b64encode(f'rowid:{rowid}'.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        kind, rowid = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split(':')
+        if kind != 'rowid':
+            raise ValueError(kind)
+        return int(rowid)
+    except ValueError:
+        api.abort(400, f'Invalid cursor {cursor}')
+
+# The columns of model named in fields (all when fields is empty), limited
+# to those in the table.  Returns (columns, mask for marshal).
+def projection(model, fields_arg, table_columns):
+    names = [name for name in model.keys() if name in table_columns]
+    if fields_arg:
+        wanted = [name.strip() for name in fields_arg.split(',') if name.strip()]
+        unknown = [name for name in wanted if name not in model.keys()]
+        if unknown:
+            api.abort(400, f"Unknown fields: {', '.join(unknown)}")
+        names = [name for name in wanted if name in table_columns]
+    return names, '{' + ','.join(names) + '}' if fields_arg else None
+
+# Fetch one page of table with the given filters ([(sql, value), ...]) and
+# return the marshalled rows with pagination headers
+def fetch_page(table, model, args, filters):
+    with get_db() as conn:
+        table_columns = app_db().table_columns(table)
+        columns, mask = projection(model, args['fields'], table_columns)
+        where = [sql for sql, value in filters]
+        values = [value for sql, value in filters if value is not None]
+        if args['cursor']:
+            where.append('rowid > ?')
+            values.append(decode_cursor(args['cursor']))
+        query = f"SELECT rowid AS _rowid, {', '.join(columns) or 'NULL'} FROM {table}"
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY rowid LIMIT ?'
+        rows = fetch_rows(conn, query, values + [args['limit'] + 1])
+
+    headers = {}
+    if len(rows) > args['limit']:
+        rows = rows[:args['limit']]
+        cursor = encode_cursor(rows[-1]['_rowid'])
+        next_args = request.args.to_dict()
+        next_args['cursor'] = cursor
+        headers['X-Next-Cursor'] = cursor
+        headers['Link'] = f'<{request.base_url}?{urlencode(next_args)}>; rel="next"'
+    return marshal([dict(row) for row in rows], model, mask=mask), 200, headers
+
 
 # JWT Token Generation Endpoint
 @auth_ns.route('/tokens', methods=['POST'])
@@ -115,35 +206,245 @@ class Auth(Resource):
 @encounters_ns.route('/')
 class EncounterList(Resource):
     @jwt_required()
-    @encounters_ns.marshal_list_with(encounter_model)
+    @encounters_ns.expect(encounter_parser)
+    @encounters_ns.response(200, 'Success', [encounter_model])
     def get(self):
-        """Fetch all encounters"""
-        with get_db() as conn:
-            encounters = conn.execute('SELECT * FROM encounters WHERE delete_flag != 1').fetchall()
-        return [dict(row) for row in encounters], 200
+        """Fetch a page of encounters"""
+        args = encounter_parser.parse_args()
+        filters = [('delete_flag != 1', None)]
+        if args['aid_station']:
+            filters.append(('aid_station = ?', args['aid_station']))
+        if args['bib']:
+            filters.append(('bib = ?', args['bib']))
+        if args['updated_since']:
+            filters.append(('updated_at > ?', args['updated_since']))
+        if args['active_only']:
+            filters.append(("(time_out IS NULL OR time_out = '')", None))
+        return fetch_page('encounters', encounter_model, args, filters)
 
     @jwt_required()
     @encounters_ns.expect(encounter_model)
     def post(self):
         """Create a new encounter"""
         data = request.json
-        with get_db() as conn:
-            conn.execute('''INSERT INTO encounters (aid_station, bib, first_name, last_name, age, sex, participant, active_duty, time_in, time_out, presentation, vitals, iv, iv_fluid_count, oral_fluid, treatments, disposition, hospital, notes, delete_flag, delete_reason)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (data['aid_station'], data['bib'], data['first_name'], data['last_name'], data['age'], data['sex'], data['participant'], data['active_duty'], data['time_in'], data['time_out'], data['presentation'], data['vitals'], data['iv'], data['iv_fluid_count'], data['oral_fluid'], data['treatments'], data['disposition'], data['hospital'], data['notes'], data['delete_flag'], data['delete_reason']))
-            conn.commit()
-        return {'message': 'Encounter created'}, 201
+        db = app_db()
+        payload = {'action': 'create'}
+        for key, field in encounter_model.items():
+            if key in data and not field.readonly:
+                payload[f'data[0][{key}]'] = data[key]
+        result = apply_transaction(db, payload=payload, user=get_jwt_identity())
+        if 'error' in result:
+            return {'message': result['error']}, 400
+        return {'message': 'Encounter created', 'uuid': result['encounter_uuid']}, 201
+
+# Bulk create, edit and remove.  The body is a JSON array of operations, or
+# one operation per line with Content-Type application/x-ndjson.  All the
+# operations are applied in one transaction through the same path as the
+# internal API (audit log, sync log and browser updates); if any of them is
+# invalid none are applied.  Clients may send a transaction_uuid with each
+# operation so a retried request does not apply it twice.
+MAX_BULK_OPERATIONS = 1000
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl')
+BULK_ACTIONS = ('create', 'edit', 'remove')
+
+bulk_operation_model = encounters_ns.model('EncounterOperation', {
+    'action': fields.String(required=True, enum=list(BULK_ACTIONS), description='create, edit or remove'),
+    'uuid': fields.String(description='Encounter UUID, generated for a create when missing'),
+    'transaction_uuid': fields.String(description='Client UUID of this operation, repeats are skipped'),
+    'data': fields.Nested(encounter_model, description='Encounter fields to set, not used by remove'),
+})
+
+bulk_result_model = encounters_ns.model('EncounterOperationResult', {
+    'index': fields.Integer(description='Position of the operation in the request'),
+    'action': fields.String(description='create, edit or remove'),
+    'uuid': fields.String(description='Encounter UUID'),
+    'transaction_uuid': fields.String(description='UUID of the transaction'),
+    'status': fields.String(description='created, edited, removed, duplicate, error or not_applied'),
+    'error': fields.String(description='Why the operation was rejected'),
+})
+
+bulk_response_model = encounters_ns.model('EncounterBulkResult', {
+    'applied': fields.Boolean(description='True if the operations were saved'),
+    'count': fields.Integer(description='Operations in the request'),
+    'results': fields.List(fields.Nested(bulk_result_model)),
+})
+
+# The operations in the request body, or abort with 400/413
+def read_operations():
+    if request.mimetype in NDJSON_TYPES:
+        operations = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if line.strip():
+                try:
+                    operations.append(json.loads(line))
+                except ValueError as e:
+                    api.abort(400, f'Invalid JSON on line {number}: {e}')
+    else:
+        operations = request.get_json(silent=True)
+        if not isinstance(operations, list):
+            api.abort(400, 'Expected a JSON array of operations')
+    if not operations:
+        api.abort(400, 'No operations')
+    if len(operations) > MAX_BULK_OPERATIONS:
+        api.abort(413, f'At most {MAX_BULK_OPERATIONS} operations per request')
+    return operations
+
+# Returns an error message for an operation that is not well formed, or None
+def check_operation(op):
+    if not isinstance(op, dict):
+        return 'Operation is not an object'
+    if op.get('action') not in BULK_ACTIONS:
+        return f"Unknown action {op.get('action')}"
+    for key in ('uuid', 'transaction_uuid'):
+        if op.get(key) is not None:
+            try:
+                UUID(str(op[key]))
+            except ValueError:
+                return f'Invalid {key} {op[key]}'
+    if op.get('uuid') is None and op['action'] != 'create':
+        return f"uuid is required to {op['action']}"
+    data = op.get('data') or {}
+    if not isinstance(data, dict):
+        return 'data is not an object'
+    unknown = [key for key in data if key not in encounter_model or encounter_model[key].readonly]
+    if unknown:
+        return f"Unknown or read only fields: {', '.join(unknown)}"
+    if op['action'] == 'create' and not data.get('aid_station'):
+        return 'aid_station is required to create'
+    return None
+
+@encounters_ns.route('/bulk')
+class EncounterBulk(Resource):
+    @jwt_required()
+    @encounters_ns.expect([bulk_operation_model])
+    @encounters_ns.response(200, 'All operations applied', bulk_response_model)
+    @encounters_ns.response(422, 'No operations applied', bulk_response_model)
+    def post(self):
+        """Create, edit and remove encounters in one transaction"""
+        operations = read_operations()
+        db = app_db()
+
+        errors = [(index, check_operation(op)) for index, op in enumerate(operations)]
+        if any(error for index, error in errors):
+            results = [{'index': index, 'action': op.get('action') if isinstance(op, dict) else None,
+                        'uuid': op.get('uuid') if isinstance(op, dict) else None,
+                        'status': 'error' if error else 'not_applied', 'error': error}
+                       for (index, error), op in zip(errors, operations)]
+            return marshal({'applied': False, 'count': len(operations), 'results': results}, bulk_response_model), 422
+
+        applied, results = apply_bulk_transactions(db, operations, user=get_jwt_identity())
+        body = marshal({'applied': applied, 'count': len(operations), 'results': results}, bulk_response_model)
+        return body, 200 if applied else 422
+
+# Change feed: the encounters created, edited or removed after a sequence
+# number.  Sequence numbers are this server's encounter_transactions ids, so
+# a client keeps the returned version and passes it back as ?since=.
+change_parser = reqparse.RequestParser()
+change_parser.add_argument('since', type=inputs.natural, default=0, location='args',
+                           help='Version returned by the previous call, 0 for everything')
+change_parser.add_argument('limit', type=inputs.int_range(1, MAX_PAGE_SIZE), default=DEFAULT_PAGE_SIZE, location='args',
+                           help=f'Transactions to read per call, at most {MAX_PAGE_SIZE}')
+change_parser.add_argument('wait', type=inputs.int_range(0, 30), default=0, location='args',
+                           help='Seconds to wait for a change when there is none yet')
+change_parser.add_argument('aid_station', type=str, location='args', help='Only changes at this aid station')
+
+change_model = encounters_ns.model('EncounterChange', {
+    'seq': fields.Integer(description='Sequence number of the latest change to the encounter'),
+    'action': fields.String(description='create, edit or remove'),
+    'uuid': fields.String(description='Encounter UUID'),
+    'encounter': fields.Nested(encounter_model, allow_null=True, description='Encounter as it is now, null when removed'),
+})
+
+change_feed_model = encounters_ns.model('EncounterChanges', {
+    'version': fields.Integer(description='Pass as since on the next call'),
+    'more': fields.Boolean(description='More changes are waiting, call again straight away'),
+    'reset': fields.Boolean(description='since is ahead of this server, start again from 0'),
+    'changes': fields.List(fields.Nested(change_model)),
+})
+
+CHANGE_POLL_SECONDS = 0.5
+
+# Sleep that yields to other greenlets when running under eventlet/gevent
+def api_sleep(seconds):
+    socketio = current_app.extensions.get('socketio')
+    if socketio is not None:
+        socketio.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+@encounters_ns.route('/changes')
+class EncounterChanges(Resource):
+    @jwt_required()
+    @encounters_ns.expect(change_parser)
+    @encounters_ns.marshal_with(change_feed_model)
+    def get(self):
+        """Fetch the encounters changed since a version, optionally waiting for a change"""
+        args = change_parser.parse_args()
+        deadline = time.monotonic() + args['wait']
+        while True:
+            with get_db() as conn:
+                latest = conn.execute('SELECT COALESCE(MAX(id), 0) FROM encounter_transactions').fetchone()[0]
+                if args['since'] > latest:
+                    return {'version': latest, 'more': False, 'reset': True, 'changes': []}
+                if latest > args['since'] or time.monotonic() >= deadline:
+                    transactions = conn.execute('SELECT id, encounter_uuid, data FROM encounter_transactions WHERE id > ? ORDER BY id LIMIT ?',
+                                                (args['since'], args['limit'])).fetchall()
+                    break
+            # Hold no connection while waiting
+            api_sleep(CHANGE_POLL_SECONDS)
+
+        # Latest change per encounter, noting those created in this window
+        changes = {}
+        created = set()
+        for seq, uuid, data in transactions:
+            try:
+                action = json.loads(data).get('action', 'edit').lower()
+            except (TypeError, ValueError, AttributeError):
+                action = 'edit'
+            if action == 'create':
+                created.add(uuid)
+            changes.pop(uuid, None)
+            changes[uuid] = {'seq': seq, 'action': action, 'uuid': uuid, 'encounter': None}
+
+        if changes:
+            uuids = list(changes)
+            rows = []
+            with get_db() as conn:
+                # Stay under SQLite's limit on bound parameters
+                for start in range(0, len(uuids), 500):
+                    chunk = uuids[start:start + 500]
+                    rows.extend(fetch_rows(conn, f"SELECT * FROM encounters WHERE uuid IN ({', '.join('?' * len(chunk))})", chunk))
+            for row in rows:
+                change = changes[row['uuid']]
+                if args['aid_station'] and row['aid_station'] != args['aid_station']:
+                    del changes[row['uuid']]
+                elif row['delete_flag'] == 1:
+                    change['action'] = 'remove'
+                else:
+                    change['action'] = 'create' if row['uuid'] in created else 'edit'
+                    change['encounter'] = dict(row)
+
+        return {
+            'version': transactions[-1][0] if transactions else latest,
+            'more': len(transactions) == args['limit'],
+            'reset': False,
+            'changes': list(changes.values()),
+        }
+
 
 # API Endpoints for Persons
 @persons_ns.route('/')
 class PersonList(Resource):
     @jwt_required()
-    @persons_ns.marshal_list_with(person_model)
+    @persons_ns.expect(person_parser)
+    @persons_ns.response(200, 'Success', [person_model])
     def get(self):
-        """Fetch all persons"""
-        with get_db() as conn:
-            persons = conn.execute('SELECT * FROM persons').fetchall()
-        return [dict(row) for row in persons], 200
+        """Fetch a page of persons"""
+        args = person_parser.parse_args()
+        filters = []
+        if args['bib']:
+            filters.append(('bib = ?', args['bib']))
+        return fetch_page('persons', person_model, args, filters)
 
     @jwt_required()
     @persons_ns.expect(person_model)
@@ -155,6 +456,7 @@ class PersonList(Resource):
                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
                          (data['bib'], data['first_name'], data['last_name'], data['age'], data['sex'], data['participant'], data['active_duty']))
             conn.commit()
+        app_db().table_changed('persons')
         return {'message': 'Person created'}, 201
 
 # Protect API and Add Blueprint
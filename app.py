@@ -16,32 +16,37 @@ __license__ = "MIT"
 
 
 from config import Config
-from io import BytesIO
+import atexit
 import json
 import os
-import pandas as pd
-import re
-import sqlite3
 import sys
-from uuid import uuid4, UUID
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, abort, Blueprint, g
+import time
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, Blueprint
 from flask_login import current_user, LoginManager, login_user, logout_user, login_required, UserMixin
 from urllib.parse import urlsplit
 from werkzeug.utils import secure_filename
 from datetime import datetime
 from flask_jwt_extended import JWTManager
-from flask_socketio import SocketIO, emit, join_room, leave_room
-import time
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 import socketio as socketioClient
-import threading
 
+from broadcast import BroadcastScheduler
+from chat_history import ChatHistory
+from exporter import ExportError, export_response
+from http_cache import PayloadCache
+from importer import Importer, ImportFileError
 from models import Db
+from participants import ParticipantIndex
+from serializer import JSONProvider, object_json
+from sync import SyncWorker, SnapshotReceiver, ack_message, decode_batch, reconcile, reject_message, snapshot_messages, start_reconcile
+from transactions import add_listener, apply_transaction, apply_sync_transactions
 
 from api import api_bp
 
 sync_mode = 'server'
 
-remote_sio = socketioClient.Client()
+# The sync worker does its own reconnecting, with backoff
+remote_sio = socketioClient.Client(reconnection=False)
 try:
     if (Config.UPSTREAM_ENDPOINT != "") and Config.SYNC_ENABLED:
         sync_mode = 'client'
@@ -55,6 +60,7 @@ print(f" * Starting syncing as {sync_mode}.", file=sys.stderr)
 # Initialize the app
 app = Flask(__name__)
 app.config.from_object(Config)
+app.json = JSONProvider(app)
 jwt = JWTManager(app)
 
 login_manager = LoginManager()
@@ -62,7 +68,7 @@ login_manager.login_view  = 'auth_bp.login'
 login_manager.init_app(app)
 
 socketio = SocketIO()
-socketio.init_app(app, cors_allowed_origins="*")
+socketio.init_app(app, cors_allowed_origins="*", async_mode=Config.ASYNC_MODE)
 
 # Setup some user stuff here
 class User(UserMixin):
@@ -130,7 +136,24 @@ for n, u in Config.USER_ACCOUNTS.items():
 # *====================================================================*
 #         INITIALIZE DB & DB access
 # *====================================================================*
-db = Db(Config.DATABASE_PATH)
+db = Db(Config.DATABASE_PATH,
+        pool_size=getattr(Config, 'DATABASE_POOL_SIZE', 8),
+        max_overflow=getattr(Config, 'DATABASE_POOL_OVERFLOW', 4),
+        pragmas=getattr(Config, 'DATABASE_PRAGMAS', None),
+        async_mode=socketio.async_mode)
+atexit.register(db.close)
+# The public API (api.routes) uses this Db too
+app.extensions['db'] = db
+
+# Rendered internal API payloads, see http_cache
+payload_cache = PayloadCache()
+
+# Participant search for the station pickers
+participant_index = ParticipantIndex(db)
+
+# Recent chat messages per room, see chat_history
+chat_history = ChatHistory(db, size=app.config.get('CHAT_HISTORY_BUFFER', 200),
+                           max_rooms=app.config.get('CHAT_HISTORY_ROOMS', 16))
 
 
 # *====================================================================*
@@ -186,88 +209,7 @@ def logout():
 @main_bp.route('/')
 @login_required
 def dashboard():
-    conn = db.db_connect()
-    cursor = conn.cursor()
-
-    active_encounters_by_station = {}
-    synopsis = {'total': {}, 'stations': {}}
-
-    for aid_station in Config.AID_STATIONS:
-
-        # Active Encounters (have a start time and not an end time)
-        cursor.execute('''SELECT * FROM encounters
-                          WHERE ( time_out IS NULL OR time_out="")
-                          AND aid_station=?
-                          AND delete_flag != 1
-                          ORDER BY time_in
-                       ''', (aid_station,))
-        active_encounters_by_station[aid_station] = cursor.fetchall()
-
-        # Generate Synopsis data set
-        synopsis['stations'][aid_station] = {}
-
-        # All Encounters
-        cursor.execute("SELECT COUNT(*) FROM encounters WHERE aid_station=? AND delete_flag !=1 ", (aid_station,))
-        synopsis['stations'][aid_station]['encounters'] = cursor.fetchone()[0]
-
-        # Active Encounters (have a start time and not an end time)
-        cursor.execute('''SELECT COUNT(*) FROM encounters
-                          WHERE time_in IS NOT NULL
-                          AND ( time_out IS NULL OR time_out="")
-                          AND aid_station=?
-                          AND delete_flag <> 1
-                       ''', (aid_station,))
-        synopsis['stations'][aid_station]['active'] = cursor.fetchone()[0]
-
-        # Closed Encounters Only (have an end time)
-        cursor.execute('''SELECT COUNT(*) FROM encounters
-                          WHERE time_out IS NOT NULL
-                          AND time_out<>""
-                          AND aid_station=?
-                          AND delete_flag <> 1
-                       ''', (aid_station,))
-        synopsis['stations'][aid_station]['discharged'] = cursor.fetchone()[0]
-
-        # Closed Encounters with Transport Only
-        cursor.execute('''SELECT COUNT(*) FROM encounters
-                        WHERE disposition IS NOT NULL
-                          AND disposition like 'Transport%'
-                          AND aid_station=?
-                          AND delete_flag <> 1
-                       ''', (aid_station,))
-        synopsis['stations'][aid_station]['transported'] = cursor.fetchone()[0]
-
-
-    # All encounter recoreds
-    cursor.execute('''SELECT COUNT(*) FROM encounters
-                      WHERE delete_flag <> 1
-                   ''')
-    synopsis['total']['encounters'] = cursor.fetchone()[0]
-
-    # Active Encounters (have a start time and not an end time)
-    cursor.execute('''SELECT COUNT(*) FROM encounters
-                      WHERE time_in IS NOT NULL
-                      AND ( time_out IS NULL OR time_out="")
-                      AND delete_flag <> 1
-                   ''')
-    synopsis['total']['active'] = cursor.fetchone()[0]
-
-    # Closed Encounters Only (have an end time)
-    cursor.execute('''SELECT COUNT(*) FROM encounters
-                      WHERE time_out IS NOT NULL
-                      AND time_out<>""
-                      AND delete_flag != 1
-                   ''')
-    synopsis['total']['discharged'] = cursor.fetchone()[0]
-
-    
-    # Closed Encounters with Transport Only
-    cursor.execute('''SELECT COUNT(*) FROM encounters
-                      WHERE disposition IS NOT NULL
-                      AND disposition like 'Transport%'
-                      AND delete_flag != 1
-                   ''')
-    synopsis['total']['transported'] = cursor.fetchone()[0]
+    active_encounters_by_station, synopsis = db.dashboard_summary(Config.AID_STATIONS)
 
     return render_template("dashboard.html", \
                            aid_stations=Config.AID_STATIONS, \
@@ -328,55 +270,76 @@ def admin():
             return f'All removed all runners.'
         elif 'remove-encounters' in request.form:
             remove_all_rows('encounters')
-            send_sio_msg('remove_encounter', 'File Uploaded')
+            db.rebuild_station_stats()
+            send_sio_msg('remove_encounter', encounter_delta(db.table_version('encounters'), 'reload'))
             return f'All removed all encounters.'
         elif 'export-people' in request.form:
-            return export_to_xlsx('persons')
+            return export_table('persons', request.form.get('format', 'xlsx'))
         elif 'export-encounters' in request.form:
-            return export_to_xlsx('encounters')
+            return export_table('encounters', request.form.get('format', 'xlsx'))
+        elif 'export-audit-log' in request.form:
+            return export_table('encounters_audit_log', request.form.get('format', 'xlsx'))
+        elif 'export-transactions' in request.form:
+            return export_table('encounter_transactions', request.form.get('format', 'xlsx'))
         elif 'participants-file' in request.files:
-            file = request.files['participants-file']
-            if file.filename.endswith('.xlsx'):
-                df = pd.read_excel(file)
-                df['participant'] = 1
-                save_to_database(df, 'persons')
-                return 'File uploaded and data loaded into database successfully!'
-            else:
-                return 'Only xlsx files are allowed!'
+            return import_file(request.files['participants-file'], 'persons')
         elif 'encounters-file' in request.files:
-            file = request.files['encounters-file']
-            if file.filename.endswith('.xlsx'):
-                df = pd.read_excel(file)
-                save_to_database(df, 'encounters')
-                send_sio_msg('new_encounter', 'File Uploaded')
-                return 'File uploaded and data loaded into database successfully!'
-            else:
-                return 'Only xlsx files are allowed!'
+            result = import_file(request.files['encounters-file'], 'encounters')
+            db.rebuild_station_stats()
+            send_sio_msg('new_encounter', encounter_delta(db.table_version('encounters'), 'reload'))
+            return result
+        elif 'rebuild-stats' in request.form:
+            if db.rebuild_station_stats():
+                return 'Station stats rebuilt from encounters.'
+            return 'Unable to rebuild station stats, see the server log.'
         else:
             return 'I am not a teapot.'
 
     return render_template('admin.html', is_admin=current_user.is_admin, active_page='admin')
 
-# Save DataFrame to SQLite database
-def save_to_database(df, table):
-    with db.db_connect() as conn:
-        df.to_sql(table, conn, if_exists='replace', index=False)
+# Progress of the current or last spreadsheet import, for /api/internal/metrics
+import_status = {}
+
+def import_progress(status):
+    import_status.update(status)
+    print(f"Importing into {status['table']}: {status['rows']} rows, {status['rows_per_s']:.0f} rows/s", file=sys.stderr)
+
+# Upsert an uploaded xlsx or csv file into table
+def import_file(file, table):
+    import_status.clear()
+    try:
+        status = Importer(db, table, chunk_rows=app.config.get('IMPORT_CHUNK_ROWS', 2000), progress=import_progress).run(file.stream, file.filename)
+    except ImportFileError as e:
+        return str(e)
+    import_status.update(status)
+    message = (f"File uploaded: {status['inserted']} added, {status['updated']} updated, {status['skipped']} skipped, "
+               f"{status['bad_values']} bad values left empty in {status['elapsed_s']:.1f}s ({status['rows_per_s']:.0f} rows/s).")
+    if status['ignored_columns']:
+        message += f" Ignored columns: {', '.join(status['ignored_columns'])}."
+    if status['errors']:
+        message += ' ' + ' '.join(status['errors'])
+    return message
 
 # Remove all rows from the table
 def remove_all_rows(table):
-    with db.db_connect() as conn:
+    with db.connection() as conn:
         conn.execute(f'DELETE FROM {table}')
+    db.table_replaced(table)
+
+# Stream SQLite table to an xlsx, csv or ndjson download
+def export_table(table, format='xlsx'):
+    try:
+        return export_response(db, table, format)
+    except ExportError as e:
+        return str(e), 400
 
-# Export SQLite table to xlsx file
-def export_to_xlsx(table):
-    with db.db_connect() as conn:
-        df = pd.read_sql_query(f'SELECT * FROM {table}', conn)
-    output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    df.to_excel(writer, index=False, sheet_name=table)
-    writer.close()
-    output.seek(0)
-    return send_file(output, download_name=f'{table}.xlsx', as_attachment=True)
+# Download a table, e.g. /admin/export/encounters?format=csv
+@admin_bp.route('/export/<table>', methods=['GET'])
+@login_required
+def admin_export(table):
+    if not current_user.is_admin:
+        abort(403)
+    return export_table(table, request.args.get('format', 'xlsx'))
 
 
 # *====================================================================*
@@ -385,99 +348,51 @@ def export_to_xlsx(table):
 @internal_api_bp.route('/participants/', methods=['GET'])
 @login_required
 def data_participants():
-    data = db.zip_table("persons")
-    return jsonify(data)
+    return payload_cache.response(('persons',), db.table_version('persons'),
+                                  lambda: b''.join(object_json({}, 'data', db.zip_table('persons', stream=True))))
 
 
-# Parse a transaction request
-def parse_transaction(payload):
-    known_actions = ['create', 'edit', 'remove']
-    pattern = r'\[(\d+)\]\[([a-zA-Z_]+)\]'
-    transaction_parts = {
-        'data': {},
-    }
-    
-    # Check if data is string, if so unpack to object
-    if isinstance(payload, str):
-        payload = json.loads(payload)
-
-    # Validate the post request
-    if 'action' not in payload:
-        e_msg = "Encounter post submitted without action."
-        print(e_msg, file=sys.stderr)
-        return { 'error': e_msg}
-
-    transaction_parts['action'] = payload['action'].lower()
-    if transaction_parts['action'] not in known_actions:
-        e_msg = f"Encounter post submitted with unknown action {action}."
-        print(e_msg, file=sys.stderr)
-        return { 'error': e_msg}
-
-    for key in payload.keys():
-        tokens = re.findall(r'\[(.*?)\]', key)
-        if len(tokens) == 2:
-            [transaction_parts['encounter_uuid'], field_key] = tokens
-            transaction_parts['data'][field_key] = payload[key]
-
-    return transaction_parts
-
-def transact_create(user, data, uuid=None):
-    try: 
-        uuidObj = UUID(uuid, version=4)
-    except ValueError:
-        uuid  = str(uuid4())
-    data['uuid'] = uuid
-    data_keys = data.keys()
-    query = f"INSERT INTO encounters ( {', '.join(data_keys) }) VALUES (:{', :'.join(data_keys)})"
-    db.execute_query(query, data)
-    new_data = db.zip_encounters(uuid=uuid)
-    send_sio_msg('new_encounter', new_data)
-    return {'encounter_uuid': uuid, 'data': new_data, 'user': user}
-
-def transact_edit(user, data, uuid):
-    data_cols = ', '.join([f"{key} = ?" for key in data.keys()])
-    data_vals = list(data.values())
-
-    query = f"UPDATE encounters SET {data_cols} WHERE uuid = '{uuid}'"
-    db.execute_query(query, data_vals)
-    new_data = db.zip_encounters(uuid=uuid)
-    send_sio_msg('edit_encounter', new_data)
-    return {'encounter_uuid': uuid, 'data': new_data, 'user': user}
-
-def transact_delete(user, uuid):
-    query = f"UPDATE encounters SET delete_flag=1 WHERE uuid='{uuid}'"
-    db.execute_query(query)
-    new_data = db.zip_encounters(uuid=uuid, include_deleted=True)
-    send_sio_msg('remove_encounter', new_data)
-    return {'encounter_uuid': uuid, 'data': new_data, 'user': user}
-
-
-def transaction(payload, user="API", encounter_uuid=None, created_at=None):
-    parts = parse_transaction(payload)
-
-    # If we had an error parsing, just return that message
-    if 'error' in parts:
-        return parts
-
-    # If we have an encounter UUID, lets use it
-    if encounter_uuid is not None:
-        parts['encounter_uuid'] = encounter_uuid
-
-    # Handle Creating a new record
-    if parts['action'] == 'create':
-        ret_val = transact_create(user=user, data=parts['data'], uuid=parts['encounter_uuid'])
-
-     # Handle Editing an existing record
-    elif parts['action'] == 'edit':
-        ret_val = transact_edit(user=user, data=parts['data'], uuid=parts['encounter_uuid'])
-
-    # Handle removing 
-    elif parts['action'] == 'remove':
-       ret_val = transact_delete(user=user, uuid=parts['encounter_uuid'])
-
-    jnew_data = json.dumps(ret_val['data'])
-    db.log_encounter_audit(action=parts['action'], uuid=ret_val['encounter_uuid'], user_id=user, resultant_value=jnew_data)
-    return ret_val
+# Ranked participant lookup for the station pickers.  Takes ?q=&limit= or
+# DataTables server-side parameters (draw, start, length, search[value]).
+@internal_api_bp.route('/participants/search', methods=['GET'])
+@login_required
+def data_participants_search():
+    query = request.args.get('q', request.args.get('search[value]', ''))
+    start = max(request.args.get('start', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', request.args.get('length', 20, type=int), type=int), 1), 100)
+    rows, total = participant_index.search(query, limit=limit, start=start)
+    return jsonify({
+        'draw': request.args.get('draw', 0, type=int),
+        'recordsTotal': len(participant_index.rows),
+        'recordsFiltered': total,
+        'data': rows,
+    })
+
+
+# Encounter counts per aid station and in total
+@internal_api_bp.route('/stats', methods=['GET'])
+@login_required
+def data_stats():
+    active_encounters, synopsis = db.dashboard_summary(Config.AID_STATIONS)
+    return jsonify(synopsis)
+
+
+# Database pool, write latency, broadcast and sync figures for monitoring
+@internal_api_bp.route('/metrics', methods=['GET'])
+@login_required
+def data_metrics():
+    return jsonify({
+        'db': {
+            'pool': db.pool().status(),
+            'unit_of_work': db.unit_of_work_stats(),
+        },
+        'broadcast': broadcaster.status(),
+        'sync': sync_status(),
+        'payload_cache': payload_cache.status(),
+        'participant_search': participant_index.status(),
+        'import': import_status,
+        'chat_history': chat_history.status(),
+    })
 
 
 @internal_api_bp.route('/encounters', methods=['GET', 'POST'])
@@ -489,28 +404,88 @@ def data_encounters(aid_station=None):
         aid_station = aid_station.replace("--", "/")
 
     if request.method == 'POST':
-        created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
         payload = json.dumps(request.form)
 
-        data = transaction(payload=payload, user=current_user.user_stamp())
-        encounter_uuid = data['encounter_uuid']
-        user = data['user']
-
-        transaction_id = db.log_transaction(encounter_uuid=encounter_uuid, user=user, data=payload, created_at=created_at, transaction_uuid=None, synced=0)
-        notify_sync_new_record()
+        data = apply_transaction(db, payload=payload, user=current_user.user_stamp())
+        if 'error' in data:
+            return jsonify(data), 400
         return jsonify( data['data'] )
        
-    # Handle Get Request
+    # Handle Get Request, the version is read first so any change that lands
+    # while reading is pushed to the client again.  Unchanged data is
+    # answered from the payload cache, or with a 304.
     if request.method == "GET":
-        with db.db_connect() as conn:
-            data = db.zip_encounters(aid_station=aid_station)
-        return jsonify(data)
+        version = db.table_version('encounters' if aid_station is None else f'encounters:{aid_station}')
+
+        # DataTables server-side processing: one page, sorted and searched in SQL
+        if 'draw' in request.args:
+            return jsonify(datatables_page(aid_station, version))
+
+        def build():
+            rows = db.zip_encounters(aid_station=aid_station, stream=True)
+            return b''.join(object_json({'version': version}, 'data', rows))
+
+        generation = db.table_version('encounters:*')
+        return payload_cache.response(('encounters', aid_station), f'{generation}.{version}', build)
 
     return jsonify("Oh no, you should never be here...")
 
 
 
+# Answer a DataTables server-side request (draw, start, length,
+# search[value], columns[i][data|searchable], order[i][column|dir]) for the
+# encounters at aid_station
+def datatables_page(aid_station, version):
+    args = request.args
+    columns = []
+    i = 0
+    while f'columns[{i}][data]' in args:
+        columns.append((args[f'columns[{i}][data]'], args.get(f'columns[{i}][searchable]', 'true') == 'true'))
+        i += 1
+    order = []
+    i = 0
+    while f'order[{i}][column]' in args:
+        column = args.get(f'order[{i}][column]', type=int)
+        if column is not None and 0 <= column < len(columns):
+            order.append((columns[column][0], args.get(f'order[{i}][dir]', 'asc')))
+        i += 1
+
+    rows, total, filtered = db.datatables_encounters(
+        aid_station=aid_station,
+        start=max(args.get('start', 0, type=int), 0),
+        length=args.get('length', 10, type=int),
+        search=args.get('search[value]', ''),
+        search_columns=[name for name, searchable in columns if searchable],
+        order=order)
+    return {
+        'draw': args.get('draw', 0, type=int),
+        'recordsTotal': total,
+        'recordsFiltered': filtered,
+        'data': rows,
+        'version': version,
+    }
+
+
+# Recount the station stats table, e.g. after restoring the database
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Rebuild the station_stats counters from the encounters table."""
+    if db.rebuild_station_stats():
+        print("Station stats rebuilt.")
+    else:
+        print("Unable to rebuild station stats.", file=sys.stderr)
+
+
+# Verify the hot queries use their indexes (non-zero exit on regressions)
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Run EXPLAIN QUERY PLAN over the hot queries."""
+    problems = db.check_query_plans()
+    if problems:
+        sys.exit(1)
+    print("All hot queries use their indexes.")
+
+
 app.register_blueprint(auth_bp)
 app.register_blueprint(internal_api_bp)
 app.register_blueprint(chat_bp)
@@ -526,113 +501,344 @@ app.register_blueprint(api_bp)
 def test_connect():
     emit('after connect',  {'data':'Lets dance'})
 
+# Browsers subscribe to the room for one aid station or to the room for all
+# of them (dashboard, managers)
+ALL_STATIONS_ROOM = 'aid_stations:all'
+
+def station_room(aid_station=None):
+    if aid_station is None:
+        return ALL_STATIONS_ROOM
+    return f'aid_station:{aid_station}'
+
+# Subscribe this socket to encounter changes for one aid station, or all
+# stations when aid_station is missing or null
+@socketio.on('subscribe', namespace='/api')
+def handle_subscribe(data=None):
+    if not current_user.is_authenticated:
+        return
+    aid_station = (data or {}).get('aid_station')
+    for room in rooms(namespace='/api'):
+        if room.startswith('aid_station'):
+            leave_room(room)
+    join_room(station_room(aid_station))
+
+# Send a message to a room, or the whole namespace when room is None
 def send_sio_msg(msg_type, msg, room=None):
-    broadcast = room is None
-    socketio.emit(msg_type, namespace='/api')
+    socketio.emit(msg_type, msg, namespace='/api', to=room)
+
+# Encounter changes are coalesced per room before being sent
+broadcaster = BroadcastScheduler(
+    emit=lambda room, message: send_sio_msg('encounters_changed', message, room=room),
+    start_task=socketio.start_background_task,
+    sleep=socketio.sleep,
+    window=getattr(Config, 'BROADCAST_WINDOW_MS', 150) / 1000,
+    max_delay=getattr(Config, 'BROADCAST_MAX_DELAY_MS', 1000) / 1000)
+
+# Build an encounter change message for browsers.  Clients update the row in
+# place when version follows the last one they saw and reload the table when
+# they find a gap or get a 'reload' action.
+def encounter_delta(version, action, row=None, uuid=None):
+    if uuid is None and row is not None:
+        uuid = row.get('uuid')
+    return {'version': version, 'action': action, 'uuid': uuid, 'row': row}
+
+# Tell browsers, and sync peers for local changes, about a committed transaction
+def on_encounter_transaction(result):
+    rows = result['data']['data']
+    row = rows[0] if rows else None
+
+    # Each room has its own version sequence so station pages do not see
+    # gaps for changes at other stations
+    version = db.table_changed('encounters')
+    broadcaster.add(station_room(), encounter_delta(version, result['action'], row=row, uuid=result['encounter_uuid']))
+    for aid_station in result['aid_stations']:
+        version = db.table_changed(f'encounters:{aid_station}')
+        broadcaster.add(station_room(aid_station),
+                        encounter_delta(version, result['action'], row=row, uuid=result['encounter_uuid']))
+    if result['synced'] == 0:
+        notify_sync_new_record()
+
+add_listener(on_encounter_transaction)
 
 # *====================================================================*
 #         SocketIO Chat
 # *====================================================================*
+# Message id from a client request, or None
+def message_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# Join a room and get its latest page of messages.  A browser that already
+# has messages of the room passes the newest id it has as after.
 @socketio.on('join', namespace='/chat')
 def handle_join(data):
     room = data['room']
     join_room(room)
-    previous_messages = db.get_chat_messages(room)
-    emit('previous_messages', previous_messages, room=request.sid)
+    messages, more, append = chat_history.recent(room, app.config.get('CHAT_HISTORY_PAGE', 50),
+                                                 after=message_id(data.get('after')))
+    emit('previous_messages', {'room': room, 'messages': messages, 'more': more, 'append': append}, room=request.sid)
 
-@socketio.on('send_message', namespace='/chat')
-def handle_send_message(data):
+@socketio.on('leave', namespace='/chat')
+def handle_leave(data):
+    leave_room(data['room'])
+
+# The page of messages before message id before
+@socketio.on('load_older', namespace='/chat')
+def handle_load_older(data):
     room = data['room']
-    assignment = current_user.name
-    username = current_user.get_person()
-    content = data['message']
+    before = message_id(data.get('before'))
+    if before is None:
+        return
+    messages, more = chat_history.older(room, before, app.config.get('CHAT_HISTORY_PAGE', 50))
+    emit('older_messages', {'room': room, 'messages': messages, 'more': more}, room=request.sid)
+
+# Save a chat message and send it to the room
+def post_chat_message(room, assignment, username, content):
     created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-
-    db.add_chat_message(room=room, assignment=assignment, username=username, content=content, created_at=created_at)
+    id = db.add_chat_message(room=room, assignment=assignment, username=username, content=content, created_at=created_at)
     message = {
+        "id": id,
+        "room": room,
         "assignment": assignment,
         "username": username,
         "content": content,
         "created_at": created_at
     }
+    if id is not None:
+        chat_history.add(room, message)
 
     emit('receive_message', message, room=room)
 
+@socketio.on('send_message', namespace='/chat')
+def handle_send_message(data):
+    post_chat_message(data['room'], current_user.name, current_user.get_person(), data['message'])
+
 @socketio.on('send_message_public', namespace='/chat')
 def handle_send_message_public(data):
-    room = data['room']
-    assignment = data['assignment']
-    username =  data['username']
-    content = data['message']
-    created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-
-    db.add_chat_message(room=room, assignment=assignment, username=username, content=content, created_at=created_at)
-    message = {
-        "assignment": assignment,
-        "username": username,
-        "content": content,
-        "created_at": created_at
-    }
-
-    emit('receive_message', message, room=room)
+    post_chat_message(data['room'], data['assignment'], data['username'], data['message'])
 
 # *====================================================================*
 #         SocketIO Server Sync Actions
 # *====================================================================*
 
-# Send out a single sync message to Room for sync id
-def notify_sync_new_record(room='encounters'):
-    message_type = 'sync_encounters'
-    namespace = "/sync"
-
-    previous_encounters = db.get_sync_transactions()
-
-    if len(previous_encounters) > 0:
-        if sync_mode == 'client':
-            if remote_sio.connected:
-                remote_sio.emit(message_type, previous_encounters, namespace=namespace)
-        elif sync_mode == 'server':
-            emit(message_type, previous_encounters, room=room, namespace=namespace)
-
-# Add a transaction from a remote host
-def add_sync_transaction(message):
-    msg_type = "encounter_sync_confirmation"
-    data = message['data']
-    user = message['user']
-    created_at = message['created_at']
-    e_uuid = message['encounter_uuid']
-    uuid = message['uuid']
-
-    transaction_uuid = db.log_transaction(encounter_uuid=e_uuid, user=user, data=data, created_at=created_at, transaction_uuid=uuid, synced=2)
-    if transaction_uuid is not None:
-        transaction(payload=data, user=user, encounter_uuid=e_uuid, created_at=created_at)
-    
+# Sync uses a watermark per peer: the highest local transaction id the peer
+# has acknowledged.  A sync worker sends newer transactions in batches and
+# the peer answers each batch with a single cumulative 'sync_ack'.  A client
+# has one worker for the upstream server; the server has one per client,
+# keyed by the stable peer id the client sends when it joins, so each
+# client gets every transaction past its own watermark.
+SYNC_PEER = 'upstream'
+SYNC_PEER_ID = getattr(Config, 'SYNC_PEER_ID', None) or db.get_sync_node_id()
+
+# Server side: peer id by socket id, socket id by peer id, the worker of
+# each peer id and the peer ids installing a snapshot, which are sent no
+# batches until they have it
+sync_peers = {}
+sync_sids = {}
+sync_workers = {}
+sync_bootstrapping = set()
+
+# Send a sync message to the peer
+def emit_sync(message_type, data, room='encounters'):
     if sync_mode == 'client':
         if remote_sio.connected:
-            remote_sio.emit(msg_type, {'id': transaction_uuid}, namespace="/sync")
+            remote_sio.emit(message_type, data, namespace="/sync")
     else:
-        emit(msg_type, {'id': transaction_uuid}, room="encounters", namespace="/sync")
+        socketio.emit(message_type, data, to=room, namespace="/sync")
+
+def connect_to_remote_server():
+    remote_sio.connect(Config.UPSTREAM_ENDPOINT, namespaces=["/sync"])
+    print("Successfully connected to the remote Socket.IO server.", file=sys.stderr)
+
+def make_sync_worker(peer, send, connected, **options):
+    return SyncWorker(
+        db, peer, send=send, connected=connected,
+        start_task=socketio.start_background_task,
+        sleep=socketio.sleep,
+        batch_size=getattr(Config, 'SYNC_BATCH_SIZE', 100),
+        window=getattr(Config, 'SYNC_BATCH_WINDOW_MS', 250) / 1000,
+        max_in_flight=getattr(Config, 'SYNC_MAX_IN_FLIGHT', 2),
+        retry_min=getattr(Config, 'SYNC_RETRY_MIN_S', 1),
+        retry_max=getattr(Config, 'SYNC_RETRY_MAX_S', 60),
+        max_retries=getattr(Config, 'SYNC_MAX_RETRIES', 3),
+        **options)
+
+# Name the watermark of the client with peer id peer is kept under, and
+# the origin recorded on transactions received from it
+def sync_peer_name(peer):
+    return f'downstream:{peer}' if peer else 'downstream'
+
+# The worker sending to the client with peer id peer, started on first use.
+# It relays transactions received from other clients as well as local ones.
+def peer_sync_worker(peer):
+    worker = sync_workers.get(peer)
+    if worker is None:
+        worker = sync_workers[peer] = make_sync_worker(
+            sync_peer_name(peer),
+            send=lambda batch: emit_sync('sync_batch', batch, room=sync_sids[peer]),
+            connected=lambda: peer in sync_sids and peer not in sync_bootstrapping,
+            unsynced_only=False)
+        worker.start()
+    return worker
+
+sync_worker = None
+if sync_mode == 'client':
+    sync_worker = make_sync_worker(
+        SYNC_PEER,
+        send=lambda batch: emit_sync('sync_batch', batch),
+        connected=lambda: remote_sio.connected,
+        connect=connect_to_remote_server,
+        # Clients start reconciliation with the server
+        reconcile=lambda: emit_sync('reconcile', start_reconcile(db)),
+        reconcile_every=getattr(Config, 'SYNC_RECONCILE_S', 300))
+
+# New local transactions are picked up by the sync workers
+def notify_sync_new_record():
+    if sync_worker is not None:
+        sync_worker.wake()
+    for worker in list(sync_workers.values()):
+        worker.wake()
+
+# Status of the sync workers, for monitoring
+def sync_status():
+    if sync_worker is not None:
+        return sync_worker.status()
+    return {'peers': {peer: dict(worker.status(), sid=sync_sids.get(peer))
+                      for peer, worker in list(sync_workers.items())}}
+
+# Add a transaction from a remote host, returns True if it was new
+def add_sync_transaction(message):
+    return apply_sync_transactions(db, [message])['applied'] == 1
+
+# Apply a batch from the peer in one database transaction and acknowledge
+# all of it at once, or up to the first transaction that failed.  A batch
+# that can not be read is rejected so the peer does not resend it as is.
+def apply_sync_batch(batch, room='encounters', ack=True, origin=SYNC_PEER):
+    try:
+        items = decode_batch(batch)
+    except ValueError as e:
+        print(f"Unable to read sync batch {batch.get('from')}-{batch.get('to')}: {e}", file=sys.stderr)
+        if ack:
+            emit_sync('sync_ack', reject_message(batch, e), room=room)
+        return None
+    result = apply_sync_transactions(db, items, origin=origin)
+    if ack:
+        emit_sync('sync_ack', ack_message(batch, items, result), room=room)
+    return result
+
+# Handle a reconciliation message from the peer and send the replies.
+# Transactions found missing arrive as a 'reconcile_batch', which is applied
+# but not acknowledged since it is outside the watermark.
+def handle_reconcile(message_type, data, room='encounters', origin=SYNC_PEER):
+    if message_type == 'reconcile_batch':
+        result = apply_sync_batch(data, room=room, ack=False, origin=origin)
+        if result and result['applied']:
+            print(f"Reconciliation applied {result['applied']} missing transactions.", file=sys.stderr)
+        return
+    for reply_type, reply in reconcile(db, message_type, data):
+        emit_sync(reply_type, reply, room=room)
+
+# The upstream server acknowledged a batch
+def handle_sync_ack(data):
+    sync_worker.receive_ack(data)
 
 
 # *====================================================================*
 #         SocketIO Server Sync Server
 # *====================================================================*
+# Clients without a peer id share the watermark sync used before peer ids.
+# A client that is about to ask for a snapshot says so, and gets no batches
+# until it has installed it.
 @socketio.on('join', namespace='/sync')
 def handle_sync_join(data):
     key = data['key']
     room = data['room']
     if key == Config.UPSTREAM_KEY:
         join_room(room)
-        notify_sync_new_record(room=request.sid)
-
-# Handle a request to sync multiple encounters
+        peer = str(data.get('peer') or '')
+        sync_peers[request.sid] = peer
+        sync_sids[peer] = request.sid
+        if data.get('snapshot'):
+            sync_bootstrapping.add(peer)
+        else:
+            sync_bootstrapping.discard(peer)
+        if Config.SYNC_ENABLED:
+            peer_sync_worker(peer).reset()
+
+@socketio.on('disconnect', namespace='/sync')
+def handle_sync_disconnect():
+    peer = sync_peers.pop(request.sid, None)
+    if peer is not None and sync_sids.get(peer) == request.sid:
+        del sync_sids[peer]
+
+# Handle a batch of transactions from a sync client
+@socketio.on('sync_batch', namespace='/sync')
+def handle_sync_batch(data):
+    if Config.SYNC_ENABLED:
+        apply_sync_batch(data, room=request.sid, origin=sync_peer_name(sync_peers.get(request.sid)))
+
+# Handle a sync client acknowledging a batch
+@socketio.on('sync_ack', namespace='/sync')
+def handle_sync_batch_ack(data):
+    worker = sync_workers.get(sync_peers.get(request.sid))
+    if worker is not None:
+        worker.receive_ack(data)
+
+# Handle digest reconciliation with a sync client
+@socketio.on('reconcile', namespace='/sync')
+@socketio.on('reconcile_uuids', namespace='/sync')
+@socketio.on('reconcile_fetch', namespace='/sync')
+@socketio.on('reconcile_batch', namespace='/sync')
+def handle_sync_reconcile(data):
+    if Config.SYNC_ENABLED:
+        handle_reconcile(request.event['message'], data, room=request.sid,
+                         origin=sync_peer_name(sync_peers.get(request.sid)))
+
+# Stream a snapshot of the database to a new sync client
+def send_snapshot(sid):
+    start = time.perf_counter()
+    snapshot = db.read_snapshot()
+    for message_type, data in snapshot_messages(snapshot, chunk_rows=getattr(Config, 'SYNC_SNAPSHOT_CHUNK_ROWS', 500)):
+        socketio.emit(message_type, data, to=sid, namespace='/sync')
+        socketio.sleep(0)
+    print(f"Sent snapshot at transaction {snapshot['high_water']} to {sid} in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+# Handle a new sync client asking for a snapshot
+@socketio.on('snapshot_request', namespace='/sync')
+def handle_snapshot_request(data=None):
+    if Config.SYNC_ENABLED and request.sid in sync_peers:
+        socketio.start_background_task(send_snapshot, request.sid)
+
+# A sync client installed a snapshot: it has every transaction up to the
+# snapshot's high water mark, its worker sends what was logged since
+@socketio.on('snapshot_installed', namespace='/sync')
+def handle_snapshot_installed(data):
+    if not (Config.SYNC_ENABLED and request.sid in sync_peers):
+        return
+    peer = sync_peers[request.sid]
+    worker = peer_sync_worker(peer)
+    worker.ack(data['high_water'])
+    sync_bootstrapping.discard(peer)
+    worker.reset()
+
+# A sync client did not install its snapshot; send it every transaction
+# past its watermark instead
+@socketio.on('snapshot_failed', namespace='/sync')
+def handle_snapshot_failed(data=None):
+    peer = sync_peers.get(request.sid)
+    if Config.SYNC_ENABLED and peer in sync_bootstrapping:
+        sync_bootstrapping.discard(peer)
+        peer_sync_worker(peer).reset()
+
+# Handle a request to sync multiple encounters (peers without batch sync)
 @socketio.on('sync_encounters', namespace='/sync')
 def handle_sync_encounters(data):
     if Config.SYNC_ENABLED:
         for item in data:
             add_sync_transaction(item)
+            emit_sync('encounter_sync_confirmation', {'id': item['uuid']}, room=request.sid)
 
 # Handle Encounter Sync Confirmation (set sync_status 2)
 @socketio.on('encounter_sync_confirmation', namespace='/sync')
@@ -642,46 +848,102 @@ def handle_sync_confirmation(data):
 #         SocketIO Server Sync Client
 # *====================================================================*
 
-def connect_to_remote_server():
-    """Attempt to connect to the remote server with retry on failure."""
-    while not remote_sio.connected:
-        try:
-            remote_sio.connect(Config.UPSTREAM_ENDPOINT, namespaces=["/sync"])
-            print("Successfully connected to the remote Socket.IO server.", file=sys.stderr)
-        except socketioClient.exceptions.ConnectionError as e:
-            print(f"SYNC Client connection failed: {e}. Retrying in 60 seconds...", file=sys.stderr)
-            time.sleep(60)  # Wait before retrying
-
 @remote_sio.event(namespace="/sync")
 def connect():
+    # A new node starts from a snapshot of the server's database
+    bootstrap = getattr(Config, 'SYNC_BOOTSTRAP', True) and db.is_empty()
     data = {
         'key': Config.UPSTREAM_KEY,
-        'room': 'encounters'
+        'room': 'encounters',
+        'peer': SYNC_PEER_ID,
+        'snapshot': bootstrap
     }
     remote_sio.emit('join', data, namespace="/sync")
-    notify_sync_new_record()
+    if bootstrap:
+        print("Database is empty, requesting a snapshot from the remote server.", file=sys.stderr)
+        remote_sio.emit('snapshot_request', {}, namespace="/sync")
+    sync_worker.reset()
 
+# The sync worker reconnects
 @remote_sio.event(namespace="/sync")
 def disconnect():
-    print("Disconnected from the remote Socket.IO server. Attempting to reconnect...")
-    # Start reconnection attempts in a separate thread
-    threading.Thread(target=connect_to_remote_server, daemon=True).start()
+    print("Disconnected from the remote Socket.IO server. Attempting to reconnect...", file=sys.stderr)
+
+# Handle a batch of transactions from the upstream server
+@remote_sio.on('sync_batch', namespace='/sync')
+def remote_handle_sync_batch(data):
+    if Config.SYNC_ENABLED:
+        apply_sync_batch(data)
+
+# Handle the upstream server acknowledging a batch
+@remote_sio.on('sync_ack', namespace='/sync')
+def remote_handle_sync_ack(data):
+    handle_sync_ack(data)
+
+# Handle digest reconciliation with the upstream server
+@remote_sio.on('reconcile', namespace='/sync')
+def remote_handle_reconcile(data):
+    handle_reconcile('reconcile', data)
+
+@remote_sio.on('reconcile_uuids', namespace='/sync')
+def remote_handle_reconcile_uuids(data):
+    handle_reconcile('reconcile_uuids', data)
+
+@remote_sio.on('reconcile_fetch', namespace='/sync')
+def remote_handle_reconcile_fetch(data):
+    handle_reconcile('reconcile_fetch', data)
+
+@remote_sio.on('reconcile_batch', namespace='/sync')
+def remote_handle_reconcile_batch(data):
+    handle_reconcile('reconcile_batch', data)
+
+# Collect a snapshot from the upstream server and install it once complete
+snapshot_receiver = SnapshotReceiver()
+
+def receive_snapshot(message_type, data):
+    snapshot = snapshot_receiver.add(message_type, data)
+    if snapshot is None:
+        if message_type == 'snapshot_end':
+            emit_sync('snapshot_failed', {})
+        return
+    if not db.is_empty():
+        print("Database is no longer empty, not installing snapshot.", file=sys.stderr)
+        emit_sync('snapshot_failed', {})
+        return
+    if db.install_snapshot(snapshot):
+        print(f"Installed snapshot at upstream transaction {snapshot['high_water']}.", file=sys.stderr)
+        emit_sync('snapshot_installed', {'high_water': snapshot['high_water']})
+        send_sio_msg('encounters_changed', {'reload': True, 'version': db.table_version('encounters')})
+    else:
+        emit_sync('snapshot_failed', {})
+
+@remote_sio.on('snapshot_begin', namespace='/sync')
+def remote_handle_snapshot_begin(data):
+    receive_snapshot('snapshot_begin', data)
+
+@remote_sio.on('snapshot_chunk', namespace='/sync')
+def remote_handle_snapshot_chunk(data):
+    receive_snapshot('snapshot_chunk', data)
 
-# Handle a request to sync multiple encounters
+@remote_sio.on('snapshot_end', namespace='/sync')
+def remote_handle_snapshot_end(data):
+    receive_snapshot('snapshot_end', data)
+
+# Handle a request to sync multiple encounters (peers without batch sync)
 @remote_sio.on('sync_encounters', namespace='/sync')
 def remote_handle_sync_encounters(data):
     if Config.SYNC_ENABLED:
         for encounter in data:
             add_sync_transaction(encounter)
+            emit_sync('encounter_sync_confirmation', {'id': encounter['uuid']})
 
 # Handle Encounter Sync Confirmation (set sync_status 2)
 @remote_sio.on('encounter_sync_confirmation', namespace='/sync')
 def remote_handle_sync_confirmation(data):
     db.update_sync_status(log_id=data['id'], sync_status=2)
 
-if sync_mode == 'client':
-    # Connect initially to the remote server in a separate thread
-    threading.Thread(target=connect_to_remote_server, daemon=True).start()
+if Config.SYNC_ENABLED and sync_worker is not None:
+    sync_worker.start()
 
 
 
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker JSON serialization benchmark
+
+Compares the per-row cost of serving a roster as JSON:
+
+  * dicts + jsonify  rows read into a list of dicts, encoded by Flask's
+                     default JSON provider (the path before serializer.py)
+  * dicts + dumps    the same list encoded with serializer.dumps
+  * stream           serializer.object_json straight from Db.iter_select
+
+each with the standard json module and with orjson when it is installed.
+The persons table of a throw away database is filled with --rows runners.
+
+    python benchmarks/serialize.py --rows 40000
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import serializer
+from models import Db
+
+
+def _fill(db, rows):
+    with db.connection() as conn:
+        conn.executemany('''INSERT INTO persons (bib, first_name, last_name, age, sex, participant, active_duty)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         [(str(i), f'First{i}', f'Lást{i}', 20 + i % 60, 'MF'[i % 2], 1, i % 7 == 0) for i in range(rows)])
+        conn.commit()
+
+
+# (seconds, peak traced bytes or None) of the fastest of runs
+def _measure(fn, runs, memory):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure JSON serialization of the roster')
+    parser.add_argument('--rows', type=int, default=40000)
+    parser.add_argument('--runs', type=int, default=5, help='Timing runs, the fastest is reported')
+    parser.add_argument('--memory', action='store_true', help='Also report peak memory (slow)')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    flask_json = DefaultJSONProvider(app)
+    backends = [('json', None)]
+    if serializer.orjson is not None:
+        backends.append(('orjson', serializer.orjson))
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = Db(os.path.join(directory, 'serialize.db'))
+        _fill(db, args.rows)
+
+        cases = [('dicts + jsonify', 'json', lambda: flask_json.dumps(db.zip_table('persons')).encode('utf-8'))]
+        for name, module in backends:
+            def dicts(module=module):
+                serializer.orjson = module
+                return serializer.dumps(db.zip_table('persons'))
+
+            def stream(module=module):
+                serializer.orjson = module
+                return b''.join(serializer.object_json({}, 'data', db.zip_table('persons', stream=True)))
+            cases += [('dicts + dumps', name, dicts), ('stream', name, stream)]
+
+        print(f'{args.rows} rows')
+        print(f"{'path':<18} {'encoder':<8} {'us/row':>8} {'total ms':>9}" + (f" {'peak MB':>8}" if args.memory else ''))
+        baseline = None
+        for path, encoder, fn in cases:
+            seconds, peak = _measure(fn, args.runs, args.memory)
+            baseline = baseline or seconds
+            line = f'{path:<18} {encoder:<8} {seconds / args.rows * 1e6:8.2f} {seconds * 1000:9.1f}'
+            if args.memory:
+                line += f' {peak / 1e6:8.1f}'
+            print(f'{line}  x{baseline / seconds:.1f}')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker startup benchmark
+
+Reports how long the app takes to start:
+
+  * an import time breakdown of app.py (python -X importtime), listing the
+    modules app imports directly by cumulative time
+  * the time from starting app.py to the first request it serves
+
+and fails if startup loads a module that should only be loaded on first
+use (pandas, numpy, openpyxl, xlsxwriter) or exceeds the given budgets.
+Run it from the app directory, with the config.py the app is run with:
+
+    python benchmarks/startup.py --max-import-ms 1500 --max-first-request-ms 5000
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+
+# Only loaded when a spreadsheet is imported or exported
+LAZY_MODULES = ('pandas', 'numpy', 'openpyxl', 'xlsxwriter')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Environment for a throw away app instance: its own database and port
+def _environment(database, port):
+    env = dict(os.environ)
+    env['DATABASE_URL'] = database
+    env['MED_TRACKER_HOST'] = '127.0.0.1'
+    env['MED_TRACKER_PORT'] = str(port)
+    env['SYNC_ENABLED'] = 'false'
+    return env
+
+
+# Returns (total ms, [(cumulative ms, self ms, module)] imported by app
+# directly, set of every module imported)
+def import_times(app_dir, env, runs):
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=app_dir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            sys.exit(f'Importing app failed:\n{result.stderr[-2000:]}')
+        # Modules are listed after the modules they import, so the direct
+        # imports of app are the depth 1 lines before it
+        total, direct, modules = None, [], set()
+        for line in reversed(result.stderr.splitlines()):
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip())) // 2
+            module = name.strip()
+            modules.add(module)
+            if depth == 0:
+                if total is not None:
+                    break
+                if module == 'app':
+                    total = int(cumulative) / 1000
+            elif depth == 1 and total is not None:
+                direct.append((int(cumulative) / 1000, int(own) / 1000, module))
+        if total is None:
+            sys.exit('No import time reported for app')
+        if best is None or total < best[0]:
+            best = (total, sorted(direct, reverse=True), modules)
+    return best
+
+
+# Milliseconds from starting app.py until it answers a request
+def first_request(app_dir, env, port, timeout):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'app.py'], cwd=app_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                sys.exit(f'app.py exited with {process.returncode} before serving a request')
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/auth/login', timeout=1) as response:
+                    response.read()
+                return (time.perf_counter() - start) * 1000
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                time.sleep(0.02)
+        sys.exit(f'app.py served no request within {timeout}s')
+    finally:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure Med-Tracker startup time')
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--runs', type=int, default=3, help='Import timing runs, the fastest is reported')
+    parser.add_argument('--top', type=int, default=15, help='Modules to list')
+    parser.add_argument('--max-import-ms', type=float, help='Fail if importing app takes longer')
+    parser.add_argument('--max-first-request-ms', type=float, help='Fail if the first request takes longer')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for the first request')
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        port = _free_port()
+        env = _environment(os.path.join(directory, 'startup.db'), port)
+
+        # The first run creates and migrates the database, time a restart
+        subprocess.run([sys.executable, '-c', 'import app'], cwd=args.app_dir, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        total, direct, modules = import_times(args.app_dir, env, args.runs)
+        print(f'import app: {total:8.1f} ms')
+        print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+        for cumulative, own, module in direct[:args.top]:
+            print(f'{cumulative:14.1f} {own:9.1f}  {module}')
+
+        loaded = [module for module in LAZY_MODULES if module in modules]
+        if loaded:
+            failures.append(f"loaded at startup: {', '.join(loaded)}")
+        if args.max_import_ms is not None and total > args.max_import_ms:
+            failures.append(f'import took {total:.0f} ms, budget {args.max_import_ms:.0f} ms')
+
+        elapsed = first_request(args.app_dir, env, port, args.timeout)
+        print(f'first request: {elapsed:8.1f} ms')
+        if args.max_first_request_ms is not None and elapsed > args.max_first_request_ms:
+            failures.append(f'first request took {elapsed:.0f} ms, budget {args.max_first_request_ms:.0f} ms')
+
+    for failure in failures:
+        print(f'FAIL {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker broadcast scheduler
+
+Coalesces encounter change messages per Socket.IO room.  The first change
+for a room opens a window; every further change within the window extends
+it, up to max_delay after the first one.  When the window closes the room
+gets one 'encounters_changed' message listing the changed UUIDs, with the
+latest row for each of them.  A spreadsheet upload or a sync backlog replay
+therefore costs each browser one message instead of hundreds.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import sys
+import threading
+import time
+
+
+class _Batch:
+    def __init__(self, now):
+        self.first = now
+        self.last = now
+        self.from_version = None
+        self.events = 0
+        self.changes = {}
+
+
+class BroadcastScheduler:
+    """Batches changes per room and emits them after a short quiet window.
+
+    emit(room, message) sends a batch.  start_task(fn, *args) and
+    sleep(seconds) should come from the Socket.IO server so this works in
+    both threading and eventlet/gevent async modes.  With window set to 0
+    every change is emitted straight away.
+    """
+
+    def __init__(self, emit, start_task, sleep, window=0.15, max_delay=1.0, max_rows=50):
+        self.emit = emit
+        self.start_task = start_task
+        self.sleep = sleep
+        self.window = window
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.stats = {'events': 0, 'merged': 0, 'batches': 0, 'largest_batch': 0}
+
+    # Queue a change for a room.  change is a dict with at least version and
+    # uuid; a later change to the same uuid replaces an earlier one.
+    def add(self, room, change):
+        now = time.monotonic()
+        with self._lock:
+            self.stats['events'] += 1
+            batch = self._pending.get(room)
+            start = batch is None
+            if start:
+                batch = self._pending[room] = _Batch(now)
+                batch.from_version = change['version']
+            batch.last = now
+            batch.events += 1
+            if change['uuid'] in batch.changes:
+                self.stats['merged'] += 1
+            batch.changes[change['uuid']] = change
+
+        if self.window <= 0:
+            self._flush(room)
+        elif start:
+            self.start_task(self._wait, room)
+
+    def _wait(self, room):
+        while True:
+            with self._lock:
+                batch = self._pending.get(room)
+                if batch is None:
+                    return
+                due = min(batch.first + self.max_delay, batch.last + self.window)
+                remaining = due - time.monotonic()
+            if remaining <= 0:
+                break
+            self.sleep(remaining)
+        self._flush(room)
+
+    def _flush(self, room):
+        with self._lock:
+            batch = self._pending.pop(room, None)
+            if batch is None:
+                return
+            self.stats['batches'] += 1
+            self.stats['largest_batch'] = max(self.stats['largest_batch'], batch.events)
+
+        changes = sorted(batch.changes.values(), key=lambda change: change['version'])
+        message = {
+            'from_version': batch.from_version,
+            'version': changes[-1]['version'],
+            'uuids': [change['uuid'] for change in changes],
+            'merged': batch.events - len(changes),
+        }
+        # Large batches only list the UUIDs, clients reload instead
+        if len(changes) > self.max_rows:
+            message['reload'] = True
+        else:
+            message['changes'] = changes
+        try:
+            self.emit(room, message)
+        except Exception as e:
+            print(f"Error broadcasting to {room}: {e}", file=sys.stderr)
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats, pending_rooms=len(self._pending),
+                        window_ms=self.window * 1000, max_delay_ms=self.max_delay * 1000)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker chat history
+
+Chat history is sent a page at a time: the newest messages when a browser
+joins a room, and older pages when it asks for them.  The most recent
+messages of each room are kept in a ring buffer, loaded from SQLite the
+first time the room is joined and appended to as messages are posted, so
+joins and reconnects are answered from memory.  A reconnecting browser
+passes the id of the newest message it has and only gets what it missed.
+Room names come from browsers, so only the max_rooms most recently used
+rooms are buffered.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import threading
+from collections import OrderedDict, deque
+
+
+class ChatHistory:
+    """Recent chat messages of each room, oldest first, backed by db."""
+
+    def __init__(self, db, size=200, max_rooms=16):
+        self.db = db
+        self.size = size
+        self.max_rooms = max_rooms
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._rooms = OrderedDict()
+        # Rooms whose buffer holds every message the room has
+        self._complete = set()
+        self.stats = {'joins': 0, 'older': 0, 'db_reads': 0}
+
+    # The buffer of room, read from the database the first time.  Call with
+    # the lock held so no message posted meanwhile is missed.
+    def _buffer(self, room):
+        buffer = self._rooms.get(room)
+        if buffer is not None:
+            self._rooms.move_to_end(room)
+            return buffer
+        rows = self.db.get_chat_page(room, limit=self.size) or []
+        self.stats['db_reads'] += 1
+        buffer = self._rooms[room] = deque(rows, maxlen=self.size)
+        if len(rows) < self.size:
+            self._complete.add(room)
+        while len(self._rooms) > self.max_rooms:
+            evicted, _ = self._rooms.popitem(last=False)
+            self._complete.discard(evicted)
+        return buffer
+
+    # Record a message posted to room; message must have its id.  A message
+    # already read from the database with the room's buffer is not added
+    # again.
+    def add(self, room, message):
+        with self._lock:
+            buffer = self._rooms.get(room)
+            if buffer is None or (buffer and message['id'] <= buffer[-1]['id']):
+                return
+            if len(buffer) == buffer.maxlen:
+                self._complete.discard(room)
+            buffer.append(message)
+
+    # Returns (messages, more, append): the last limit messages of room, or
+    # with after only those newer than message id after if none of them
+    # were dropped from the buffer (append is then True).  more is True if
+    # the browser does not have all older messages yet.
+    def recent(self, room, limit, after=None):
+        with self._lock:
+            messages = list(self._buffer(room))
+            complete = room in self._complete
+            self.stats['joins'] += 1
+
+        if after is not None and (complete or (messages and messages[0]['id'] <= after)):
+            newer = [message for message in messages if message['id'] > after]
+            if len(newer) <= limit:
+                return newer, False, True
+        page = messages[-limit:]
+        return page, len(messages) > limit or not complete, False
+
+    # Returns (messages, more): up to limit messages of room older than
+    # message id before, oldest first
+    def older(self, room, before, limit):
+        with self._lock:
+            messages = [message for message in self._buffer(room) if message['id'] < before]
+            complete = room in self._complete
+            self.stats['older'] += 1
+
+        if len(messages) >= limit or complete:
+            return messages[-limit:], len(messages) > limit or not complete
+        rows = self.db.get_chat_page(room, before_id=before, limit=limit + 1) or []
+        self.stats['db_reads'] += 1
+        return rows[-limit:], len(rows) > limit
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats, rooms=len(self._rooms),
+                        messages=sum(len(buffer) for buffer in self._rooms.values()))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker table export
+
+Streams a table out as xlsx, CSV or NDJSON without holding it in memory.
+Rows are read CHUNK_ROWS at a time in rowid order, leasing a pooled
+connection only while a chunk is read, so a slow download does not tie up
+the pool.  CSV and NDJSON are sent as they are generated.  xlsx is written
+with xlsxwriter in constant_memory mode to a temporary file, which is then
+sent in blocks and removed; a zip archive can only be sent once it is
+complete.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import csv
+import io
+import os
+import tempfile
+
+from flask import Response
+
+from serializer import dumps
+
+
+CHUNK_ROWS = 1000
+BLOCK_BYTES = 64 * 1024
+
+EXPORT_TABLES = ('persons', 'encounters', 'encounters_audit_log', 'encounter_transactions')
+
+# format: (mimetype, file extension)
+FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+
+class ExportError(ValueError):
+    """Unknown table or format."""
+
+
+# The column names of table, then lists of rows in rowid order
+def table_chunks(db, table, chunk_rows=CHUNK_ROWS):
+    columns = list(db.table_columns(table))
+    yield columns
+
+    query = f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+    last = -1
+    while True:
+        with db.connection() as conn:
+            rows = conn.execute(query, (last, chunk_rows)).fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [row[1:] for row in rows]
+        if len(rows) < chunk_rows:
+            return
+
+
+def _csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(next(chunks))
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _ndjson(chunks):
+    columns = next(chunks)
+    for rows in chunks:
+        yield b''.join(dumps(dict(zip(columns, row))) + b'\n' for row in rows)
+
+
+# xlsxwriter is only loaded for the first xlsx export
+def _xlsx(chunks, sheet_name):
+    import xlsxwriter
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_numbers': False,
+                                              'strings_to_formulas': False, 'strings_to_urls': False})
+        worksheet = workbook.add_worksheet(sheet_name[:31])
+        bold = workbook.add_format({'bold': True})
+        worksheet.write_row(0, 0, next(chunks), bold)
+        number = 1
+        for rows in chunks:
+            for row in rows:
+                worksheet.write_row(number, 0, row)
+                number += 1
+        workbook.close()
+
+        with open(path, 'rb') as file:
+            while True:
+                block = file.read(BLOCK_BYTES)
+                if not block:
+                    break
+                yield block
+    finally:
+        os.remove(path)
+
+
+# Streaming download of table in format (xlsx, csv or ndjson)
+def export_response(db, table, format='xlsx', chunk_rows=CHUNK_ROWS):
+    if table not in EXPORT_TABLES:
+        raise ExportError(f'Can not export {table}')
+    if format not in FORMATS:
+        raise ExportError(f"Unknown export format {format}, use one of {', '.join(FORMATS)}")
+
+    chunks = table_chunks(db, table, chunk_rows)
+    if format == 'csv':
+        body = _csv(chunks)
+    elif format == 'ndjson':
+        body = _ndjson(chunks)
+    else:
+        body = _xlsx(chunks, table)
+
+    mimetype, extension = FORMATS[format]
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={table}.{extension}',
+                             'X-Accel-Buffering': 'no'})
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker conditional GET and compressed payload cache
+
+The internal data endpoints are reloaded by every station's DataTables over
+slow field networks.  Each payload is tagged with the version of the table
+it was read from (Db.table_version), which the write path bumps on every
+change.  A request whose If-None-Match matches the current version gets a
+304 without touching SQLite; otherwise the last rendered payload for that
+version is served from memory, gzipped when the client accepts it, and
+only rebuilt after the table changes.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import gzip
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+
+from serializer import dumps
+
+
+# Appended to the entity tag of gzip encoded bodies: strong validators must
+# differ between content codings of the same payload
+GZIP_SUFFIX = '-gz'
+
+
+class _Payload:
+    def __init__(self, version, etag, body):
+        self.version = version
+        self.etag = etag
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=6)
+
+
+class PayloadCache:
+    """Rendered JSON payloads by key, e.g. (table, aid_station).
+
+    Keeps the newest version of up to max_entries keys, least recently
+    used first out.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+    # Strong entity tag (unquoted) for a key at a version
+    @staticmethod
+    def etag(key, version):
+        name = '-'.join(str(part) for part in key if part is not None).replace('"', '')
+        return f'{name}-{version}'
+
+    # Respond to a GET for key at version.  build() returns the data to
+    # serialize, or the JSON body as bytes, and is only called when there is
+    # no payload for version.
+    def response(self, key, version, build):
+        etag = self.etag(key, version)
+        gzipped = self._gzip()
+        # Either coding validates, the 304 carries the tag of the coding the
+        # browser gets now
+        if request.if_none_match.contains(etag) or request.if_none_match.contains(etag + GZIP_SUFFIX):
+            with self._lock:
+                self.stats['not_modified'] += 1
+            return self._not_modified(etag + GZIP_SUFFIX if gzipped else etag)
+
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None and payload.version == version:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+            else:
+                payload = None
+                self.stats['misses'] += 1
+
+        if payload is None:
+            body = build()
+            if not isinstance(body, bytes):
+                body = dumps(body)
+            payload = _Payload(version, etag, body)
+            with self._lock:
+                self._entries[key] = payload
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return self._ok(payload, gzipped)
+
+    # Browsers must revalidate, which costs a 304 while nothing changed
+    def _finish(self, response, etag):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    def _not_modified(self, etag):
+        return self._finish(Response(status=304), etag)
+
+    @staticmethod
+    def _gzip():
+        return 'gzip' in request.accept_encodings
+
+    def _ok(self, payload, gzipped):
+        if gzipped:
+            response = Response(payload.gzipped, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+            return self._finish(response, payload.etag + GZIP_SUFFIX)
+        response = Response(payload.body, mimetype='application/json')
+        return self._finish(response, payload.etag)
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries),
+                        bytes=sum(len(payload.body) for payload in self._entries.values()),
+                        gzipped_bytes=sum(len(payload.gzipped) for payload in self._entries.values()))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker spreadsheet import
+
+Loads an uploaded participant or encounter spreadsheet (xlsx or CSV) into
+the existing table.  The file is read in chunks of rows (openpyxl in read
+only mode for xlsx), so only one chunk is held in memory at a time.  Header
+names are mapped onto the table's columns, values are checked against the
+column types and each chunk is upserted on the table's key (bib for
+persons, uuid for encounters) with executemany in its own unit of work.
+The table, its indexes and the columns the app added are left in place.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import csv
+import io
+import re
+import sqlite3
+import sys
+import time
+from datetime import date, datetime
+from datetime import time as time_of_day
+from uuid import uuid4
+
+
+CHUNK_ROWS = 2000
+MAX_ERRORS = 20
+
+# table: (key column, column filled in when missing, values set on every row)
+TABLES = {
+    'persons': ('bib', None, {'participant': 1}),
+    'encounters': ('uuid', 'uuid', {}),
+}
+
+# Other names spreadsheets use for a column, after normalizing
+ALIASES = {
+    'bib_number': 'bib', 'bib_no': 'bib', 'bib_num': 'bib', 'number': 'bib',
+    'first': 'first_name', 'firstname': 'first_name', 'given_name': 'first_name',
+    'last': 'last_name', 'lastname': 'last_name', 'surname': 'last_name', 'family_name': 'last_name',
+    'gender': 'sex',
+    'station': 'aid_station', 'aid': 'aid_station',
+}
+
+
+# Yes/no columns, which also take true/yes/y/x and false/no/n
+FLAGS = {'participant', 'active_duty', 'oral_fluid', 'food', 'delete_flag', 'critical_flag'}
+
+
+class ImportFileError(ValueError):
+    """The file can not be imported, e.g. an unknown format or no key column."""
+
+
+def _normalize(name):
+    return re.sub(r'[^a-z0-9#]+', '_', str(name or '').strip().lower()).strip('_').replace('#', 'no')
+
+
+# Rows of an xlsx workbook's first sheet, header first, as tuples.  openpyxl
+# is only loaded when a workbook is uploaded.
+def _xlsx_rows(stream):
+    import openpyxl
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _csv_rows(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        for row in csv.reader(text):
+            yield tuple(row)
+    finally:
+        text.detach()
+
+
+def _cell(value):
+    if isinstance(value, str):
+        value = value.strip()
+        return value if value else None
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, time_of_day):
+        return value.strftime('%H:%M')
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+# value as an integer, raises ValueError if it is not a number (or for a
+# flag column, not a yes/no word)
+def _integer(value, flag=False):
+    if value is None or isinstance(value, int):
+        return value
+    if flag and isinstance(value, str) and value.lower() in ('true', 'yes', 'y', 'x'):
+        return 1
+    if flag and isinstance(value, str) and value.lower() in ('false', 'no', 'n'):
+        return 0
+    return int(float(value))
+
+
+class Importer:
+    """Streams one spreadsheet into table of db.
+
+    progress, if given, is called with status() after every chunk.
+    """
+
+    def __init__(self, db, table, chunk_rows=CHUNK_ROWS, progress=None):
+        if table not in TABLES:
+            raise ImportFileError(f'Can not import into {table}')
+        self.db = db
+        self.table = table
+        self.chunk_rows = chunk_rows
+        self.progress = progress
+        self.key, self.generated, self.fixed = TABLES[table]
+        self.stats = {'table': table, 'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'bad_values': 0,
+                      'chunks': 0, 'elapsed_s': 0.0, 'rows_per_s': 0.0,
+                      'columns': [], 'ignored_columns': [], 'errors': []}
+        self._start = None
+
+    # Rows of the uploaded file by its extension
+    def rows(self, stream, filename):
+        extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if extension == 'xlsx':
+            return _xlsx_rows(stream)
+        if extension == 'csv':
+            return _csv_rows(stream)
+        raise ImportFileError('Only xlsx and csv files are allowed!')
+
+    # Import the file, returns status()
+    def run(self, stream, filename):
+        self._start = time.perf_counter()
+        rows = self.rows(stream, filename)
+        header = next(rows, None)
+        if header is None:
+            raise ImportFileError('The file is empty')
+
+        with self.db.connection() as conn:
+            schema = {row[1]: (row[2].upper(), row[4]) for row in conn.execute('SELECT * FROM pragma_table_info(?)', (self.table,))}
+        positions = self._map_columns(header, schema)
+        columns = list(positions) + [name for name in self.fixed if name in schema and name not in positions]
+        if self.generated and self.generated not in columns:
+            columns.append(self.generated)
+        self.stats['columns'] = columns
+        statements = self._statements(columns, schema)
+        integers = {name for name in columns if 'INT' in schema[name][0]}
+
+        chunk = []
+        for number, row in enumerate(rows, 2):
+            values = self._values(number, row, positions, columns, integers)
+            if values is not None:
+                chunk.append(values)
+            if len(chunk) >= self.chunk_rows:
+                self._write(number, chunk, columns, statements)
+                chunk = []
+        if chunk:
+            self._write(number, chunk, columns, statements)
+
+        self.db.table_replaced(self.table)
+        self._update_rate()
+        print(f"Imported {filename} into {self.table}: {self.stats['inserted']} inserted, {self.stats['updated']} updated, "
+              f"{self.stats['skipped']} skipped, {self.stats['bad_values']} bad values in {self.stats['elapsed_s']:.1f}s "
+              f"({self.stats['rows_per_s']:.0f} rows/s)", file=sys.stderr)
+        return self.status()
+
+    # {column: position in row} for the header cells that name a column of
+    # the table; the key column (unless generated) is required
+    def _map_columns(self, header, schema):
+        positions = {}
+        for position, name in enumerate(header):
+            column = _normalize(name)
+            column = ALIASES.get(column, column)
+            if column in schema and column != 'id' and column not in positions:
+                positions[column] = position
+            elif name is not None:
+                self.stats['ignored_columns'].append(str(name))
+        if self.key not in positions and self.key != self.generated:
+            raise ImportFileError(f'No {self.key} column found in the file')
+        return positions
+
+    # (select existing keys, insert, update by key) statements.  NULLs are
+    # replaced by the column default so e.g. delete_flag never ends up NULL.
+    def _statements(self, columns, schema):
+        def value(name):
+            default = schema[name][1]
+            return f'COALESCE(?, {default})' if default is not None else '?'
+        others = [name for name in columns if name != self.key]
+        return (
+            f'SELECT {self.key} FROM {self.table} WHERE {self.key} IN ',
+            f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join(value(name) for name in columns)})",
+            f"UPDATE {self.table} SET {', '.join(f'{name} = {value(name)}' for name in others)} WHERE {self.key} = ?"
+            if others else None,
+        )
+
+    # The values of one row in columns order, or None if it is skipped.
+    # Integer cells that are not numbers are left empty and counted.
+    def _values(self, number, row, positions, columns, integers):
+        cells = {name: _cell(row[position]) if position < len(row) else None for name, position in positions.items()}
+        if not any(value is not None for value in cells.values()):
+            return None
+        cells.update(self.fixed)
+        if self.generated and cells.get(self.generated) is None:
+            cells[self.generated] = str(uuid4())
+        if cells.get(self.key) is None:
+            return self._skip(number, f'no {self.key}')
+        cells[self.key] = str(cells[self.key])
+        for name in integers:
+            try:
+                cells[name] = _integer(cells.get(name), flag=name in FLAGS)
+            except (TypeError, ValueError):
+                self._error(number, f"{name} is not {'yes or no' if name in FLAGS else 'a number'}: {cells[name]}")
+                self.stats['bad_values'] += 1
+                cells[name] = None
+        return [cells.get(name) for name in columns]
+
+    def _skip(self, number, reason, rows=1):
+        self.stats['skipped'] += rows
+        self._error(number, reason)
+        return None
+
+    def _error(self, number, reason):
+        if len(self.stats['errors']) < MAX_ERRORS:
+            self.stats['errors'].append(f'Row {number}: {reason}')
+
+    # Upsert one chunk, ending at row number, in one unit of work
+    def _write(self, number, chunk, columns, statements):
+        select, insert, update = statements
+        key = columns.index(self.key)
+        inserts, updates = [], []
+        with self.db.unit_of_work() as uow:
+            with self.db.connection() as conn:
+                try:
+                    existing = set()
+                    keys = list({values[key] for values in chunk})
+                    for start in range(0, len(keys), 500):
+                        part = keys[start:start + 500]
+                        existing.update(row[0] for row in conn.execute(f"{select}({', '.join('?' * len(part))})", part))
+                    for values in chunk:
+                        if values[key] in existing:
+                            updates.append(values[:key] + values[key + 1:] + [values[key]])
+                        else:
+                            existing.add(values[key])
+                            inserts.append(values)
+                    conn.executemany(insert, inserts)
+                    if update is not None:
+                        conn.executemany(update, updates)
+                except sqlite3.Error as e:
+                    self.db._db_error(f"Database error importing into {self.table}: {e}")
+        if uow.committed:
+            self.stats['inserted'] += len(inserts)
+            self.stats['updated'] += len(updates)
+        else:
+            self._skip(number, f"{len(chunk)} rows up to here not saved: {'; '.join(uow.errors)}", rows=len(chunk))
+        self.stats['rows'] += len(chunk)
+        self.stats['chunks'] += 1
+        self._update_rate()
+        if self.progress is not None:
+            self.progress(self.status())
+
+    def _update_rate(self):
+        elapsed = time.perf_counter() - self._start
+        self.stats['elapsed_s'] = round(elapsed, 3)
+        self.stats['rows_per_s'] = round(self.stats['rows'] / elapsed, 1) if elapsed else 0.0
+
+    def status(self):
+        return dict(self.stats, errors=list(self.stats['errors']))
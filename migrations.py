@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker schema migrations
+
+Versioned changes to the database schema.  The schema version is kept in
+SQLite's user_version header field; migrate() applies every migration newer
+than it, each one in its own transaction.
+
+HOT_QUERIES lists the queries the app runs most often together with the
+index each one is expected to use.  check_query_plans() runs EXPLAIN QUERY
+PLAN over them so a schema or query change that falls back to a full table
+scan is caught.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import sys
+from uuid import uuid4
+
+
+# Returns True if table has a column named column
+def _has_column(cursor, table, column):
+    cursor.execute('SELECT COUNT(*) FROM pragma_table_info(?) WHERE name=?', (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+# Add a column to table unless it is already there
+def _add_column(cursor, table, column, definition):
+    if not _has_column(cursor, table, column):
+        print(f"Updating {table} table... adding {column}", file=sys.stderr)
+        cursor.execute(f'ALTER TABLE {table} ADD {column} {definition}')
+
+
+# Columns added to encounters after the first release
+def _encounter_columns(cursor):
+    # SQLite can not add a UNIQUE NOT NULL column, so add it plain, fill it
+    # in and enforce uniqueness with an index
+    if not _has_column(cursor, 'encounters', 'uuid'):
+        _add_column(cursor, 'encounters', 'uuid', 'TEXT')
+        cursor.execute('SELECT rowid FROM encounters WHERE uuid IS NULL')
+        rowids = [row[0] for row in cursor.fetchall()]
+        cursor.executemany('UPDATE encounters SET uuid = ? WHERE rowid = ?',
+                           [(str(uuid4()), rowid) for rowid in rowids])
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_encounters_uuid ON encounters(uuid)')
+
+    if not _has_column(cursor, 'encounters', 'delete_flag'):
+        _add_column(cursor, 'encounters', 'delete_flag', 'INTEGER DEFAULT 0')
+        _add_column(cursor, 'encounters', 'delete_reason', "TEXT DEFAULT ''")
+    _add_column(cursor, 'encounters', 'critical_flag', 'INTEGER DEFAULT 0')
+    _add_column(cursor, 'encounters', 'num_encounters', 'INTEGER DEFAULT 0')
+
+
+# Encounter counters per aid station, kept up to date by the write path
+def _station_stats(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS station_stats (
+                      aid_station TEXT PRIMARY KEY,
+                      encounters INTEGER NOT NULL DEFAULT 0,
+                      active INTEGER NOT NULL DEFAULT 0,
+                      discharged INTEGER NOT NULL DEFAULT 0,
+                      transported INTEGER NOT NULL DEFAULT 0
+                   )''')
+
+
+# Indexes for the hot queries below
+def _hot_query_indexes(cursor):
+    # Encounter list for one aid station
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_encounters_station
+                      ON encounters(aid_station) WHERE delete_flag != 1''')
+
+    # Active encounters on the dashboard; covers the query (time_out and
+    # delete_flag are listed so SQLite need not read the row to check them)
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_encounters_active
+                      ON encounters(time_in, aid_station, bib, first_name, last_name, time_out, delete_flag)
+                      WHERE (time_out IS NULL OR time_out = '') AND delete_flag != 1''')
+
+    # Transactions still to be sent to the sync peer
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_transactions_unsynced
+                      ON encounter_transactions(created_at) WHERE synced = 0''')
+
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_chat_messages_room
+                      ON chat_messages(room, created_at)''')
+
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_audit_log_uuid
+                      ON encounters_audit_log(uuid)''')
+
+
+# Per peer sync watermark: the highest local encounter_transactions.id the
+# peer has acknowledged
+def _sync_state(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+                      peer TEXT PRIMARY KEY,
+                      acked_id INTEGER NOT NULL DEFAULT 0,
+                      updated_at TEXT
+                   )''')
+
+
+# Transaction log in created_at order, for reconciliation digests
+def _transaction_digest_index(cursor):
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_transactions_created
+                      ON encounter_transactions(created_at, uuid)''')
+
+
+# Last change time of each encounter, for API filters, backfilled from the
+# transaction log.  The log has no encounter_uuid index, so the latest
+# change of every encounter is found in one pass first.
+def _encounter_updated_at(cursor):
+    _add_column(cursor, 'encounters', 'updated_at', 'TEXT')
+    cursor.execute('CREATE TEMP TABLE latest_change (encounter_uuid TEXT PRIMARY KEY, created_at TEXT)')
+    cursor.execute('''INSERT INTO latest_change
+                      SELECT encounter_uuid, MAX(created_at) FROM encounter_transactions
+                      WHERE encounter_uuid IS NOT NULL
+                      GROUP BY encounter_uuid''')
+    cursor.execute('''UPDATE encounters SET updated_at = (SELECT created_at FROM latest_change
+                                                          WHERE encounter_uuid = encounters.uuid)
+                      WHERE updated_at IS NULL''')
+    cursor.execute('DROP TABLE latest_change')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_encounters_bib ON encounters(bib)')
+
+
+# Participant lookups by bib, and the key spreadsheet imports upsert on
+def _person_bib_index(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_persons_bib ON persons(bib)')
+
+
+# Chat history pages, newest first by id
+def _chat_page_index(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_room_id ON chat_messages(room, id)')
+
+
+# Stable id this node presents to the sync server, which keeps a watermark
+# per client id
+def _sync_node(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS sync_node (id TEXT NOT NULL)')
+    cursor.execute('INSERT INTO sync_node (id) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM sync_node)', (str(uuid4()),))
+
+
+# The sync peer a received transaction came from, so it is not relayed
+# back to that peer
+def _transaction_origin(cursor):
+    _add_column(cursor, 'encounter_transactions', 'origin', 'TEXT')
+
+
+# (version, description, function(cursor)) in the order they are applied.
+# Never edit or renumber a released migration; add a new one instead.
+MIGRATIONS = [
+    (1, 'add uuid, delete, critical and num_encounters columns to encounters', _encounter_columns),
+    (2, 'add station_stats table', _station_stats),
+    (3, 'add indexes for hot queries', _hot_query_indexes),
+    (4, 'add sync_state watermark table', _sync_state),
+    (5, 'add transaction digest index', _transaction_digest_index),
+    (6, 'add encounters updated_at column and bib index', _encounter_updated_at),
+    (7, 'add persons bib index', _person_bib_index),
+    (8, 'add chat message page index', _chat_page_index),
+    (9, 'add sync node id', _sync_node),
+    (10, 'add transaction origin column', _transaction_origin),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+# Returns the schema version of the database on conn
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Apply all pending migrations, returns the resulting schema version
+def migrate(conn):
+    version = schema_version(conn)
+    if conn.in_transaction:
+        conn.commit()
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        print(f"Migrating database to version {number}: {description}", file=sys.stderr)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            step(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    return version
+
+
+# name: (query, parameters, index the query should use)
+HOT_QUERIES = {
+    'encounters_by_station': (
+        "SELECT * FROM encounters WHERE aid_station='Aid 1' AND delete_flag!=1",
+        (), 'idx_encounters_station'),
+    'encounter_by_uuid': (
+        "SELECT * FROM encounters WHERE uuid='00000000-0000-4000-8000-000000000000' AND delete_flag!=1",
+        (), None),
+    'active_encounters': (
+        '''SELECT aid_station, bib, first_name, last_name, time_in
+           FROM encounters
+           WHERE (time_out IS NULL OR time_out = '')
+           AND delete_flag != 1
+           ORDER BY time_in''',
+        (), 'COVERING INDEX idx_encounters_active'),
+    'encounters_by_bib': (
+        'SELECT * FROM encounters WHERE bib = ? ORDER BY id LIMIT ?',
+        ('1234', 100), 'idx_encounters_bib'),
+    'person_by_bib': (
+        'SELECT bib FROM persons WHERE bib IN (?, ?)',
+        ('1234', '1235'), 'idx_persons_bib'),
+    'datatables_page': (
+        'SELECT * FROM encounters WHERE delete_flag != 1 ORDER BY bib ASC, id LIMIT ? OFFSET ?',
+        (10, 0), 'idx_encounters_bib'),
+    'unsynced_transactions': (
+        'SELECT * FROM encounter_transactions WHERE synced = 0 ORDER BY created_at',
+        (), 'idx_transactions_unsynced'),
+    'sync_batch': (
+        'SELECT * FROM encounter_transactions WHERE id > ? AND synced = 0 ORDER BY id LIMIT ?',
+        (0, 100), 'PRIMARY KEY'),
+    'relay_batch': (
+        'SELECT * FROM encounter_transactions WHERE id > ? ORDER BY id LIMIT ?',
+        (0, 100), 'PRIMARY KEY'),
+    'transaction_keys': (
+        'SELECT created_at, uuid FROM encounter_transactions WHERE created_at >= ? AND created_at < ? ORDER BY created_at, uuid',
+        ('2024-10-27 08', '2024-10-27 08~'), 'COVERING INDEX idx_transactions_created'),
+    'transaction_by_uuid': (
+        'SELECT uuid FROM encounter_transactions WHERE uuid = ?',
+        ('00000000-0000-4000-8000-000000000000',), None),
+    'chat_history': (
+        'SELECT * FROM chat_messages WHERE room = ? ORDER BY created_at',
+        ('general',), 'idx_chat_messages_room'),
+    'chat_page': (
+        'SELECT * FROM chat_messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?',
+        ('general', 1000, 50), 'idx_chat_messages_room_id'),
+    'audit_log_by_uuid': (
+        'SELECT * FROM encounters_audit_log WHERE uuid = ?',
+        ('00000000-0000-4000-8000-000000000000',), 'idx_audit_log_uuid'),
+}
+
+
+# Run EXPLAIN QUERY PLAN over the hot queries.  Returns a list of
+# (name, problem, plan) for every query that scans a whole table, sorts
+# with a temporary b-tree or does not use its expected index.
+def check_query_plans(conn, queries=None):
+    problems = []
+    for name, (query, values, index) in (queries or HOT_QUERIES).items():
+        plan = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', values).fetchall()]
+        for detail in plan:
+            if detail.startswith('SCAN') and 'USING' not in detail:
+                problems.append((name, 'full table scan', plan))
+            elif 'TEMP B-TREE' in detail:
+                problems.append((name, 'temporary b-tree sort', plan))
+        if index is not None and not any(index in detail for detail in plan):
+            problems.append((name, f'does not use {index}', plan))
+    return problems
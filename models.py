@@ -18,22 +18,249 @@ __status__ = "Development"
 
 import json
 import os
+import re
 import sqlite3
 import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 from uuid import uuid4
 
+from migrations import check_query_plans, migrate
+
+# Per-connection settings applied to every pooled connection.  Any of these
+# can be overridden with the DATABASE_PRAGMAS config setting.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'mmap_size': 67108864,
+}
+
+
+# Prepared statements kept per connection; every query is parameterized so
+# repeated reads reuse their compiled statement
+STATEMENT_CACHE_SIZE = 256
+
+# Rows fetched at a time by Db.iter_select
+FETCH_ROWS = 500
+
+
+# Counters kept per aid station in the station_stats table
+STATION_COUNTERS = ('encounters', 'active', 'discharged', 'transported')
+
+
+# Returns an id for the current greenlet (eventlet/gevent) or thread
+def current_ident(async_mode=None):
+    if async_mode in ('eventlet', 'gevent'):
+        try:
+            import greenlet
+            return id(greenlet.getcurrent())
+        except ImportError:
+            pass
+    return threading.get_ident()
+
+
+class ConnectionPool:
+    """A bounded pool of long lived SQLite connections.
+
+    Connections are leased to the current thread, or greenlet when running
+    under eventlet/gevent.  Nested leases from the same thread/greenlet share
+    a single connection so several Db calls can run in one transaction.
+    """
+
+    def __init__(self, db_path, pool_size=8, max_overflow=4, timeout=30,
+                 recycle=3600, pre_ping=True, pragmas=None, async_mode=None):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.async_mode = async_mode
+
+        self._idle = deque()
+        self._leases = {}
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.stats = {'created': 0, 'reused': 0, 'recycled': 0, 'waits': 0}
+
+    # Opens and configures a new connection
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for name, value in self.pragmas.items():
+            if not re.fullmatch(r'[a-z_]+', name):
+                raise ValueError(f"Invalid pragma name {name}")
+            conn.execute(f"PRAGMA {name}={value}").fetchall()
+        return conn
+
+    # Returns False if a connection is too old or no longer answers
+    def _healthy(self, conn, born):
+        if self.recycle and time.monotonic() - born > self.recycle:
+            return False
+        if self.pre_ping:
+            try:
+                conn.execute('SELECT 1').fetchone()
+            except sqlite3.Error:
+                return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    # Take an idle connection, open a new one or wait for one to be returned
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError("Connection pool is closed")
+                if self._idle:
+                    conn, born = self._idle.pop()
+                    break
+                if self._open < self.pool_size + self.max_overflow:
+                    self._open += 1
+                    conn, born = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError("Timed out waiting for a database connection")
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+
+        if conn is not None:
+            if self._healthy(conn, born):
+                self.stats['reused'] += 1
+                return conn, born
+            self._discard(conn)
+            self.stats['recycled'] += 1
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        self.stats['created'] += 1
+        return conn, time.monotonic()
+
+    # Lease a connection to the current thread/greenlet
+    def acquire(self):
+        ident = current_ident(self.async_mode)
+        lease = self._leases.get(ident)
+        if lease is not None:
+            lease[2] += 1
+            return lease[0]
+        conn, born = self._checkout()
+        self._leases[ident] = [conn, born, 1]
+        return conn
+
+    # Current lease depth for this thread/greenlet (0 if none)
+    def depth(self):
+        lease = self._leases.get(current_ident(self.async_mode))
+        return 0 if lease is None else lease[2]
+
+    # Return the current lease; the connection goes back to the pool once
+    # the outermost lease is released
+    def release(self):
+        ident = current_ident(self.async_mode)
+        lease = self._leases[ident]
+        lease[2] -= 1
+        if lease[2] > 0:
+            return
+        del self._leases[ident]
+        conn, born = lease[0], lease[1]
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            if self._closed or len(self._idle) >= self.pool_size:
+                self._discard(conn)
+                self._open -= 1
+            else:
+                self._idle.append((conn, born))
+            self._cond.notify()
+
+    # Close all idle connections and refuse new leases
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+                self._open -= 1
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            return dict(self.stats, open=self._open, idle=len(self._idle),
+                        leased=len(self._leases), pool_size=self.pool_size,
+                        max_overflow=self.max_overflow)
+
+
+# Tables copied to a new sync client, see Db.read_snapshot
+SNAPSHOT_TABLES = ('encounters', 'persons', 'encounter_transactions')
+
+
+class UnitOfWork:
+    """Tracks a group of Db calls committed as a single SQLite transaction."""
+
+    def __init__(self):
+        self.errors = []
+        self.committed = False
+        self.elapsed_ms = None
+        self.depth = 1
+        self._after_commit = []
+
+    # Call fn once the outermost unit of work has committed
+    def after_commit(self, fn):
+        self._after_commit.append(fn)
+
+
 class Db:
     _db_path = ""
+    _pool = None
+    # Table versions are shared by every Db on the same database file, and
+    # start from the clock so they keep increasing across restarts
+    _version_seed = int(time.time() * 1000)
+    _versions = {}
+    _versions_lock = threading.Lock()
+    # Column names per (database file, table), cleared when the schema changes
+    _columns = {}
 
-    def __init__(self, db_path = None):
+    def __init__(self, db_path = None, pool_size=8, max_overflow=4, pragmas=None, async_mode=None):
+        self._pool_options = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pragmas': pragmas,
+            'async_mode': async_mode,
+        }
+        self._pool_lock = threading.Lock()
+        self._units = {}
+        self._uow_stats = {'count': 0, 'committed': 0, 'rolled_back': 0,
+                           'last_ms': 0.0, 'max_ms': 0.0, 'total_ms': 0.0}
+        self._cache_lock = threading.Lock()
+        self._dashboard_cache = None
         if db_path is not None:
             self._db_path = db_path
             self.make_db_path()
             self.create_database()
+            self.check_query_plans()
+            self.rebuild_station_stats()
 
     def add_db(self, db_path=None):
-        self._db_path = db_path
+        if db_path != self._db_path:
+            self.close()
+            self._db_path = db_path
 
 
     # *====================================================================*
@@ -44,19 +271,109 @@ class Db:
         if db_path:
             os.makedirs(db_path, exist_ok=True)
 
-    # Function to connect to SQLLite Database
+    # Function to connect to SQLLite Database (unpooled)
     def db_connect(self):
         try:
-            conn = sqlite3.connect(self._db_path)
-            return conn
+            return self.pool().connect()
         except sqlite3.Error as e:
             print(f"Database error: {e}", file=sys.stderr)
             return None
 
+    # Returns the connection pool, creating it on first use
+    def pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(self._db_path, **self._pool_options)
+        return self._pool
+
+    # Lease a pooled connection.  Like sqlite3's own context manager this
+    # commits on success and rolls back on error, but only when leaving the
+    # outermost lease so nested calls share one transaction.
+    @contextmanager
+    def connection(self):
+        pool = self.pool()
+        conn = pool.acquire()
+        outermost = pool.depth() == 1
+        try:
+            yield conn
+            if outermost and conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if outermost and conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            pool.release()
+
+    # Group Db calls made inside the block into one transaction (and one
+    # fsync).  Any database error raised or reported by a Db method rolls the
+    # whole unit back; check uow.committed afterwards.  Nested units join the
+    # outer one.
+    @contextmanager
+    def unit_of_work(self):
+        ident = current_ident(self.pool().async_mode)
+        uow = self._units.get(ident)
+        if uow is not None:
+            uow.depth += 1
+            try:
+                yield uow
+            finally:
+                uow.depth -= 1
+            return
+
+        uow = UnitOfWork()
+        self._units[ident] = uow
+        start = time.perf_counter()
+        try:
+            with self.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                yield uow
+                if uow.errors:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                    uow.committed = True
+        finally:
+            del self._units[ident]
+            uow.elapsed_ms = (time.perf_counter() - start) * 1000
+            stats = self._uow_stats
+            stats['count'] += 1
+            stats['committed' if uow.committed else 'rolled_back'] += 1
+            stats['last_ms'] = uow.elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], uow.elapsed_ms)
+            stats['total_ms'] += uow.elapsed_ms
+        if uow.committed:
+            for fn in uow._after_commit:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"Error after commit in {getattr(fn, '__name__', fn)}: {e}", file=sys.stderr)
+
+    # Latency of units of work, for monitoring
+    def unit_of_work_stats(self):
+        stats = dict(self._uow_stats)
+        stats['avg_ms'] = stats['total_ms'] / stats['count'] if stats['count'] else 0.0
+        return stats
+
+    # Report a database error, failing the current unit of work if any
+    def _db_error(self, message):
+        print(message, file=sys.stderr)
+        uow = self._units.get(current_ident(self.pool().async_mode))
+        if uow is not None:
+            uow.errors.append(message)
+
+    # Close all pooled connections
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
 
     # Function to create an SQLite database and table to store data
     def create_database(self):
-        with self.db_connect() as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
 
             # Encounters Table - Holds a list of all encounters
@@ -96,29 +413,7 @@ class Db:
                               num_encounters INTEGER DEFAULT 1
                            )''')
 
-            cursor.execute('''SELECT COUNT(*) AS CNTREC FROM pragma_table_info('encounters') WHERE name='uuid' ''')
-            if cursor.fetchall()[0][0] == 0:
-                print("Updating encounters table... adding UUID", file=sys.stderr)
-                cursor.execute('''ALTER TABLE encounters ADD uuid TEXT UNIQUE NOT NULL ''')
-
-            cursor.execute('''SELECT COUNT(*) AS CNTREC FROM pragma_table_info('encounters') WHERE name='delete_flag' ''')
-            if cursor.fetchall()[0][0] == 0:
-                print("Updating encounters table... adding delete flag", file=sys.stderr)
-                cursor.execute('''ALTER TABLE encounters ADD delete_flag INTEGER DEFAULT 0 ''')
-                cursor.execute('''ALTER TABLE encounters ADD delete_reason TEXT DEFAULT '' ''')
-
-            cursor.execute('''SELECT COUNT(*) AS CNTREC FROM pragma_table_info('encounters') WHERE name='critical_flag' ''')
-            if cursor.fetchall()[0][0] == 0:
-                print("Updating encounters table... adding critical_flag", file=sys.stderr)
-                cursor.execute('''ALTER TABLE encounters ADD critical_flag INTEGER DEFAULT 0 ''')
-
-            cursor.execute('''SELECT COUNT(*) AS CNTREC FROM pragma_table_info('encounters') WHERE name='num_encounters' ''')
-            if cursor.fetchall()[0][0] == 0:
-                print("Updating encounters table... adding num_encounters", file=sys.stderr)
-                cursor.execute('''ALTER TABLE encounters ADD num_encounters INTEGER DEFAULT 0 ''')
-
-
-                # Encounters Table - Holds a list of all encounters
+            # Encounters Audit Log Table - Holds every change to an encounter
             cursor.execute('''CREATE TABLE IF NOT EXISTS encounters_audit_log (
                               id INTEGER PRIMARY KEY AUTOINCREMENT,
                               uuid TEXT NOT NULL,
@@ -195,12 +490,40 @@ class Db:
                               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                            )''')
 
-            print("Database created!", file=sys.stderr)
             conn.commit()
 
+            # Bring older databases up to date and add indexes
+            migrate(conn)
+            self.schema_changed()
+            print("Database created!", file=sys.stderr)
+
+    # Column names of table, read once and cached until schema_changed()
+    def table_columns(self, table_name):
+        key = (self._db_path, table_name)
+        columns = Db._columns.get(key)
+        if columns is None:
+            with self.connection() as conn:
+                columns = tuple(row[0] for row in conn.execute('SELECT name FROM pragma_table_info(?)', (table_name,)))
+            if columns:
+                Db._columns[key] = columns
+        return columns
+
+    # Call after a migration or anything else that changes tables' columns
+    def schema_changed(self):
+        for key in [key for key in Db._columns if key[0] == self._db_path]:
+            Db._columns.pop(key, None)
+
+    # Check that the hot queries still use their indexes, see migrations.py
+    def check_query_plans(self):
+        with self.connection() as conn:
+            problems = check_query_plans(conn)
+        for name, problem, plan in problems:
+            print(f"Query plan warning for {name}: {problem} ({'; '.join(plan)})", file=sys.stderr)
+        return problems
+
     # Function to log server sync
 
-    def log_transaction(self, encounter_uuid, user, data, created_at, transaction_uuid=None, synced=0):
+    def log_transaction(self, encounter_uuid, user, data, created_at, transaction_uuid=None, synced=0, origin=None):
         table_name = "encounter_transactions"
 
         if transaction_uuid is None:
@@ -209,124 +532,143 @@ class Db:
         if not isinstance(data, str):
             data = json.dumps(data)
         
-        query = f"INSERT INTO {table_name} (uuid, encounter_uuid, user, data, synced, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+        query = f"INSERT INTO {table_name} (uuid, encounter_uuid, user, data, synced, created_at, origin) VALUES (?, ?, ?, ?, ?, ?, ?)"
 
         try:
-            with self.db_connect() as conn:
+            with self.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute(query, (transaction_uuid, encounter_uuid, user, data, synced, created_at))
-                conn.commit()
+                cursor.execute(query, (transaction_uuid, encounter_uuid, user, data, synced, created_at, origin))
                 return transaction_uuid
         except sqlite3.Error as e:
-            print(f"Database error recording transaction {query}: {e}", file=sys.stderr)
+            self._db_error(f"Database error recording transaction {query}: {e}")
             return None
 
     # Check if we have this update
     def check_if_synced(self, uuid):
         table_name = 'encounter_transactions'
-        query = f"SELECT uuid FROM {table_name} WHERE uuid ='{uuid}'"
+        query = f"SELECT uuid FROM {table_name} WHERE uuid = ?"
         try:
-            with self.db_connect() as conn:
+            with self.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute(query)
+                cursor.execute(query, (uuid,))
                 data = cursor.fetchall()
                 if len(data) > 0:
                     return True
                 else:
                     return False
         except sqlite3.Error as e:
-            print(f"Database error checking if synced {query}: {e}", file=sys.stderr)
+            self._db_error(f"Database error checking if synced {query}: {e}")
             return False
 
+    # The subset of uuids already in the transaction log, looked up in bulk
+    def get_synced_uuids(self, uuids):
+        uuids = list(uuids)
+        found = set()
+        try:
+            with self.connection() as conn:
+                # Stay under SQLite's limit on bound parameters
+                for start in range(0, len(uuids), 500):
+                    chunk = uuids[start:start + 500]
+                    query = f"SELECT uuid FROM encounter_transactions WHERE uuid IN ({', '.join('?' * len(chunk))})"
+                    found.update(row[0] for row in conn.execute(query, chunk))
+        except sqlite3.Error as e:
+            self._db_error(f"Database error checking synced transactions: {e}")
+        return found
+
+    # The uuids, out of uuids, of encounters in the database (removed ones included)
+    def get_encounter_uuids(self, uuids):
+        uuids = list(uuids)
+        found = set()
+        try:
+            with self.connection() as conn:
+                for start in range(0, len(uuids), 500):
+                    chunk = uuids[start:start + 500]
+                    query = f"SELECT uuid FROM encounters WHERE uuid IN ({', '.join('?' * len(chunk))})"
+                    found.update(row[0] for row in conn.execute(query, chunk))
+        except sqlite3.Error as e:
+            self._db_error(f"Database error checking encounters: {e}")
+        return found
+
     # Function to update sync status
     def update_sync_status(self, log_id, sync_status):
         table_name = 'encounter_transactions'
-        query = f"UPDATE {table_name} SET synced = {sync_status} WHERE uuid = '{log_id}'"
+        query = f"UPDATE {table_name} SET synced = ? WHERE uuid = ?"
         try:
-            with self.db_connect() as conn:
+            with self.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute(query)
-                conn.commit()
+                cursor.execute(query, (sync_status, log_id))
         except sqlite3.Error as e:
-            print(f'Database error updating sync status "{query}": {e}', file=sys.stderr)
+            self._db_error(f'Database error updating sync status "{query}": {e}')
             return None
 
-    # Function to return all chat messages in a chatroom
-    def get_sync_transactions(self, unsynced_only=True):
-        table_name = 'encounter_transactions'
-
+    # Function to return the transactions still to be synced (or all of
+    # them), as dicts, with tuples=True as {'columns': [...], 'rows': [...]}
+    # or with stream=True as an iter_select generator
+    def get_sync_transactions(self, unsynced_only=True, tuples=False, stream=False):
         if unsynced_only:
-            query = f"SELECT * FROM {table_name} WHERE synced = 0 ORDER BY created_at"
+            query = "SELECT * FROM encounter_transactions WHERE synced = 0 ORDER BY created_at"
         else:
-            query = f"SELECT * FROM {table_name} ORDER BY created_at"
+            query = "SELECT * FROM encounter_transactions ORDER BY created_at"
 
+        if stream:
+            return self.iter_select(query)
         try:
-            
-            with self.db_connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute(query)
-                rows = cursor.fetchall()
-                # Get the column names
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = [column[1] for column in cursor.fetchall()]
-                data_list = []
-            for row in rows:
-                data_dict = dict(zip(columns, row))
-                data_list.append(data_dict)
-            return data_list
+            return self.select(query, tuples=tuples)
         except sqlite3.Error as e:
-            print(f"Database error getting transaction to sync {query}: {e}", file=sys.stderr)
+            self._db_error(f"Database error getting transaction to sync {query}: {e}")
             return None
 
-    # Function to return all chat messages in a chatroom
-    def get_chat_messages(self, room):
-        table_name = 'chat_messages'
+    # Function to return all chat messages in a chatroom, as dicts or with
+    # tuples=True as {'columns': [...], 'rows': [...]}
+    def get_chat_messages(self, room, tuples=False):
         try:
-            query = f"SELECT * FROM {table_name} WHERE room = ? ORDER BY created_at"
-            with self.db_connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute(query, (room,))
-                rows = cursor.fetchall()
-                # Get the column names
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = [column[1] for column in cursor.fetchall()]
-                data_list = []
-            for row in rows:
-                data_dict = dict(zip(columns, row))
-                data_list.append(data_dict)
-            return data_list
+            return self.select("SELECT * FROM chat_messages WHERE room = ? ORDER BY created_at", (room,), tuples=tuples)
         except sqlite3.Error as e:
-            print(f"Database error reading messages for {room}: {e}", file=sys.stderr)
+            self._db_error(f"Database error reading messages for {room}: {e}")
             return None
 
-    # Adds a chat message to the db
+    # Up to limit messages of room older than message id before_id (the
+    # newest ones when before_id is None), oldest first
+    def get_chat_page(self, room, before_id=None, limit=50):
+        if before_id is None:
+            query, values = "SELECT * FROM chat_messages WHERE room = ? ORDER BY id DESC LIMIT ?", (room, limit)
+        else:
+            query, values = "SELECT * FROM chat_messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?", (room, before_id, limit)
+        try:
+            rows = self.select(query, values)
+        except sqlite3.Error as e:
+            self._db_error(f"Database error reading messages for {room}: {e}")
+            return None
+        rows.reverse()
+        return rows
+
+    # Adds a chat message to the db, returns its id
     def add_chat_message(self, room, assignment, username, content, created_at):
-        query = f"INSERT INTO chat_messages (room, assignment, username, content, created_at) VALUES ('{room}', '{assignment}', '{username}', '{content}', '{created_at}')"
+        query = "INSERT INTO chat_messages (room, assignment, username, content, created_at) VALUES (?, ?, ?, ?, ?)"
         try:
-            with self.db_connect() as conn:
+            with self.connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute(query)
-                conn.commit()
+                cursor.execute(query, (room, assignment, username, content, created_at))
+                return cursor.lastrowid
 
         except sqlite3.Error as e:
-            print(f"Database error executing query {query}: {e}", file=sys.stderr)
+            self._db_error(f"Database error executing query {query}: {e}")
             return None
 
     # Function to execute query and return the last row ID after executing seaid query
     def execute_query(self, query, values=None):
         try:
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            with self.db_connect() as conn:
+            with self.connection() as conn:
                 cursor = conn.cursor()
                 if values is None:
                     cursor.execute(query)
                 else:
                     cursor.execute(query, values)
                 id = cursor.lastrowid
-                conn.commit()
                 return id
         except sqlite3.Error as e:
-            print(f"Database error executing query {query}: {e}", file=sys.stderr)
+            self._db_error(f"Database error executing query {query}: {e}")
             return None
 
 
@@ -334,70 +676,463 @@ class Db:
     def log_encounter_audit(self, action, uuid, user_id, resultant_value):
         try:
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            with self.db_connect() as conn:
+            with self.connection() as conn:
                 cursor = conn.cursor()
                 query = f"INSERT INTO encounters_audit_log (action, uuid, user_id, timestamp, resultant_value) VALUES (?, ?, ?, ?, ?)"
                 values = (action, uuid, user_id, timestamp, resultant_value)
                 cursor.execute(query, values)
-                conn.commit()
         except sqlite3.Error as e:
-            print(f"Database error writing audit log -{query}: {e}", file=sys.stderr)
+            self._db_error(f"Database error writing audit log -{query}: {e}")
 
     # Function to export data as a zipped dict
-    def zip_encounters(self, id=None, uuid=None, aid_station=None, include_deleted=False, only_deleted=False):
+    def zip_encounters(self, id=None, uuid=None, aid_station=None, include_deleted=False, only_deleted=False,
+                       tuples=False, stream=False):
         where_clauses = []
+        values = []
         if id is not None:
-            where_clauses.append(f'ID={id}')
+            where_clauses.append('id = ?')
+            values.append(id)
         if uuid is not None:
-            where_clauses.append(f"uuid='{uuid}'")
+            where_clauses.append('uuid = ?')
+            values.append(uuid)
         if aid_station is not None:
-            where_clauses.append(f"aid_station='{aid_station}'")
+            where_clauses.append('aid_station = ?')
+            values.append(aid_station)
         if include_deleted is False:
-            where_clauses.append('delete_flag!=1')
+            where_clauses.append('delete_flag != 1')
         if only_deleted:
-            where_clauses.append('delete_flag=1')
+            where_clauses.append('delete_flag = 1')
 
         where_clause = ' AND '.join(where_clauses)
 
-        data = self.zip_table(table_name='encounters', where_clause=where_clause)
+        data = self.zip_table(table_name='encounters', where_clause=where_clause, values=values, tuples=tuples,
+                              stream=stream)
         return data
 
+    # One page of encounters for a DataTables server-side request.
+    #
+    # search words must each appear (case insensitive) in one of
+    # search_columns; order is a list of (column, 'asc' or 'desc').  Column
+    # names not in the encounters table are ignored.  Returns
+    # (rows, total encounters, encounters matching search).
+    def datatables_encounters(self, aid_station=None, start=0, length=10, search='',
+                              search_columns=(), order=()):
+        with self.connection() as conn:
+            table_columns = set(self.table_columns('encounters'))
+            where, values = ['delete_flag != 1'], []
+            if aid_station is not None:
+                where.append('aid_station = ?')
+                values.append(aid_station)
+            base = ' AND '.join(where)
+            total = conn.execute(f'SELECT COUNT(*) FROM encounters WHERE {base}', values).fetchone()[0]
+
+            search_columns = [column for column in search_columns if column in table_columns]
+            for word in search.split():
+                if search_columns:
+                    where.append('(' + ' OR '.join(f"{column} LIKE ? ESCAPE '\\'" for column in search_columns) + ')')
+                    pattern = '%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                    values.extend([pattern] * len(search_columns))
+            filtered_where = ' AND '.join(where)
+            filtered = total if filtered_where == base else \
+                conn.execute(f'SELECT COUNT(*) FROM encounters WHERE {filtered_where}', values).fetchone()[0]
+
+            order_by = [f"{column} {'DESC' if direction == 'desc' else 'ASC'}"
+                        for column, direction in order if column in table_columns]
+            # id last so pages are stable when sort values repeat
+            order_by.append('id')
+            query = f"SELECT * FROM encounters WHERE {filtered_where} ORDER BY {', '.join(order_by)}"
+            if length is not None and length >= 0:
+                query += ' LIMIT ? OFFSET ?'
+                values += [length, start]
+            cursor = conn.execute(query, values)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return rows, total, filtered
+
 
     # Function to export data as a zipped dict
     def zip_vitals(self, encounter_id=None, id=None):
         where_clause = None
         if encounter_id is not None and id is not None:
-            where_clause = f'ENCOUNTER_ID={encounter_id} AND ID={id}'
+            where_clause, values = 'encounter_id = ? AND id = ?', (encounter_id, id)
         elif encounter_id is None and id is None:
             return {'data': []}
         else:
             if encounter_id is not None:
-                where_clause = f'ENCOUNTER_ID={encounter_id}'
+                where_clause, values = 'encounter_id = ?', (encounter_id,)
             if id is not None:
-                where_clause = f'id={id}'
+                where_clause, values = 'id = ?', (id,)
 
-        data = self.zip_table(table_name='vitals', where_clause=where_clause)
+        data = self.zip_table(table_name='vitals', where_clause=where_clause, values=values)
         return data
 
 
+    # Run a parameterized SELECT.  Column names come from the cursor, so no
+    # second query is needed.  Returns a list of dicts, or with tuples=True
+    # {'columns': [...], 'rows': [tuple, ...]} without a dict per row.
+    def select(self, query, values=(), tuples=False):
+        with self.connection() as conn:
+            cursor = conn.execute(query, values)
+            rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
+        if tuples:
+            return {'columns': columns, 'rows': rows}
+        return [dict(zip(columns, row)) for row in rows]
+
+    # Run a parameterized SELECT and yield the column names, then lists of up
+    # to chunk_rows row tuples.  The pooled connection is held until the
+    # generator is exhausted or closed.
+    def iter_select(self, query, values=(), chunk_rows=FETCH_ROWS):
+        with self.connection() as conn:
+            cursor = conn.execute(query, values)
+            yield [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    return
+                yield rows
+
     # Function to export participant data as a zipped dict
-    def zip_table(self, table_name, where_clause=None):
-        if where_clause is None:
-            where_clause = ""
+    #
+    # where_clause may use ? placeholders bound to values.  Returns
+    # {'data': [dict, ...]}, with tuples=True {'columns': [...], 'data':
+    # [tuple, ...]}, or with stream=True the iter_select generator.
+    def zip_table(self, table_name, where_clause=None, values=(), tuples=False, stream=False):
+        query = f'SELECT * FROM {table_name}'
+        if where_clause:
+            query += f' WHERE {where_clause}'
+        if stream:
+            return self.iter_select(query, values)
+        result = self.select(query, values, tuples=tuples)
+        if tuples:
+            return {'columns': result['columns'], 'data': result['rows']}
+        return {'data': result}
+
+
+    # *====================================================================*
+    #         DASHBOARD
+    # *====================================================================*
+
+    # Current version of a table; it increases on every table_changed()
+    def table_version(self, table_name):
+        return Db._versions.get((self._db_path, table_name), Db._version_seed)
+
+    # Call after any write to a table so cached views of it are rebuilt.
+    # Returns the table's new version.
+    def table_changed(self, table_name):
+        with Db._versions_lock:
+            version = self.table_version(table_name) + 1
+            Db._versions[(self._db_path, table_name)] = version
+        if table_name == 'encounters':
+            with self._cache_lock:
+                self._dashboard_cache = None
+        return version
 
-        if len(where_clause) > 0:
-            where_clause = f' WHERE {where_clause}'
-        with self.db_connect() as conn:
+    # Call after rewriting a whole table (bulk upload, remove all, snapshot)
+    # so per-key views of it, e.g. 'encounters:<station>', are rebuilt too.
+    # Their generation is table_version(f'{table_name}:*').
+    def table_replaced(self, table_name):
+        self.table_changed(f'{table_name}:*')
+        return self.table_changed(table_name)
+
+    # Returns (active encounters by station, synopsis) for the dashboard.
+    #
+    # Counts come from the station_stats counters and the totals are summed
+    # from them.  The result is cached until the next
+    # table_changed('encounters').
+    def dashboard_summary(self, aid_stations):
+        aid_stations = tuple(aid_stations)
+        with self._cache_lock:
+            cached = self._dashboard_cache
+            version = self.table_version('encounters')
+        if cached is not None and cached[0] == aid_stations:
+            return cached[1]
+
+        synopsis = {'total': dict.fromkeys(STATION_COUNTERS, 0), 'stations': {}}
+        for aid_station in aid_stations:
+            synopsis['stations'][aid_station] = dict.fromkeys(STATION_COUNTERS, 0)
+        active_encounters_by_station = {aid_station: [] for aid_station in aid_stations}
+
+        with self.connection() as conn:
             cursor = conn.cursor()
-            select_statement = f'SELECT * FROM {table_name}{where_clause if where_clause else ""}'
-            cursor.execute(select_statement)
-            rows = cursor.fetchall()
-            # Get the column names
-            cursor.execute(f"PRAGMA table_info({table_name})")
-            columns = [column[1] for column in cursor.fetchall()]
-            # Convert the data to a list of dictionaries
-        data_list = []
-        for row in rows:
-            data_dict = dict(zip(columns, row))
-            data_list.append(data_dict)
-        return {'data': data_list}
\ No newline at end of file
+            cursor.execute(f'SELECT aid_station, {", ".join(STATION_COUNTERS)} FROM station_stats')
+            for row in cursor.fetchall():
+                counts = dict(zip(STATION_COUNTERS, row[1:]))
+                for key, value in counts.items():
+                    synopsis['total'][key] += value
+                if row[0] in synopsis['stations']:
+                    synopsis['stations'][row[0]] = counts
+
+            # Active Encounters (have a start time and not an end time)
+            cursor.execute('''SELECT aid_station, bib, first_name, last_name, time_in
+                              FROM encounters
+                              WHERE (time_out IS NULL OR time_out = '')
+                              AND delete_flag != 1
+                              ORDER BY time_in
+                           ''')
+            for row in cursor.fetchall():
+                if row[0] in active_encounters_by_station:
+                    active_encounters_by_station[row[0]].append(
+                        dict(zip(('aid_station', 'bib', 'first_name', 'last_name', 'time_in'), row)))
+
+        summary = (active_encounters_by_station, synopsis)
+        with self._cache_lock:
+            if version == self.table_version('encounters'):
+                self._dashboard_cache = (aid_stations, summary)
+        return summary
+
+
+    # *====================================================================*
+    #         STATION STATS
+    # *====================================================================*
+
+    # Returns the station_stats counters for a (live) encounter row
+    @staticmethod
+    def station_counts(row):
+        time_out = row.get('time_out')
+        disposition = row.get('disposition') or ''
+        return (
+            1,
+            int(row.get('time_in') is not None and (time_out is None or time_out == '')),
+            int(time_out is not None and time_out != ''),
+            int(disposition.lower().startswith('transport')),
+        )
+
+    # Move the station counters from the before rows to the after rows of a
+    # change.  Only pass rows that are not deleted; deleted rows are not
+    # counted.
+    def update_station_stats(self, before_rows, after_rows):
+        deltas = {}
+        for sign, rows in ((-1, before_rows), (1, after_rows)):
+            for row in rows:
+                delta = deltas.setdefault(row.get('aid_station') or '', [0] * len(STATION_COUNTERS))
+                for idx, count in enumerate(self.station_counts(row)):
+                    delta[idx] += sign * count
+
+        values = [(aid_station, *delta) for aid_station, delta in deltas.items() if any(delta)]
+        if not values:
+            return
+        updates = ', '.join([f'{key} = {key} + excluded.{key}' for key in STATION_COUNTERS])
+        query = f'''INSERT INTO station_stats (aid_station, {", ".join(STATION_COUNTERS)})
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(aid_station) DO UPDATE SET {updates}'''
+        try:
+            with self.connection() as conn:
+                conn.executemany(query, values)
+        except sqlite3.Error as e:
+            self._db_error(f"Database error updating station stats: {e}")
+
+    # Recount station_stats from the encounters table, e.g. after a bulk load
+    def rebuild_station_stats(self):
+        try:
+            with self.unit_of_work() as uow:
+                with self.connection() as conn:
+                    conn.execute('DELETE FROM station_stats')
+                    conn.execute('''INSERT INTO station_stats (aid_station, encounters, active, discharged, transported)
+                                    SELECT COALESCE(aid_station, ''),
+                                           COUNT(*),
+                                           SUM(CASE WHEN time_in IS NOT NULL
+                                                     AND (time_out IS NULL OR time_out = '') THEN 1 ELSE 0 END),
+                                           SUM(CASE WHEN time_out IS NOT NULL
+                                                     AND time_out <> '' THEN 1 ELSE 0 END),
+                                           SUM(CASE WHEN disposition LIKE 'Transport%' THEN 1 ELSE 0 END)
+                                    FROM encounters
+                                    WHERE delete_flag != 1
+                                    GROUP BY COALESCE(aid_station, '')
+                                 ''')
+        except sqlite3.Error as e:
+            self._db_error(f"Database error rebuilding station stats: {e}")
+            return False
+        self.table_changed('encounters')
+        return uow.committed
+
+
+    # *====================================================================*
+    #         SYNC WATERMARKS
+    # *====================================================================*
+
+    # {uuid: updated_at} of the encounters, out of uuids, in the database
+    def get_encounter_updated_at(self, uuids):
+        uuids = list(set(uuids))
+        found = {}
+        try:
+            with self.connection() as conn:
+                for start in range(0, len(uuids), 500):
+                    chunk = uuids[start:start + 500]
+                    query = f"SELECT uuid, updated_at FROM encounters WHERE uuid IN ({', '.join('?' * len(chunk))})"
+                    found.update(conn.execute(query, chunk).fetchall())
+        except sqlite3.Error as e:
+            self._db_error(f"Database error reading encounter change times: {e}")
+        return found
+
+    # Highest local transaction id the peer has acknowledged
+    def get_sync_watermark(self, peer):
+        try:
+            with self.connection() as conn:
+                row = conn.execute('SELECT acked_id FROM sync_state WHERE peer = ?', (peer,)).fetchone()
+            return row[0] if row else 0
+        except sqlite3.Error as e:
+            self._db_error(f"Database error reading sync watermark for {peer}: {e}")
+            return 0
+
+    # Up to limit local (synced = 0) transactions after after_id, oldest
+    # first; with unsynced_only=False transactions received from peers too
+    def get_sync_batch(self, after_id, limit=100, unsynced_only=True):
+        query = f"SELECT * FROM encounter_transactions WHERE id > ? {'AND synced = 0 ' if unsynced_only else ''}ORDER BY id LIMIT ?"
+        try:
+            with self.connection() as conn:
+                cursor = conn.execute(query, (after_id, limit))
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            self._db_error(f"Database error getting sync batch {query}: {e}")
+            return []
+
+    # (count, oldest created_at) of local transactions after after_id not yet
+    # synced; with unsynced_only=False of every transaction after after_id
+    def get_sync_backlog(self, after_id, unsynced_only=True):
+        query = f"SELECT COUNT(*), MIN(created_at) FROM encounter_transactions WHERE id > ? {'AND synced = 0' if unsynced_only else ''}"
+        try:
+            with self.connection() as conn:
+                row = conn.execute(query, (after_id,)).fetchone()
+            return row[0], row[1]
+        except sqlite3.Error as e:
+            self._db_error(f"Database error reading sync backlog: {e}")
+            return 0, None
+
+    # (created_at, uuid) of every transaction in the transaction log, or only
+    # those whose created_at starts with one of prefixes, in created_at order
+    def get_transaction_keys(self, prefixes=None):
+        query = 'SELECT created_at, uuid FROM encounter_transactions'
+        # '~' sorts after every character of a timestamp
+        ranges = [(None, None)] if prefixes is None else [(prefix, prefix + '~') for prefix in sorted(prefixes)]
+        keys = []
+        try:
+            with self.connection() as conn:
+                for low, high in ranges:
+                    if low is None:
+                        rows = conn.execute(f'{query} ORDER BY created_at, uuid')
+                    else:
+                        rows = conn.execute(f'{query} WHERE created_at >= ? AND created_at < ? ORDER BY created_at, uuid',
+                                            (low, high))
+                    keys.extend(rows.fetchall())
+        except sqlite3.Error as e:
+            self._db_error(f"Database error reading transaction keys: {e}")
+        return keys
+
+    # Transaction log rows for the given uuids
+    def get_transactions_by_uuid(self, uuids):
+        uuids = list(uuids)
+        rows = []
+        try:
+            with self.connection() as conn:
+                for start in range(0, len(uuids), 500):
+                    chunk = uuids[start:start + 500]
+                    query = f"SELECT * FROM encounter_transactions WHERE uuid IN ({', '.join('?' * len(chunk))}) ORDER BY id"
+                    cursor = conn.execute(query, chunk)
+                    columns = [column[0] for column in cursor.description]
+                    rows.extend(dict(zip(columns, row)) for row in cursor.fetchall())
+        except sqlite3.Error as e:
+            self._db_error(f"Database error reading transactions: {e}")
+        return rows
+
+    # This node's sync peer id, created with the database so it stays the
+    # same across restarts
+    def get_sync_node_id(self):
+        with self.connection() as conn:
+            row = conn.execute('SELECT id FROM sync_node').fetchone()
+        return row[0] if row else None
+
+    # Record a cumulative acknowledgement: the peer has every local
+    # transaction up to and including acked_id
+    def ack_sync_transactions(self, peer, acked_id):
+        updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with self.unit_of_work():
+                with self.connection() as conn:
+                    conn.execute('''INSERT INTO sync_state (peer, acked_id, updated_at) VALUES (?, ?, ?)
+                                    ON CONFLICT(peer) DO UPDATE SET acked_id = MAX(acked_id, excluded.acked_id),
+                                                                    updated_at = excluded.updated_at''',
+                                 (peer, acked_id, updated_at))
+                    conn.execute('UPDATE encounter_transactions SET synced = 2 WHERE id <= ? AND synced = 0',
+                                 (acked_id,))
+        except sqlite3.Error as e:
+            self._db_error(f"Database error acknowledging sync for {peer}: {e}")
+
+
+    # *====================================================================*
+    #         SNAPSHOTS
+    # *====================================================================*
+
+    # True if there are no encounters and no transactions yet
+    def is_empty(self):
+        with self.connection() as conn:
+            row = conn.execute('''SELECT EXISTS(SELECT 1 FROM encounters)
+                                         OR EXISTS(SELECT 1 FROM encounter_transactions)''').fetchone()
+        return not row[0]
+
+    # A consistent copy of tables, read in one read transaction.  Returns
+    # {'high_water': highest transaction id, 'tables': {table: {'columns': [...], 'rows': [...]}}}
+    # encounter_transactions rows are read without their local id.
+    def read_snapshot(self, tables=SNAPSHOT_TABLES):
+        snapshot = {'tables': {}}
+        with self.connection() as conn:
+            in_transaction = conn.in_transaction
+            if not in_transaction:
+                conn.execute('BEGIN')
+            try:
+                snapshot['high_water'] = conn.execute('SELECT COALESCE(MAX(id), 0) FROM encounter_transactions').fetchone()[0]
+                for table in tables:
+                    if table == 'encounter_transactions':
+                        cursor = conn.execute('SELECT uuid, encounter_uuid, user, data, created_at FROM encounter_transactions ORDER BY id')
+                    else:
+                        cursor = conn.execute(f'SELECT * FROM {table}')
+                    snapshot['tables'][table] = {
+                        'columns': [column[0] for column in cursor.description],
+                        'rows': cursor.fetchall(),
+                    }
+            finally:
+                if not in_transaction:
+                    conn.commit()
+        return snapshot
+
+    # Replace the contents of the snapshot's tables with it in one unit of
+    # work, keeping the local schema (keys, defaults and indexes).  Snapshot
+    # columns a table lacks, e.g. extra participant spreadsheet columns on
+    # the server, are added to it.  Transactions are stored as synced (2).
+    # Returns True on success.
+    def install_snapshot(self, snapshot):
+        with self.unit_of_work() as uow:
+            with self.connection() as conn:
+                for table, data in snapshot['tables'].items():
+                    if table not in SNAPSHOT_TABLES:
+                        self._db_error(f"Snapshot has unknown table {table}")
+                        break
+                    columns = list(data['columns'])
+                    rows = data['rows']
+                    local = [row[1] for row in conn.execute('SELECT * FROM pragma_table_info(?)', (table,))]
+                    for column in columns:
+                        if column not in local:
+                            if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', column):
+                                self._db_error(f"Snapshot of {table} has invalid column name {column!r}")
+                                break
+                            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+                            self.schema_changed()
+                    if uow.errors:
+                        break
+                    conn.execute(f'DELETE FROM {table}')
+                    if table == 'encounter_transactions':
+                        columns.append('synced')
+                        rows = [list(row) + [2] for row in rows]
+                    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+                    try:
+                        conn.executemany(query, rows)
+                    except sqlite3.Error as e:
+                        self._db_error(f"Database error installing snapshot of {table}: {e}")
+                        break
+        if not uow.committed:
+            return False
+        self.rebuild_station_stats()
+        for table in snapshot['tables']:
+            self.table_replaced(table)
+        return True
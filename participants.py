@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker participant search
+
+An in-memory index over the persons table so station pickers can look up
+runners on the server instead of downloading the whole roster.  Bib
+numbers, first and last names are indexed as lower case tokens: exact and
+prefix matches come from a sorted token list, and misspellings are found
+through a trigram index and a bounded edit distance.  Every word of the
+query has to match; results are ranked by how well they match.
+
+The index is rebuilt when the persons table version changes.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import bisect
+import re
+import threading
+import time
+
+
+SEARCH_FIELDS = ('bib', 'first_name', 'last_name')
+
+# Score of a query word matching a token, best first
+EXACT_BIB = 100
+EXACT = 50
+PREFIX = 30
+FUZZY = 10
+
+
+def _tokens(value):
+    if value is None:
+        return []
+    return [token for token in re.split(r'[\s,]+', str(value).lower()) if token]
+
+
+def _trigrams(token):
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Edit distance between a and b counting a swap of neighbouring letters as
+# one edit, or limit + 1 once it is known to exceed limit
+def _distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if before is not None and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+# Typos allowed for a query word of this length
+def _allowed_typos(word):
+    if len(word) >= 7:
+        return 2
+    if len(word) >= 4:
+        return 1
+    return 0
+
+
+class _Index:
+    """One build of the participant index, never changed once built."""
+
+    def __init__(self, rows, version):
+        self.rows = rows
+        self.version = version
+        self.bibs, self.token_rows, self.trigram_tokens = {}, {}, {}
+        for index, row in enumerate(rows):
+            bib = str(row.get('bib') or '').strip().lower()
+            if bib:
+                self.bibs.setdefault(bib, []).append(index)
+            for field in SEARCH_FIELDS:
+                for token in _tokens(row.get(field)):
+                    self.token_rows.setdefault(token, set()).add(index)
+        for token in self.token_rows:
+            for trigram in _trigrams(token):
+                self.trigram_tokens.setdefault(trigram, []).append(token)
+        self.sorted_tokens = sorted(self.token_rows)
+        self.order = sorted(range(len(rows)), key=lambda i: (str(rows[i].get('last_name') or '').lower(),
+                                                             str(rows[i].get('first_name') or '').lower()))
+        self.position = {index: rank for rank, index in enumerate(self.order)}
+
+    # {row index: score} for one query word
+    def match_word(self, word, fuzzy):
+        scores = {}
+
+        def add(indexes, score):
+            for index in indexes:
+                if scores.get(index, 0) < score:
+                    scores[index] = score
+
+        add(self.bibs.get(word, ()), EXACT_BIB)
+        start = bisect.bisect_left(self.sorted_tokens, word)
+        for token in self.sorted_tokens[start:]:
+            if not token.startswith(word):
+                break
+            add(self.token_rows[token], EXACT if token == word else PREFIX)
+
+        typos = _allowed_typos(word)
+        if fuzzy and typos:
+            # Tokens sharing enough trigrams with word are checked by edit distance
+            counts = {}
+            for trigram in _trigrams(word):
+                for token in self.trigram_tokens.get(trigram, ()):
+                    counts[token] = counts.get(token, 0) + 1
+            needed = len(_trigrams(word)) - 3 * typos
+            for token, shared in counts.items():
+                if shared >= needed and _distance(word, token, typos) <= typos:
+                    add(self.token_rows[token], FUZZY)
+        return scores
+
+
+class ParticipantIndex:
+    """Ranked, typo tolerant search over the persons table of db.
+
+    Each rebuild makes a new _Index and swaps it in whole, so a search
+    running during a rebuild keeps using the build it started with.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self._index = _Index([], None)
+        self.stats = {'builds': 0, 'build_ms': 0.0, 'searches': 0, 'last_ms': 0.0, 'max_ms': 0.0}
+
+    @property
+    def rows(self):
+        return self._index.rows
+
+    # Rebuild the index if the persons table changed since the last build.
+    # Returns the current build.
+    def refresh(self):
+        version = self.db.table_version('persons')
+        index = self._index
+        if version == index.version:
+            return index
+        with self._lock:
+            index = self._index
+            if version == index.version:
+                return index
+            start = time.perf_counter()
+            index = self._index = _Index(self.db.zip_table('persons')['data'], version)
+            self.stats['builds'] += 1
+            self.stats['build_ms'] = (time.perf_counter() - start) * 1000
+            return index
+
+    # Returns (rows ranked best first, starting at start, at most limit of
+    # them, total number of matches)
+    def search(self, query, limit=20, start=0):
+        begin = time.perf_counter()
+        index = self.refresh()
+        words = _tokens(query)
+        if not words:
+            ranked = index.order
+        else:
+            totals = None
+            for fuzzy in (False, True):
+                totals = None
+                for word in words:
+                    scores = index.match_word(word, fuzzy)
+                    if totals is None:
+                        totals = scores
+                    else:
+                        totals = {index: totals[index] + score for index, score in scores.items() if index in totals}
+                    if not totals:
+                        break
+                # Only look for typos when exact and prefix matches are short
+                if len(totals) >= start + limit:
+                    break
+            ranked = sorted(totals, key=lambda row: (-totals[row], index.position[row]))
+
+        rows = [index.rows[row] for row in ranked[start:start + limit]]
+        elapsed = (time.perf_counter() - begin) * 1000
+        self.stats['searches'] += 1
+        self.stats['last_ms'] = elapsed
+        self.stats['max_ms'] = max(self.stats['max_ms'], elapsed)
+        return rows, len(ranked)
+
+    def status(self):
+        index = self._index
+        return dict(self.stats, participants=len(index.rows), tokens=len(index.sorted_tokens))
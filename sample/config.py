@@ -18,6 +18,20 @@ class Config(object):
     # Database Stuff
     DATABASE_PATH = os.environ.get('DATABASE_URL') or 'db/data.db'
 
+    # Connection pool: connections kept open, plus extra connections allowed
+    # under load that are closed once returned
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 8)
+    DATABASE_POOL_OVERFLOW = int(os.environ.get('DATABASE_POOL_OVERFLOW') or 4)
+
+    # Settings applied to every database connection
+    DATABASE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,       # ms to wait on a locked database
+        'cache_size': -16000,       # negative values are KiB
+        'mmap_size': 67108864,      # bytes
+    }
+
     # Admin Account
     ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME') or ''
     ADMIN_PASSWORD = os.environ.get('USER_PASSWORD') or ''
@@ -62,6 +76,55 @@ class Config(object):
     # the best option based on installed packages.
     ASYNC_MODE = os.environ.get('ASYNC_MODE') or None
 
+    # Sync with an upstream server.  Leave UPSTREAM_ENDPOINT empty to run as
+    # the sync server; clients must present UPSTREAM_KEY to join.
+    SYNC_ENABLED = os.environ.get('SYNC_ENABLED') in ['True', 'TRUE', 'true', '1']
+    UPSTREAM_ENDPOINT = os.environ.get('UPSTREAM_ENDPOINT') or ''
+    UPSTREAM_KEY = os.environ.get('UPSTREAM_KEY') or ''
+    # Id a client presents to the server, which keeps a watermark per id.
+    # Defaults to one generated with the database.
+    SYNC_PEER_ID = os.environ.get('SYNC_PEER_ID') or None
+
+    # Transactions go to the sync peer in batches of up to SYNC_BATCH_SIZE,
+    # waiting up to SYNC_BATCH_WINDOW_MS for a batch to fill, with at most
+    # SYNC_MAX_IN_FLIGHT batches waiting for an acknowledgement.  Reconnects
+    # back off from SYNC_RETRY_MIN_S to SYNC_RETRY_MAX_S seconds.  A
+    # transaction the peer rejects SYNC_MAX_RETRIES times on its own is
+    # skipped.
+    SYNC_BATCH_SIZE = int(os.environ.get('SYNC_BATCH_SIZE') or 100)
+    SYNC_BATCH_WINDOW_MS = int(os.environ.get('SYNC_BATCH_WINDOW_MS') or 250)
+    SYNC_MAX_IN_FLIGHT = int(os.environ.get('SYNC_MAX_IN_FLIGHT') or 2)
+    SYNC_RETRY_MIN_S = float(os.environ.get('SYNC_RETRY_MIN_S') or 1)
+    SYNC_RETRY_MAX_S = float(os.environ.get('SYNC_RETRY_MAX_S') or 60)
+    SYNC_MAX_RETRIES = int(os.environ.get('SYNC_MAX_RETRIES') or 3)
+
+    # A client starting with an empty database first copies the server's
+    # encounters, participants and transaction log, in chunks of
+    # SYNC_SNAPSHOT_CHUNK_ROWS rows, instead of replaying every transaction
+    SYNC_BOOTSTRAP = os.environ.get('SYNC_BOOTSTRAP') not in ['False', 'FALSE', 'false', '0']
+    SYNC_SNAPSHOT_CHUNK_ROWS = int(os.environ.get('SYNC_SNAPSHOT_CHUNK_ROWS') or 500)
+
+    # Seconds between digest checks of the transaction log against the
+    # upstream server, 0 to turn them off
+    SYNC_RECONCILE_S = float(os.environ.get('SYNC_RECONCILE_S') or 300)
+
+    # Encounter changes are sent to browsers in batches: a batch is sent once
+    # no change arrived for BROADCAST_WINDOW_MS, or BROADCAST_MAX_DELAY_MS
+    # after its first change.  Set the window to 0 to send every change.
+    BROADCAST_WINDOW_MS = int(os.environ.get('BROADCAST_WINDOW_MS') or 150)
+    BROADCAST_MAX_DELAY_MS = int(os.environ.get('BROADCAST_MAX_DELAY_MS') or 1000)
+
+    # Uploaded participant and encounter spreadsheets are read and saved
+    # IMPORT_CHUNK_ROWS rows at a time
+    IMPORT_CHUNK_ROWS = int(os.environ.get('IMPORT_CHUNK_ROWS') or 2000)
+
+    # Chat history is sent CHAT_HISTORY_PAGE messages at a time; the last
+    # CHAT_HISTORY_BUFFER messages of the CHAT_HISTORY_ROOMS most recently
+    # used rooms are kept in memory
+    CHAT_HISTORY_PAGE = int(os.environ.get('CHAT_HISTORY_PAGE') or 50)
+    CHAT_HISTORY_BUFFER = int(os.environ.get('CHAT_HISTORY_BUFFER') or 200)
+    CHAT_HISTORY_ROOMS = int(os.environ.get('CHAT_HISTORY_ROOMS') or 16)
+
     # Web UI and general app Stuff
     if (os.environ.get('MED_TRACKER_DEBUG') in ['True', 'TRUE', 'true', '1']):
         DEBUG = True
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker JSON serialization
+
+One place for turning responses into JSON.  orjson is used when it is
+installed (pip install orjson) and the standard json module otherwise;
+BACKEND tells which.  JSONProvider plugs the same encoder into Flask's
+jsonify, and object_json writes JSON straight from the (columns, row
+tuple chunks) that Db.iter_select yields, one chunk at a time, without
+building a dict for every row of the table first.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = 'json' if orjson is None else 'orjson'
+
+# Types neither encoder handles natively (dates, Decimal, UUID with json)
+# are converted the way Flask converts them.  orjson is asked to pass
+# datetimes through so they come out as HTTP dates, as with Flask.
+_default = DefaultJSONProvider.default
+_OPTIONS = 0 if orjson is None else orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+# obj as compact UTF-8 JSON bytes
+def dumps(obj, sort_keys=False):
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=_OPTIONS | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+    return json.dumps(obj, default=_default, separators=(',', ':'), sort_keys=sort_keys,
+                      ensure_ascii=False).encode('utf-8')
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# The objects of a JSON array, comma separated bytes pieces, from column
+# names and chunks of row tuples
+def _rows(columns, chunks):
+    first = True
+    for rows in chunks:
+        if not rows:
+            continue
+        body = dumps([dict(zip(columns, row)) for row in rows])[1:-1]
+        yield body if first else b',' + body
+        first = False
+
+
+# A JSON object of fields plus key holding the rows of a Db.iter_select
+# stream (column names first, then chunks of row tuples)
+def object_json(fields, key, stream):
+    columns = next(stream)
+    head = dumps({**{name: value for name, value in fields.items() if name != key}, key: []})
+    # Everything up to the closing "]}" of the empty list
+    yield head[:-2]
+    yield from _rows(columns, stream)
+    yield b']}'
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider (app.json) using dumps/loads above."""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, sort_keys=kwargs.get('sort_keys', self.sort_keys)).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, sort_keys=self.sort_keys) + b'\n', mimetype=self.mimetype)
@@ -3,19 +3,57 @@ var socket = io.connect('//' + document.domain + ':' + location.port + '/chat');
 
 var currentRoom = localStorage.getItem('currentRoom') || 'Medical';
 
+// Ids of the oldest and newest messages shown, so older pages can be asked
+// for and a reconnect only gets the messages missed
+var oldestId = null;
+var newestId = null;
+
 socket.on('connect', function() {
     joinRoom(currentRoom);
 });
 
-socket.on('previous_messages', function(messages) {
+// The latest page of messages, or on a reconnect the messages missed
+socket.on('previous_messages', function(data) {
+    if (data.room !== currentRoom) {
+        return;
+    }
     let chatBox = document.getElementById('chat-box');
-    chatBox.innerHTML = '';
-    messages.forEach(function(message) {
+    if (!data.append) {
+        chatBox.innerHTML = '';
+        oldestId = null;
+        newestId = null;
+    }
+    data.messages.forEach(function(message) {
         addMessageToChatBox(message, message.assignment === assignment ? 'right' : 'left');
     });
+    if (!data.append) {
+        showLoadOlder(data.more);
+    }
+});
+
+socket.on('older_messages', function(data) {
+    if (data.room !== currentRoom) {
+        return;
+    }
+    let chatBox = document.getElementById('chat-box');
+    let button = document.getElementById('load-older');
+    let height = chatBox.scrollHeight;
+    let first = button ? button.nextSibling : chatBox.firstChild;
+    data.messages.forEach(function(message) {
+        chatBox.insertBefore(messageElement(message, message.assignment === assignment ? 'right' : 'left'), first);
+        if (oldestId === null || message.id < oldestId) {
+            oldestId = message.id;
+        }
+    });
+    // Keep the messages being read in place
+    chatBox.scrollTop += chatBox.scrollHeight - height;
+    showLoadOlder(data.more);
 });
 
 socket.on('receive_message', function(data) {
+    if (data.room !== currentRoom || (newestId !== null && data.id <= newestId)) {
+        return;
+    }
     addMessageToChatBox(data, data.assignment === assignment ? 'right' : 'left');
 });
 
@@ -34,20 +72,57 @@ document.getElementById('room-select').onchange = function() {
         leaveRoom(currentRoom);
         currentRoom = newRoom;
         localStorage.setItem('currentRoom', currentRoom); // Update room in localStorage
+        oldestId = null;
+        newestId = null;
         joinRoom(currentRoom);
     }
 };
 
 function joinRoom(room) {
-    socket.emit('join', {room: room});
+    socket.emit('join', {room: room, after: newestId});
 }
 
 function leaveRoom(room) {
     socket.emit('leave', {room: room});
 }
 
+// A "Load older messages" button at the top of the chat box while there are any
+function showLoadOlder(more) {
+    let chatBox = document.getElementById('chat-box');
+    let button = document.getElementById('load-older');
+    if (!more || oldestId === null) {
+        if (button) {
+            button.remove();
+        }
+        return;
+    }
+    if (!button) {
+        button = document.createElement('button');
+        button.id = 'load-older';
+        button.type = 'button';
+        button.textContent = 'Load older messages';
+        button.onclick = function() {
+            socket.emit('load_older', {room: currentRoom, before: oldestId});
+        };
+        chatBox.insertBefore(button, chatBox.firstChild);
+    }
+}
+
 function addMessageToChatBox(data, alignment) {
     let chatBox = document.getElementById('chat-box');
+    chatBox.appendChild(messageElement(data, alignment));
+    chatBox.scrollTop = chatBox.scrollHeight;
+    if (data.id !== undefined) {
+        if (oldestId === null || data.id < oldestId) {
+            oldestId = data.id;
+        }
+        if (newestId === null || data.id > newestId) {
+            newestId = data.id;
+        }
+    }
+}
+
+function messageElement(data, alignment) {
     let messageDiv = document.createElement('div');
     messageDiv.classList.add('message', alignment);
 
@@ -62,6 +137,5 @@ function addMessageToChatBox(data, alignment) {
     bubble.innerHTML = `<strong>${data.assignment}</strong> (${data.username})<span class="timestamp">  @  ${formattedTime}</span><br>${data.content}`;
 
     messageDiv.appendChild(bubble);
-    chatBox.appendChild(messageDiv);
-    chatBox.scrollTop = chatBox.scrollHeight;
+    return messageDiv;
 }
\ No newline at end of file
@@ -0,0 +1,101 @@
+// Keeps an encounters DataTable in step with the server from the change
+// messages pushed over Socket.IO.  The socket subscribes to the room for
+// aidStation (all stations when null).  Changes arrive in batches carrying
+// the range of that room's versions they cover; when a batch follows the
+// version we last saw the changed rows are updated in place, otherwise (or
+// when the server asks for a reload) the table is reloaded from the server.
+// Tables in server-side processing mode reload their current page instead.
+function trackEncounterTable(table, socket, aidStation) {
+    let version = null;
+    let loading = true;
+    let pending = [];
+    let connected = false;
+    const serverSide = table.init().serverSide === true;
+
+    // The GET response carries the version it was read at
+    table.on('xhr', function (e, settings, json) {
+        version = (json && json.version !== undefined) ? json.version : null;
+        if (!json) {
+            loading = false;
+            return;
+        }
+        // Replay changes that arrived while loading once the rows are drawn
+        table.one('draw', function () {
+            loading = false;
+            const queued = pending;
+            pending = [];
+            queued.forEach(apply);
+        });
+    });
+
+    // The first load may already have finished
+    const loaded = table.ajax.json();
+    if (loaded) {
+        version = loaded.version !== undefined ? loaded.version : null;
+        loading = false;
+    }
+
+    function reload() {
+        loading = true;
+        table.ajax.reload(null, false);
+    }
+
+    function applyRow(change) {
+        const rows = table.rows(function (idx, data) { return data.uuid === change.uuid; });
+        const row = change.row;
+        const visible = row && Number(row.delete_flag) !== 1 &&
+            (!aidStation || row.aid_station === aidStation);
+
+        if (!visible) {
+            rows.remove();
+        } else if (rows.count() > 0) {
+            rows.every(function () { this.data(row); });
+        } else {
+            table.row.add(row);
+        }
+    }
+
+    // msg is either a batch ('encounters_changed') covering versions
+    // from_version..version, or a single change / reload request
+    function apply(msg) {
+        if (loading) {
+            pending.push(msg);
+            return;
+        }
+        if (!msg || msg.version === undefined) {
+            reload();
+            return;
+        }
+        const fromVersion = msg.from_version !== undefined ? msg.from_version : msg.version;
+        const changes = msg.changes || [msg];
+        if (version === null || msg.reload || msg.action === 'reload' || fromVersion > version + 1) {
+            reload();
+            return;
+        }
+        if (msg.version <= version) {
+            return;
+        }
+        // Server-side tables only hold the current page, fetch it again
+        if (serverSide) {
+            reload();
+            return;
+        }
+        version = msg.version;
+        changes.forEach(applyRow);
+        table.draw(false);
+    }
+
+    socket.on('encounters_changed', apply);
+    socket.on('new_encounter', apply);
+    socket.on('edit_encounter', apply);
+    socket.on('remove_encounter', apply);
+
+    // Rooms are lost and changes may have been missed while disconnected
+    socket.on('connect', function () {
+        socket.emit('subscribe', { aid_station: aidStation || null });
+        if (connected) {
+            reload();
+        }
+        connected = true;
+    });
+}
@@ -363,6 +363,10 @@ const manager_cols = [
 // Encounters DataTable shown in the page
 encounterTable = new DataTable('#encounters-table', {
     idSrc: 'uuid',
+    // Paging, sorting and searching are done by the server
+    serverSide: true,
+    processing: true,
+    searchDelay: 300,
     ajax: `.${window.internal_api_base_url}/encounters${window.current_aid_station_path}`,
     columns: window.current_user_is_admin ? manager_cols : aid_station_cols,
     layout: {
@@ -404,10 +408,14 @@ encounterTable = new DataTable('#encounters-table', {
 
 });
 
-// Encounters DataTable shown in the page
+// Participant picker; the server searches the roster and returns one
+// ranked page at a time
 let participantsTable = new DataTable('#participants-table', {
     idSrc: 'id',
-    ajax: `./${window.internal_api_base_url}/participants/`,
+    serverSide: true,
+    ordering: false,
+    searchDelay: 250,
+    ajax: `./${window.internal_api_base_url}/participants/search`,
     columns: [
         { data: 'bib' },
         { data: 'first_name' },
@@ -447,8 +455,6 @@ $(document).ready(function () {
     socket = io.connect('//' + document.domain + ':' + location.port + '/api');
     socket.on('after connect', function(msg) {console.log('Connected')});
     socket.on('disconnect', function(msg) { console.log('Disconnect')});
-    socket.on('new_encounter', function(msg) { encounterTable.ajax.reload() });
-    socket.on('edit_encounter', function(msg) { encounterTable.ajax.reload() });
-    socket.on('remove_encounter', function(msg) { encounterTable.ajax.reload() });
+    trackEncounterTable(encounterTable, socket, window.current_aid_station);
 
 });
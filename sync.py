@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker sync worker
+
+Sends local encounter transactions to the sync peer from a background task
+so the request that made a change never waits on the network.  Writes only
+wake() the worker.  The worker collects transactions past the peer's
+watermark into batches of up to batch_size, waiting at most window seconds
+for a batch to fill, and keeps at most max_in_flight batches waiting for
+an acknowledgement.  A batch not acknowledged within ack_timeout is sent
+again from the watermark.  Batches go on the wire compressed, see
+encode_batch.  A batch the peer could not read, or could not apply all
+of, is acknowledged only up to the first failed transaction (see
+ack_message) and the rest is sent again, in ever smaller batches, until a
+single transaction has failed max_retries times; it is then logged and
+skipped.
+
+When the link is down the worker reconnects with exponential backoff and
+jitter, so a room full of aid stations coming back online does not
+reconnect in step.  Every reconcile_every seconds the worker also starts a
+digest comparison with the peer (see reconcile) to find transactions that
+were lost or resent outside the watermark, e.g. after a database restore.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from uuid import uuid4
+
+
+# Version of the sync_batch message.  1 carries 'items' as a plain list;
+# 2 carries them as zlib compressed JSON bytes.
+SYNC_FORMAT = 2
+
+
+# Build a sync_batch message for items (encounter_transactions rows).  to,
+# if given, is the last id the batch covers when rows after the last item
+# were left out.
+def encode_batch(items, to=None):
+    return {
+        'format': SYNC_FORMAT,
+        'from': items[0]['id'],
+        'to': items[-1]['id'] if to is None else to,
+        'count': len(items),
+        'items': zlib.compress(json.dumps(items, separators=(',', ':')).encode('utf-8')),
+    }
+
+
+# Returns the items of a sync_batch message of any known format.  Raises
+# ValueError if the message can not be read.
+def decode_batch(message):
+    version = message.get('format', 1)
+    try:
+        if version == 1:
+            return message['items']
+        if version == 2:
+            return json.loads(zlib.decompress(message['items']).decode('utf-8'))
+    except (KeyError, TypeError, ValueError, zlib.error) as e:
+        raise ValueError(f"Unreadable sync batch: {e}") from e
+    raise ValueError(f"Unknown sync batch format {version}")
+
+
+# The sync_ack for a batch and the result of apply_sync_transactions for
+# its items.  'to' is the highest id the peer may count as delivered: the
+# end of the batch, or just before the first failed item ('partial').
+def ack_message(batch, items, result):
+    failed = set(result['failed'])
+    failed_ids = [item['id'] for item in items if item['uuid'] in failed]
+    if not failed_ids:
+        return dict(result, status='ok', to=batch['to'], received=len(items))
+    return dict(result, status='partial', to=min(failed_ids) - 1, received=len(items))
+
+
+# The sync_ack for a batch that could not be read: nothing in it was applied
+def reject_message(batch, error):
+    start = batch.get('from') if isinstance(batch, dict) else None
+    return {'status': 'rejected', 'to': start - 1 if isinstance(start, int) else None, 'error': str(error)}
+
+
+# A new sync client with an empty database is sent a snapshot instead of
+# every historical transaction: 'snapshot_begin' with the columns, row
+# counts and transaction high-water mark, 'snapshot_chunk' messages of up to
+# chunk_rows compressed rows each, then 'snapshot_end'.
+def snapshot_messages(snapshot, chunk_rows=500):
+    snapshot_id = str(uuid4())
+    yield 'snapshot_begin', {
+        'snapshot': snapshot_id,
+        'format': SYNC_FORMAT,
+        'high_water': snapshot['high_water'],
+        'tables': {table: {'columns': data['columns'], 'rows': len(data['rows'])}
+                   for table, data in snapshot['tables'].items()},
+    }
+    chunks = 0
+    for table, data in snapshot['tables'].items():
+        rows = data['rows']
+        for start in range(0, len(rows), chunk_rows):
+            yield 'snapshot_chunk', {
+                'snapshot': snapshot_id,
+                'table': table,
+                'seq': chunks,
+                'rows': zlib.compress(json.dumps([list(row) for row in rows[start:start + chunk_rows]],
+                                                 separators=(',', ':')).encode('utf-8')),
+            }
+            chunks += 1
+    yield 'snapshot_end', {'snapshot': snapshot_id, 'chunks': chunks}
+
+
+class SnapshotReceiver:
+    """Collects the messages of one snapshot on the client.
+
+    add(message_type, data) returns the assembled snapshot, in the form
+    Db.install_snapshot takes, once 'snapshot_end' arrives with every chunk
+    accounted for, otherwise None.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.chunks = 0
+
+    def add(self, message_type, data):
+        if message_type == 'snapshot_begin':
+            self.chunks = 0
+            self.snapshot = {
+                'id': data['snapshot'],
+                'high_water': data['high_water'],
+                'tables': {table: {'columns': info['columns'], 'rows': [], 'expected': info['rows']}
+                           for table, info in data['tables'].items()},
+            }
+            return None
+
+        if self.snapshot is None or data['snapshot'] != self.snapshot['id']:
+            print(f"Ignoring {message_type} for unknown snapshot {data.get('snapshot')}", file=sys.stderr)
+            return None
+
+        if message_type == 'snapshot_chunk':
+            rows = json.loads(zlib.decompress(data['rows']).decode('utf-8'))
+            self.snapshot['tables'][data['table']]['rows'].extend(rows)
+            self.chunks += 1
+            return None
+
+        snapshot, self.snapshot = self.snapshot, None
+        complete = data['chunks'] == self.chunks and all(
+            len(table['rows']) == table['expected'] for table in snapshot['tables'].values())
+        if not complete:
+            print(f"Snapshot {snapshot['id']} is incomplete, discarding it", file=sys.stderr)
+            return None
+        return snapshot
+
+
+# Reconciliation compares the transaction logs of two peers as a tree of
+# digests over created_at prefixes: day, hour, then minute.  Only buckets
+# whose digests differ are expanded, and for differing minutes the peers
+# swap transaction uuids and send each other what is missing.
+RECONCILE_LEVELS = [10, 13, 16]
+
+
+# {bucket: [count, digest]} of (created_at, uuid) keys, bucketed by the
+# first length characters of created_at
+def transaction_digests(keys, length):
+    buckets = {}
+    for created_at, uuid in keys:
+        buckets.setdefault(str(created_at)[:length], []).append(uuid)
+    return {bucket: [len(uuids), hashlib.sha1('\n'.join(sorted(uuids)).encode('utf-8')).hexdigest()]
+            for bucket, uuids in buckets.items()}
+
+
+# First reconcile message, from the peer starting a check
+def start_reconcile(db):
+    return {'level': RECONCILE_LEVELS[0], 'digests': transaction_digests(db.get_transaction_keys(), RECONCILE_LEVELS[0])}
+
+
+# Answer a reconcile message.  Returns a list of (message_type, data) to
+# send back: the next level down for differing buckets, uuid lists at the
+# last level, and transactions the peer is missing.
+def reconcile(db, message_type, data):
+    if message_type == 'reconcile':
+        level = data['level']
+        keys = db.get_transaction_keys(data.get('buckets'))
+        ours = transaction_digests(keys, level)
+        theirs = data['digests']
+        differing = sorted(bucket for bucket in set(ours) | set(theirs) if ours.get(bucket) != theirs.get(bucket))
+        if not differing:
+            return []
+        if level != RECONCILE_LEVELS[-1]:
+            next_level = RECONCILE_LEVELS[RECONCILE_LEVELS.index(level) + 1]
+            keys = [key for key in keys if str(key[0])[:level] in differing]
+            return [('reconcile', {'level': next_level, 'buckets': differing,
+                                   'digests': transaction_digests(keys, next_level)})]
+        uuids = [uuid for created_at, uuid in keys if str(created_at)[:level] in differing]
+        return [('reconcile_uuids', {'buckets': differing, 'uuids': uuids})]
+
+    if message_type == 'reconcile_uuids':
+        ours = {uuid for created_at, uuid in db.get_transaction_keys(data['buckets'])}
+        theirs = set(data['uuids'])
+        replies = []
+        if ours - theirs:
+            replies.append(('reconcile_batch', encode_batch(db.get_transactions_by_uuid(ours - theirs))))
+        if theirs - ours:
+            replies.append(('reconcile_fetch', {'uuids': sorted(theirs - ours)}))
+        return replies
+
+    if message_type == 'reconcile_fetch':
+        rows = db.get_transactions_by_uuid(data['uuids'])
+        return [('reconcile_batch', encode_batch(rows))] if rows else []
+
+    raise ValueError(f"Unknown reconcile message {message_type}")
+
+
+# Delay before reconnect attempt number attempt (0 based): exponential
+# growth capped at maximum, with the upper half jittered
+def backoff_delay(attempt, minimum=1.0, maximum=60.0):
+    delay = min(maximum, minimum * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class SyncWorker:
+    """Drains unsynced transactions to the peer in bounded batches.
+
+    db is the models.Db, peer the name its watermark is kept under.  With
+    unsynced_only the worker only sends local transactions (synced = 0),
+    otherwise every transaction past the watermark, as a server does to
+    relay changes between its clients.  send(batch) puts a batch on the
+    wire, connected() tells whether there is a peer to send to, and
+    connect() (optional) opens the link and raises on failure.
+    start_task(fn) and sleep(seconds) should come from the Socket.IO
+    server, so the worker is a thread or a greenlet to match ASYNC_MODE.
+    """
+
+    def __init__(self, db, peer, send, connected, start_task, sleep, connect=None, unsynced_only=True,
+                 batch_size=100, window=0.25, max_in_flight=2, ack_timeout=30.0,
+                 retry_min=1.0, retry_max=60.0, max_retries=3, poll=5.0, reconcile=None, reconcile_every=300.0):
+        self.db = db
+        self.peer = peer
+        self.send = send
+        self.connected = connected
+        self.connect = connect
+        self.unsynced_only = unsynced_only
+        self.start_task = start_task
+        self.sleep = sleep
+        self.batch_size = batch_size
+        self.window = window
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.max_retries = max_retries
+        self.poll = poll
+        self.reconcile = reconcile
+        self.reconcile_every = reconcile_every
+
+        self._lock = threading.Lock()
+        self._in_flight = []
+        self._woken_at = None
+        self._reset = False
+        self._running = False
+        self._attempt = 0
+        self._latency = []
+        # Resending after a rejected batch: {'after': watermark, 'limit':
+        # batch size, 'singles': single transaction rejects, 'at': when}
+        self._retry = None
+        self.stats = {'batches': 0, 'transactions': 0, 'acks': 0, 'resends': 0, 'rejects': 0, 'skipped': 0,
+                      'connects': 0, 'connect_failures': 0, 'errors': 0, 'reconciles': 0}
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self.start_task(self._run)
+
+    def stop(self):
+        self._running = False
+
+    # There are new local transactions; never blocks
+    def wake(self):
+        with self._lock:
+            if self._woken_at is None:
+                self._woken_at = time.monotonic()
+
+    # The link was (re)established: anything in flight may be lost, so
+    # start again from the watermark
+    def reset(self):
+        with self._lock:
+            self._in_flight = []
+            self._reset = True
+            self._woken_at = time.monotonic()
+
+    # The peer has every transaction up to and including to
+    def ack(self, to):
+        self.db.ack_sync_transactions(self.peer, to)
+        now = time.monotonic()
+        with self._lock:
+            self.stats['acks'] += 1
+            for batch in [batch for batch in self._in_flight if batch['to'] <= to]:
+                self._latency = (self._latency + [now - batch['sent_at']])[-100:]
+                self._in_flight.remove(batch)
+            if self._retry is not None and to > self._retry['after']:
+                self._retry = None
+            if self._woken_at is None:
+                self._woken_at = now
+
+    # Handle a sync_ack message from the peer, see ack_message
+    def receive_ack(self, data):
+        if data.get('status', 'ok') == 'ok':
+            self.ack(data['to'])
+        else:
+            self.reject(data.get('to'), data.get('error') or f"{len(data.get('failed') or [])} transactions failed")
+
+    # The peer has every transaction up to to (if given) but not the one
+    # after it.  Send again from there, halving the batch size each time;
+    # a single transaction rejected max_retries times is skipped.
+    def reject(self, to, error=None):
+        if to:
+            self.db.ack_sync_transactions(self.peer, to)
+        watermark = self.db.get_sync_watermark(self.peer)
+        with self._lock:
+            self.stats['rejects'] += 1
+            retry = self._retry
+            if retry is None or retry['after'] != watermark:
+                retry = {'after': watermark, 'limit': self.batch_size, 'singles': 0}
+            if retry['limit'] == 1:
+                retry['singles'] += 1
+            retry['limit'] = max(1, retry['limit'] // 2)
+            retry['at'] = time.monotonic() + backoff_delay(retry['singles'], self.retry_min, self.retry_max)
+            self._retry = retry
+            self._in_flight = []
+            self._reset = True
+            self._woken_at = time.monotonic()
+        print(f"Sync peer {self.peer} did not take transactions after {watermark}: {error}", file=sys.stderr)
+        if retry['singles'] >= self.max_retries:
+            self._skip(watermark)
+
+    # Give up on the transaction after watermark
+    def _skip(self, watermark):
+        items = self.db.get_sync_batch(after_id=watermark, limit=1, unsynced_only=self.unsynced_only)
+        if items:
+            print(f"Sync peer {self.peer} rejected transaction {items[0]['uuid']} (id {items[0]['id']}) "
+                  f"{self.max_retries} times, skipping it", file=sys.stderr)
+            self.db.ack_sync_transactions(self.peer, items[0]['id'])
+        with self._lock:
+            self.stats['skipped'] += 1
+            self._retry = None
+
+    def _run(self):
+        last_check = time.monotonic()
+        last_reconcile = last_check
+        while self._running:
+            try:
+                if not self.connected():
+                    self._reconnect()
+                    continue
+                now = time.monotonic()
+                with self._lock:
+                    woken_at = self._woken_at
+                if woken_at is None and now - last_check >= self.poll:
+                    woken_at = last_check
+                if woken_at is not None:
+                    last_check = now
+                    self._fill(woken_at)
+                # Check with the peer once everything sent is acknowledged
+                if self.reconcile is not None and self.reconcile_every and not self._in_flight \
+                        and now - last_reconcile >= self.reconcile_every:
+                    last_reconcile = now
+                    self.stats['reconciles'] += 1
+                    self.reconcile()
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"Sync worker error: {e}", file=sys.stderr)
+            self.sleep(min(self.window, 0.25) or 0.05)
+
+    def _reconnect(self):
+        if self.connect is None:
+            self.sleep(self.poll / 5)
+            return
+        try:
+            self.connect()
+            self.stats['connects'] += 1
+            self._attempt = 0
+        except Exception as e:
+            self.stats['connect_failures'] += 1
+            delay = backoff_delay(self._attempt, self.retry_min, self.retry_max)
+            self._attempt += 1
+            print(f"SYNC Client connection failed: {e}. Retrying in {delay:.1f} seconds...", file=sys.stderr)
+            self.sleep(delay)
+
+    # Send batches until max_in_flight are waiting or nothing is left
+    def _fill(self, woken_at):
+        now = time.monotonic()
+        with self._lock:
+            if self._in_flight and now - self._in_flight[0]['sent_at'] > self.ack_timeout:
+                self.stats['resends'] += 1
+                self._in_flight = []
+            if len(self._in_flight) >= self.max_in_flight:
+                return
+            retry = self._retry
+            # After a reject only one batch at a time, once the delay is over
+            if retry is not None and (self._in_flight or now < retry['at']):
+                return
+            after = self._in_flight[-1]['to'] if self._in_flight else None
+            self._reset = False
+
+        if after is None:
+            after = self.db.get_sync_watermark(self.peer)
+        limit = retry['limit'] if retry is not None and retry['after'] == after else self.batch_size
+        items = self.db.get_sync_batch(after_id=after, limit=limit, unsynced_only=self.unsynced_only)
+
+        # Give a partial batch until the window closes to fill up
+        if len(items) < limit and now - woken_at < self.window:
+            return
+
+        # Transactions received from the peer are not sent back to it
+        full = len(items) == limit
+        to = items[-1]['id'] if items else None
+        items = [item for item in items if item.get('origin') != self.peer]
+
+        with self._lock:
+            if to is None:
+                self._woken_at = None
+                return
+            # A reset or an ack timeout while reading starts over
+            if self._reset or (self._in_flight and self._in_flight[-1]['to'] != after):
+                return
+            # More may be waiting behind a full batch
+            self._woken_at = now if full else None
+            if not items:
+                # The peer has all of them; move the watermark past them
+                # once everything before them is acknowledged
+                if self._in_flight:
+                    return
+            else:
+                self._in_flight.append({'from': items[0]['id'], 'to': to, 'sent_at': now})
+                self.stats['batches'] += 1
+                self.stats['transactions'] += len(items)
+
+        if items:
+            self.send(encode_batch(items, to=to))
+        else:
+            self.db.ack_sync_transactions(self.peer, to)
+
+    def status(self):
+        watermark = self.db.get_sync_watermark(self.peer)
+        depth, oldest = self.db.get_sync_backlog(after_id=watermark, unsynced_only=self.unsynced_only)
+        lag = None
+        if oldest:
+            try:
+                lag = max(0, (datetime.now() - datetime.strptime(oldest, '%Y-%m-%d %H:%M:%S')).total_seconds())
+            except ValueError:
+                pass
+        with self._lock:
+            latency = self._latency
+            return dict(self.stats,
+                        running=self._running,
+                        connected=bool(self.connected()),
+                        watermark=watermark,
+                        queue_depth=depth,
+                        lag_seconds=lag,
+                        in_flight=len(self._in_flight),
+                        batch_latency_ms={
+                            'last': round(latency[-1] * 1000, 1) if latency else None,
+                            'avg': round(sum(latency) / len(latency) * 1000, 1) if latency else None,
+                            'max': round(max(latency) * 1000, 1) if latency else None,
+                        })
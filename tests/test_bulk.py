@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker bulk transaction tests
+
+    python -m pytest tests
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+
+
+import os
+import sys
+import tempfile
+import unittest
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transactions
+from models import Db
+
+
+class ApplyBulkTransactionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Db(os.path.join(self.directory.name, 'test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def count(self, table):
+        return self.db.select(f'SELECT COUNT(*) FROM {table}', (), tuples=True)['rows'][0][0]
+
+    def test_all_saved(self):
+        uuid = str(uuid4())
+        committed, results = transactions.apply_bulk_transactions(self.db, [
+            {'action': 'create', 'uuid': uuid, 'data': {'bib': '1', 'notes': 'created'}},
+            {'action': 'edit', 'uuid': uuid, 'data': {'notes': 'edited'}},
+            {'action': 'create', 'data': {'bib': '2'}},
+        ])
+
+        self.assertTrue(committed)
+        self.assertEqual([result['status'] for result in results], ['created', 'edited', 'created'])
+        self.assertIsNotNone(results[2]['uuid'])
+        self.assertEqual(self.db.zip_encounters(uuid=uuid)['data'][0]['notes'], 'edited')
+        self.assertEqual(self.count('encounters'), 2)
+        self.assertEqual(self.count('encounter_transactions'), 3)
+
+    def test_unknown_encounter_saves_nothing(self):
+        committed, results = transactions.apply_bulk_transactions(self.db, [
+            {'action': 'create', 'data': {'bib': '1'}},
+            {'action': 'edit', 'uuid': str(uuid4()), 'data': {'notes': 'edited'}},
+        ])
+
+        self.assertFalse(committed)
+        self.assertEqual([result['status'] for result in results], ['not_applied', 'error'])
+        self.assertEqual(self.count('encounters'), 0)
+        self.assertEqual(self.count('encounter_transactions'), 0)
+
+    def test_existing_encounter_can_not_be_created_again(self):
+        uuid = str(uuid4())
+        transactions.apply_bulk_transactions(self.db, [{'action': 'create', 'uuid': uuid, 'data': {'bib': '1'}}])
+
+        committed, results = transactions.apply_bulk_transactions(self.db, [
+            {'action': 'create', 'uuid': uuid, 'data': {'bib': '1'}},
+        ])
+
+        self.assertFalse(committed)
+        self.assertEqual(results[0]['status'], 'error')
+        self.assertEqual(self.count('encounters'), 1)
+
+    def test_retried_transaction_is_a_duplicate(self):
+        uuid, transaction_uuid = str(uuid4()), str(uuid4())
+        operations = [{'action': 'create', 'uuid': uuid, 'transaction_uuid': transaction_uuid, 'data': {'bib': '1'}}]
+        transactions.apply_bulk_transactions(self.db, operations)
+
+        committed, results = transactions.apply_bulk_transactions(self.db, operations + [
+            {'action': 'edit', 'uuid': uuid, 'data': {'notes': 'after retry'}},
+        ])
+
+        self.assertTrue(committed)
+        self.assertEqual([result['status'] for result in results], ['duplicate', 'edited'])
+        self.assertEqual(self.count('encounters'), 1)
+        self.assertEqual(self.count('encounter_transactions'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker spreadsheet import tests
+
+    python -m pytest tests
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from importer import Importer, ImportFileError
+from models import Db
+
+
+def csv_file(*lines):
+    return io.BytesIO('\n'.join(lines).encode('utf-8'))
+
+
+class ImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Db(os.path.join(self.directory.name, 'test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def persons(self):
+        return {row['bib']: row for row in self.db.select('SELECT * FROM persons')}
+
+    def test_persons_upserted_by_bib(self):
+        Importer(self.db, 'persons').run(csv_file('Bib #,First,Last,Age', '1,Ann,Lee,30', '2,Bo,Kim,41'), 'runners.csv')
+
+        status = Importer(self.db, 'persons', chunk_rows=1).run(
+            csv_file('Bib Number,Surname,Shoe size', '2,Park,10', '3,Cruz,9'), 'runners.csv')
+
+        self.assertEqual((status['inserted'], status['updated'], status['chunks']), (1, 1, 2))
+        self.assertEqual(status['ignored_columns'], ['Shoe size'])
+        persons = self.persons()
+        self.assertEqual(sorted(persons), ['1', '2', '3'])
+        self.assertEqual((persons['2']['first_name'], persons['2']['last_name']), ('Bo', 'Park'))
+        self.assertEqual(persons['3']['participant'], 1)
+
+    def test_bad_values_left_empty(self):
+        status = Importer(self.db, 'persons').run(
+            csv_file('bib,age,active_duty', '1,thirty,yes', '2,40,maybe', ',50,no'), 'runners.csv')
+
+        self.assertEqual((status['inserted'], status['skipped'], status['bad_values']), (2, 1, 2))
+        self.assertEqual(len(status['errors']), 3)
+        persons = self.persons()
+        self.assertEqual((persons['1']['age'], persons['1']['active_duty']), (None, 1))
+        self.assertEqual((persons['2']['age'], persons['2']['active_duty']), (40, None))
+
+    def test_encounters_get_uuids(self):
+        status = Importer(self.db, 'encounters').run(csv_file('bib,station', '1,Aid 1', '2,Aid 2'), 'encounters.csv')
+
+        self.assertEqual(status['inserted'], 2)
+        rows = self.db.select('SELECT uuid, aid_station FROM encounters')
+        self.assertEqual(sorted(row['aid_station'] for row in rows), ['Aid 1', 'Aid 2'])
+        self.assertTrue(all(row['uuid'] for row in rows))
+
+    def test_file_errors(self):
+        with self.assertRaises(ImportFileError):
+            Importer(self.db, 'persons').run(csv_file('first,last', 'Ann,Lee'), 'runners.csv')
+        with self.assertRaises(ImportFileError):
+            Importer(self.db, 'persons').run(csv_file('bib', '1'), 'runners.txt')
+        with self.assertRaises(ImportFileError):
+            Importer(self.db, 'users')
+
+
+if __name__ == '__main__':
+    unittest.main()
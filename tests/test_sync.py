@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker sync tests
+
+    python -m pytest tests
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync
+import transactions
+from models import Db
+
+
+def create(db, bib, created_at=None, origin=None):
+    return transactions.apply_transaction(db, {'action': 'create', 'data[0][bib]': bib},
+                                          created_at=created_at, origin=origin)
+
+
+class SyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbs = []
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.close()
+        self.directory.cleanup()
+
+    def make_db(self):
+        db = Db(os.path.join(self.directory.name, f'test{len(self.dbs)}.db'))
+        self.dbs.append(db)
+        return db
+
+    def count(self, db, table):
+        return db.select(f'SELECT COUNT(*) FROM {table}', (), tuples=True)['rows'][0][0]
+
+
+class AckMessageTest(unittest.TestCase):
+
+    def test_ok(self):
+        items = [{'id': 4, 'uuid': 'a'}, {'id': 6, 'uuid': 'b'}]
+        result = {'applied': 2, 'stale': 0, 'duplicates': 0, 'failed': []}
+
+        ack = sync.ack_message({'from': 4, 'to': 7}, items, result)
+
+        self.assertEqual((ack['status'], ack['to'], ack['received']), ('ok', 7, 2))
+
+    def test_partial_stops_before_first_failed(self):
+        items = [{'id': 4, 'uuid': 'a'}, {'id': 5, 'uuid': 'b'}, {'id': 6, 'uuid': 'c'}]
+        result = {'applied': 1, 'stale': 0, 'duplicates': 0, 'failed': ['c', 'b']}
+
+        ack = sync.ack_message({'from': 4, 'to': 6}, items, result)
+
+        self.assertEqual((ack['status'], ack['to']), ('partial', 4))
+
+    def test_reject(self):
+        self.assertEqual(sync.reject_message({'from': 4, 'to': 6}, 'bad')['to'], 3)
+        self.assertIsNone(sync.reject_message('junk', 'bad')['to'])
+
+    def test_batch_round_trip(self):
+        items = [{'id': 1, 'uuid': 'a'}, {'id': 2, 'uuid': 'b'}]
+
+        batch = sync.encode_batch(items, to=5)
+
+        self.assertEqual((batch['from'], batch['to'], batch['count']), (1, 5, 2))
+        self.assertEqual(sync.decode_batch(batch), items)
+        with self.assertRaises(ValueError):
+            sync.decode_batch(dict(batch, items=b'junk'))
+
+
+class SyncWorkerTest(SyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = self.make_db()
+        self.sent = []
+
+    def worker(self, peer='peer', **options):
+        options = dict(dict(batch_size=8, window=0, retry_min=0, retry_max=0, max_retries=2), **options)
+        return sync.SyncWorker(self.db, peer, send=self.sent.append, connected=lambda: True,
+                               start_task=None, sleep=None, **options)
+
+    def fill(self, worker):
+        worker._fill(0.0)
+        return self.sent.pop() if self.sent else None
+
+    def test_ack_advances_watermark(self):
+        for bib in range(10):
+            create(self.db, str(bib))
+        worker = self.worker()
+
+        batch = self.fill(worker)
+        self.assertEqual((batch['from'], batch['to'], batch['count']), (1, 8, 8))
+        worker.receive_ack(sync.ack_message(batch, sync.decode_batch(batch), {'failed': []}))
+        self.assertEqual(self.db.get_sync_watermark('peer'), 8)
+
+        batch = self.fill(worker)
+        self.assertEqual((batch['from'], batch['to']), (9, 10))
+        worker.receive_ack(sync.ack_message(batch, sync.decode_batch(batch), {'failed': []}))
+        self.assertEqual(self.db.get_sync_watermark('peer'), 10)
+        self.assertIsNone(self.fill(worker))
+        self.assertEqual(self.count(self.db, 'encounter_transactions WHERE synced = 0'), 0)
+
+    def test_partial_ack_resends_from_failed(self):
+        for bib in range(10):
+            create(self.db, str(bib))
+        worker = self.worker()
+
+        batch = self.fill(worker)
+        items = sync.decode_batch(batch)
+        worker.receive_ack(sync.ack_message(batch, items, {'failed': [items[2]['uuid']]}))
+
+        self.assertEqual(self.db.get_sync_watermark('peer'), 2)
+        batch = self.fill(worker)
+        self.assertEqual((batch['from'], batch['count']), (3, 4))
+
+    def test_rejected_transaction_is_skipped(self):
+        for bib in range(10):
+            create(self.db, str(bib))
+        worker = self.worker()
+
+        counts = []
+        batch = self.fill(worker)
+        while batch is not None and batch['from'] == 1:
+            counts.append(batch['count'])
+            worker.receive_ack(sync.reject_message(batch, 'bad'))
+            batch = self.fill(worker)
+
+        # Halved down to the one transaction, which is then given up on
+        self.assertEqual(counts, [8, 4, 2, 1, 1])
+        self.assertEqual(worker.stats['skipped'], 1)
+        self.assertEqual(self.db.get_sync_watermark('peer'), 1)
+        self.assertEqual(batch['from'], 2)
+
+    def test_transactions_from_peer_not_sent_back(self):
+        create(self.db, '1', origin='a')
+        create(self.db, '2', origin='b')
+        create(self.db, '3', origin='a')
+
+        batch = self.fill(self.worker('a', unsynced_only=False))
+        self.assertEqual([item['id'] for item in sync.decode_batch(batch)], [2])
+        self.assertEqual(batch['to'], 3)
+
+    def test_own_transactions_move_watermark(self):
+        create(self.db, '1', origin='b')
+        create(self.db, '2', origin='a')
+        self.db.ack_sync_transactions('a', 1)
+
+        # Nothing from anyone else: the watermark moves without a batch
+        self.assertIsNone(self.fill(self.worker('a', unsynced_only=False)))
+        self.assertEqual(self.db.get_sync_watermark('a'), 2)
+
+class ReconcileTest(SyncTestCase):
+
+    # Run the reconcile exchange between two databases the way the sync
+    # handlers do, applying each reconcile_batch where it arrives
+    def exchange(self, first, second):
+        pending = [(second, 'reconcile', sync.start_reconcile(first))]
+        while pending:
+            db, message_type, data = pending.pop(0)
+            other = first if db is second else second
+            if message_type == 'reconcile_batch':
+                transactions.apply_sync_transactions(db, sync.decode_batch(data))
+                continue
+            pending.extend((other, reply_type, reply) for reply_type, reply in sync.reconcile(db, message_type, data))
+
+    def keys(self, db):
+        return sorted(db.get_transaction_keys())
+
+    def test_missing_transactions_swapped(self):
+        first, second = self.make_db(), self.make_db()
+        create(first, '1', '2024-10-27 08:00:00')
+        create(first, '2', '2024-10-27 09:15:00')
+        create(second, '3', '2024-10-27 09:15:30')
+        create(second, '4', '2024-10-28 10:00:00')
+
+        self.exchange(first, second)
+
+        self.assertEqual(self.keys(first), self.keys(second))
+        self.assertEqual(len(self.keys(first)), 4)
+        self.assertEqual(self.count(first, 'encounters'), 4)
+        self.assertEqual(self.count(second, 'encounters'), 4)
+
+    def test_in_step_peers_send_nothing(self):
+        first, second = self.make_db(), self.make_db()
+        create(first, '1', '2024-10-27 08:00:00')
+        self.exchange(first, second)
+
+        self.assertEqual(sync.reconcile(second, 'reconcile', sync.start_reconcile(first)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker transaction tests
+
+    python -m pytest tests
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transactions
+from models import Db
+
+
+# An encounter_transactions row as a sync peer sends it
+def sync_item(action, encounter_uuid, created_at='2024-10-27 08:00:00', **data):
+    payload = {'action': action}
+    for key, value in data.items():
+        payload[f'data[{encounter_uuid}][{key}]'] = value
+    return {'uuid': str(uuid4()), 'encounter_uuid': encounter_uuid, 'user': 'peer',
+            'created_at': created_at, 'data': json.dumps(payload)}
+
+
+class ApplySyncTransactionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Db(os.path.join(self.directory.name, 'test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def count(self, table):
+        return self.db.select(f'SELECT COUNT(*) FROM {table}', (), tuples=True)['rows'][0][0]
+
+    def test_malformed_item_in_batch(self):
+        bad = sync_item('create', str(uuid4()), bib='2')
+        bad['data'] = json.dumps({'data[x][bib]': '2'})
+        items = [sync_item('create', str(uuid4()), bib='1'), bad, sync_item('create', str(uuid4()), bib='3')]
+
+        result = transactions.apply_sync_transactions(self.db, items)
+
+        self.assertEqual(result, {'applied': 2, 'stale': 0, 'duplicates': 0, 'failed': [bad['uuid']]})
+        self.assertEqual(self.count('encounters'), 2)
+        self.assertEqual(self.count('encounter_transactions'), 2)
+
+    def test_late_edit_does_not_overwrite_newer(self):
+        uuid = str(uuid4())
+        transactions.apply_sync_transactions(self.db, [
+            sync_item('create', uuid, '2024-10-27 08:00:00', bib='1', notes='created'),
+            sync_item('edit', uuid, '2024-10-27 09:00:00', notes='newer'),
+        ])
+
+        # Out of order within a batch, and older than the row
+        result = transactions.apply_sync_transactions(self.db, [
+            sync_item('edit', uuid, '2024-10-27 08:50:00', notes='late'),
+            sync_item('edit', uuid, '2024-10-27 08:30:00', notes='later still'),
+        ])
+
+        self.assertEqual(result['stale'], 2)
+        self.assertEqual(self.db.zip_encounters(uuid=uuid)['data'][0]['notes'], 'newer')
+        self.assertEqual(self.count('encounter_transactions'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCM - Medical Tracker encounter transactions
+
+Applies create, edit and remove transactions to the encounters table.  The
+change, the read back of the changed row, the station_stats counters, the
+audit log row and the sync transaction row are all written in one unit of
+work, so they commit (or fail) together.  Listeners registered with add_listener are called once the unit of
+work has committed, e.g. to notify connected browsers and sync peers.
+apply_sync_transactions applies a whole batch from a sync peer in one unit
+of work, apply_bulk_transactions a batch of operations from the public API.
+"""
+
+__author__ = "Joe Porcelli"
+__copyright__ = "Copyright 2024, Joe Porcelli"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__email__ = "porcej@gmail.com"
+__status__ = "Development"
+
+
+import json
+import re
+import sys
+from datetime import datetime
+from uuid import uuid4, UUID
+
+_listeners = []
+
+
+# Register a function called with the result of every committed transaction
+def add_listener(listener):
+    _listeners.append(listener)
+
+
+# Parse a transaction request
+def parse_transaction(payload):
+    known_actions = ['create', 'edit', 'remove']
+    transaction_parts = {
+        'data': {},
+    }
+
+    # Check if data is string, if so unpack to object
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+
+    # Validate the post request
+    if 'action' not in payload:
+        e_msg = "Encounter post submitted without action."
+        print(e_msg, file=sys.stderr)
+        return { 'error': e_msg}
+
+    transaction_parts['action'] = payload['action'].lower()
+    if transaction_parts['action'] not in known_actions:
+        e_msg = f"Encounter post submitted with unknown action {transaction_parts['action']}."
+        print(e_msg, file=sys.stderr)
+        return { 'error': e_msg}
+
+    for key in payload.keys():
+        tokens = re.findall(r'\[(.*?)\]', key)
+        if len(tokens) == 2:
+            [transaction_parts['encounter_uuid'], field_key] = tokens
+            transaction_parts['data'][field_key] = payload[key]
+
+    return transaction_parts
+
+
+# Aid stations of the given rows, without repeats.  An edit that moves an
+# encounter to another station affects both.
+def _aid_stations(rows):
+    aid_stations = []
+    for row in rows:
+        if row.get('aid_station') not in aid_stations:
+            aid_stations.append(row.get('aid_station'))
+    return aid_stations
+
+
+def transact_create(db, user, data, uuid=None, updated_at=None):
+    # Keep a supplied uuid only if it is a well formed version 4 uuid
+    try:
+        if UUID(uuid).version != 4:
+            raise ValueError(uuid)
+    except (TypeError, ValueError, AttributeError):
+        uuid = str(uuid4())
+    data['uuid'] = uuid
+    if updated_at is not None:
+        data['updated_at'] = updated_at
+    data_keys = data.keys()
+    query = f"INSERT INTO encounters ( {', '.join(data_keys) }) VALUES (:{', :'.join(data_keys)})"
+    db.execute_query(query, data)
+    new_data = db.zip_encounters(uuid=uuid)
+    db.update_station_stats([], new_data['data'])
+    return {'encounter_uuid': uuid, 'data': new_data, 'user': user,
+            'aid_stations': _aid_stations(new_data['data'])}
+
+
+def transact_edit(db, user, data, uuid, updated_at=None):
+    if updated_at is not None:
+        data['updated_at'] = updated_at
+    data_cols = ', '.join([f"{key} = ?" for key in data.keys()])
+    data_vals = list(data.values())
+
+    old_data = db.zip_encounters(uuid=uuid)
+    query = f"UPDATE encounters SET {data_cols} WHERE uuid = ?"
+    db.execute_query(query, data_vals + [uuid])
+    new_data = db.zip_encounters(uuid=uuid)
+    db.update_station_stats(old_data['data'], new_data['data'])
+    return {'encounter_uuid': uuid, 'data': new_data, 'user': user,
+            'aid_stations': _aid_stations(old_data['data'] + new_data['data'])}
+
+
+def transact_delete(db, user, uuid, updated_at=None):
+    old_data = db.zip_encounters(uuid=uuid)
+    query = "UPDATE encounters SET delete_flag=1, updated_at=COALESCE(?, updated_at) WHERE uuid=?"
+    db.execute_query(query, (updated_at, uuid))
+    new_data = db.zip_encounters(uuid=uuid, include_deleted=True)
+    db.update_station_stats(old_data['data'], [])
+    return {'encounter_uuid': uuid, 'data': new_data, 'user': user,
+            'aid_stations': _aid_stations(old_data['data'])}
+
+
+# Apply a transaction and record it in the audit and sync logs.
+#
+# payload is the DataTables Editor style request ({'action': ..., 'data[<uuid>][<field>]': ...})
+# either as a dict or a JSON string.  transaction_uuid, synced and origin
+# are stored on the sync row; pass synced=2 and the sending peer as origin
+# for transactions received from a sync peer.
+# Returns the transaction result, or a dict with an 'error' key.
+def apply_transaction(db, payload, user="API", encounter_uuid=None, created_at=None,
+                      transaction_uuid=None, synced=0, origin=None):
+    parts = parse_transaction(payload)
+
+    # If we had an error parsing, just return that message
+    if 'error' in parts:
+        return parts
+
+    # If we have an encounter UUID, lets use it
+    if encounter_uuid is not None:
+        parts['encounter_uuid'] = encounter_uuid
+
+    # Without an encounter uuid an edit or remove would match every row
+    if parts['action'] in ('edit', 'remove') and not parts.get('encounter_uuid'):
+        return {'error': f"Encounter {parts['action']} requires an encounter uuid"}
+
+    if created_at is None:
+        created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    with db.unit_of_work() as uow:
+        # Handle Creating a new record
+        if parts['action'] == 'create':
+            ret_val = transact_create(db, user=user, data=parts['data'], uuid=parts.get('encounter_uuid'), updated_at=created_at)
+
+        # Handle Editing an existing record
+        elif parts['action'] == 'edit':
+            ret_val = transact_edit(db, user=user, data=parts['data'], uuid=parts.get('encounter_uuid'), updated_at=created_at)
+
+        # Handle removing
+        elif parts['action'] == 'remove':
+            ret_val = transact_delete(db, user=user, uuid=parts.get('encounter_uuid'), updated_at=created_at)
+
+        jnew_data = json.dumps(ret_val['data'])
+        db.log_encounter_audit(action=parts['action'], uuid=ret_val['encounter_uuid'], user_id=user, resultant_value=jnew_data)
+        ret_val['transaction_uuid'] = db.log_transaction(encounter_uuid=ret_val['encounter_uuid'], user=user, data=payload,
+                                                         created_at=created_at, transaction_uuid=transaction_uuid, synced=synced,
+                                                         origin=origin)
+
+        ret_val.update({'action': parts['action'], 'synced': synced, 'created_at': created_at})
+        uow.after_commit(lambda: _notify(ret_val))
+        nested = uow.depth > 1
+
+    # Inside a larger unit of work the outcome is only known once it ends
+    if uow.errors or not (nested or uow.committed):
+        return {'error': f"Encounter {parts['action']} was not saved: {'; '.join(uow.errors)}"}
+
+    ret_val['elapsed_ms'] = uow.elapsed_ms
+    return ret_val
+
+
+def _notify(result):
+    for listener in _listeners:
+        try:
+            listener(result)
+        except Exception as e:
+            print(f"Error notifying transaction listener {listener.__name__}: {e}", file=sys.stderr)
+
+
+# True if item is an edit made before the last change to its encounter
+# (updated is {encounter uuid: updated_at})
+def _stale_edit(item, updated):
+    changed_at = updated.get(item['encounter_uuid'])
+    if changed_at is None or str(item['created_at']) >= str(changed_at):
+        return False
+    parts = parse_transaction(item['data'])
+    return parts.get('action') == 'edit'
+
+
+# Apply transactions received from a sync peer, skipping any already in the
+# transaction log, in the order they were made.  An edit older than the
+# last change to its encounter is only recorded in the transaction log, so
+# a late edit never overwrites a newer one.  The batch is applied in one
+# unit of work; if any item fails the batch is rolled back and applied item
+# by item so one bad transaction does not hold back the rest.
+#
+# items are encounter_transactions rows from the peer named origin.  Returns
+# a dict with the counts applied, stale and duplicates, and the uuids that
+# failed.
+def apply_sync_transactions(db, items, origin=None):
+    seen = db.get_synced_uuids(item['uuid'] for item in items)
+    new_items = []
+    for item in items:
+        if item['uuid'] not in seen:
+            seen.add(item['uuid'])
+            new_items.append(item)
+    new_items.sort(key=lambda item: str(item['created_at'] or ''))
+
+    def apply(item, updated):
+        if _stale_edit(item, updated):
+            with db.unit_of_work() as uow:
+                db.log_transaction(encounter_uuid=item['encounter_uuid'], user=item['user'], data=item['data'],
+                                   created_at=item['created_at'], transaction_uuid=item['uuid'], synced=2,
+                                   origin=origin)
+                nested = uow.depth > 1
+            if uow.errors or not (nested or uow.committed):
+                return {'error': f"Stale transaction was not logged: {'; '.join(uow.errors)}"}
+            return {'stale': True}
+        result = apply_transaction(db, payload=item['data'], user=item['user'], encounter_uuid=item['encounter_uuid'],
+                                   created_at=item['created_at'], transaction_uuid=item['uuid'], synced=2,
+                                   origin=origin)
+        if 'error' not in result:
+            updated[result['encounter_uuid']] = item['created_at']
+        return result
+
+    def apply_all(on_error):
+        counts = {'applied': 0, 'stale': 0}
+        updated = db.get_encounter_updated_at(item['encounter_uuid'] for item in new_items)
+        for item in new_items:
+            result = apply(item, updated)
+            if 'error' in result:
+                if on_error(item, result):
+                    break
+            else:
+                counts['stale' if result.get('stale') else 'applied'] += 1
+        return counts
+
+    with db.unit_of_work() as uow:
+        # Not every error comes from the database, fail the unit of work so
+        # the items before the failed one are rolled back too
+        def fail_batch(item, result):
+            uow.errors.append(result['error'])
+            return True
+        counts = apply_all(fail_batch)
+
+    failed = []
+    if not uow.committed:
+        def skip(item, result):
+            print(f"Unable to apply sync transaction {item['uuid']}: {result['error']}", file=sys.stderr)
+            failed.append(item['uuid'])
+        counts = apply_all(skip)
+
+    return dict(counts, duplicates=len(items) - len(new_items), failed=failed)
+
+
+# Apply a batch of operations from an API client in one unit of work: either
+# all of them are saved or none are.
+#
+# operations are dicts with an action (create, edit or remove), the
+# encounter uuid (optional for create, generated when missing), the
+# encounter fields in data and an optional client transaction_uuid.  An
+# operation whose transaction_uuid is already in the transaction log is a
+# retry and is skipped.  Returns (committed, a result dict per operation).
+def apply_bulk_transactions(db, operations, user="API"):
+    seen = db.get_synced_uuids(op['transaction_uuid'] for op in operations if op.get('transaction_uuid'))
+    existing = db.get_encounter_uuids(op['uuid'] for op in operations if op.get('uuid'))
+
+    # Check every operation against the database before writing any
+    results = []
+    for index, op in enumerate(operations):
+        result = {'index': index, 'action': op['action'], 'uuid': op.get('uuid'),
+                  'transaction_uuid': op.get('transaction_uuid'), 'status': 'pending'}
+        if result['transaction_uuid'] in seen:
+            result['status'] = 'duplicate'
+        elif op['action'] == 'create':
+            if result['uuid'] in existing:
+                result.update(status='error', error=f"Encounter {result['uuid']} already exists")
+            elif result['uuid'] is None:
+                result['uuid'] = str(uuid4())
+        elif result['uuid'] not in existing:
+            result.update(status='error', error=f"Encounter {result['uuid']} not found")
+        if result['status'] == 'pending':
+            existing.add(result['uuid'])
+            if result['transaction_uuid'] is not None:
+                seen.add(result['transaction_uuid'])
+        results.append(result)
+
+    if any(result['status'] == 'error' for result in results):
+        for result in results:
+            if result['status'] == 'pending':
+                result['status'] = 'not_applied'
+        return False, results
+
+    done = {'create': 'created', 'edit': 'edited', 'remove': 'removed'}
+    with db.unit_of_work() as uow:
+        for op, result in zip(operations, results):
+            if result['status'] != 'pending':
+                continue
+            payload = {'action': op['action']}
+            for key, value in (op.get('data') or {}).items():
+                payload[f"data[{result['uuid']}][{key}]"] = value
+            applied = apply_transaction(db, payload=payload, user=user, encounter_uuid=result['uuid'],
+                                        transaction_uuid=result['transaction_uuid'])
+            if 'error' in applied:
+                result.update(status='error', error=applied['error'])
+                uow.errors.append(applied['error'])
+                break
+            result.update(status=done[op['action']], transaction_uuid=applied['transaction_uuid'])
+
+    if not uow.committed:
+        for result in results:
+            if result['status'] not in ('error', 'duplicate'):
+                result['status'] = 'not_applied'
+    return uow.committed, results